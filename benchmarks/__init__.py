@@ -0,0 +1,3 @@
+"""
+Throughput benchmarks for backup and restore against synthetic clusters
+"""
@@ -0,0 +1,193 @@
+"""
+Run the backup and restore throughput benchmark
+
+A synthetic cluster is backed up to an in-process S3 stand-in provided by
+moto, optionally under several cluster names to measure the content layout
+sharing objects between clusters, then restored from it with a strategy that parses each resource. The
+throughput, request counts and peak memory of each phase are printed and
+can be written to a JSON file, and compared with an earlier result file.
+
+Example:
+    python -m benchmarks.run --namespaces 10 --objects 10000 --size 1024 --output results.json
+    python -m benchmarks.run --namespaces 10 --objects 10000 --size 1024 --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+import boto3
+from kubernetes import client
+
+import utilslib.library as lib
+from utilslib.dr import Backup, Restore, Clients
+from benchmarks.synthetic import SyntheticCluster, CountingStrategy
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+BUCKET_NAME = "k8s-dr-benchmark"
+CLUSTER_SET = "bench"
+CLUSTER_NAME = "synthetic"
+
+
+def run_backup(cluster, args, cluster_name=CLUSTER_NAME):
+    """Back up the synthetic cluster, returns the measurements"""
+    backup = Backup(bucket_name=BUCKET_NAME, cluster_set=CLUSTER_SET, cluster_name=cluster_name,
+                    api_client=client.ApiClient(client.Configuration()),
+                    k8s_workers=args.k8s_workers, s3_workers=args.s3_workers,
+                    skip_unchanged=args.skip_unchanged, layout=args.layout,
+                    compression=args.compression, compression_level=args.compression_level, k8s_qps=0)
+    cluster.attach(backup.k8s)
+    measurement = _measure(args, backup.save_cluster)
+    _, errors = measurement.value
+    if len(errors) > 0:
+        raise Exception("backup failed for namespaces: {}".format(", ".join(sorted(errors))))
+    return _result(backup.last_report, measurement)
+
+
+def run_restore(cluster, args):
+    """Restore the synthetic cluster from the backup, returns the measurements"""
+    strategy = CountingStrategy(CLUSTER_NAME)
+    restore = Restore(BUCKET_NAME, strategy, cluster_set=CLUSTER_SET, cluster_name=CLUSTER_NAME,
+                      api_client=client.ApiClient(client.Configuration()),
+                      prefetch_workers=args.prefetch_workers, k8s_qps=0)
+    cluster.attach(restore.k8s)
+    measurement = _measure(args, lambda: restore.restore_namespaces(CLUSTER_SET, CLUSTER_NAME, "*",
+                                                                    workers=args.restore_workers))
+    if len(restore.namespace_errors) > 0:
+        raise Exception("restore failed for namespaces: {}".format(", ".join(sorted(restore.namespace_errors))))
+    return _result(restore.last_report, measurement)
+
+
+class _Measurement(object):
+    def __init__(self, value, elapsed, peak):
+        self.value = value
+        self.elapsed = elapsed
+        self.peak = peak
+
+
+def _measure(args, func):
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        value = func()
+        elapsed = time.perf_counter() - started
+    finally:
+        peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+        if args.trace_memory:
+            tracemalloc.stop()
+    if peak is None:
+        # ru_maxrss is the peak of the whole process so far, in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return _Measurement(value, elapsed, peak)
+
+
+def _result(report, measurement):
+    elapsed = measurement.elapsed
+    peak = measurement.peak
+    totals = report["totals"]
+    return {"objects": totals.get("objects", 0),
+            "bytes": totals.get("bytes", 0),
+            "seconds": round(elapsed, 3),
+            "objects_per_second": round(totals.get("objects", 0) / elapsed, 1) if elapsed > 0 else 0,
+            "megabytes_per_second": round(totals.get("bytes", 0) / elapsed / 1024 / 1024, 3) if elapsed > 0 else 0,
+            "k8s_requests": report["metrics"]["k8s_requests_total"],
+            "s3_requests": report["metrics"]["s3_requests_total"],
+            "s3_uploaded_bytes": report["metrics"]["s3_uploaded_bytes_total"],
+            "peak_memory_megabytes": round(peak / 1024 / 1024, 1),
+            "phases": {name: round(seconds, 3) for name, seconds in report["phases"].items()},
+            "compression": report.get("compression")}
+
+
+def run(args):
+    """Run the benchmark, returns the results"""
+    if mock_aws is None:
+        raise Exception("the benchmarks need moto, install it with: pip install k8sdrutils[bench]")
+
+    for name, value in (("AWS_DEFAULT_REGION", "us-east-1"), ("AWS_ACCESS_KEY_ID", "benchmark"),
+                        ("AWS_SECRET_ACCESS_KEY", "benchmark")):
+        os.environ.setdefault(name, value)
+
+    cluster = SyntheticCluster(namespaces=args.namespaces, objects_per_namespace=args.objects,
+                               object_size=args.size, kinds=args.kinds.split(","), api_latency=args.api_latency)
+    lib.log.setLevel(args.log_level)
+    with mock_aws():
+        Clients.clear()
+        boto3.client("s3").create_bucket(Bucket=BUCKET_NAME)
+        results = {"parameters": {"namespaces": args.namespaces, "objects_per_namespace": args.objects,
+                                  "object_size": args.size, "kinds": args.kinds, "api_latency": args.api_latency,
+                                  "k8s_workers": args.k8s_workers, "s3_workers": args.s3_workers,
+                                  "prefetch_workers": args.prefetch_workers, "restore_workers": args.restore_workers,
+                                  "skip_unchanged": args.skip_unchanged, "layout": args.layout, "clusters": args.clusters,
+                                  "compression": args.compression, "compression_level": args.compression_level},
+                   "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                                   "cpus": os.cpu_count()},
+                   "backup": run_backup(cluster, args)}
+        if args.skip_unchanged:
+            results["backup_unchanged"] = run_backup(cluster, args)
+        for i in range(1, args.clusters):
+            results["backup_last_cluster"] = run_backup(cluster, args, "{}-{}".format(CLUSTER_NAME, i))
+        if not args.backup_only:
+            results["restore"] = run_restore(cluster, args)
+        Clients.clear()
+    return results
+
+
+def compare(results, baseline):
+    """Print the change in each measurement from a baseline result"""
+    for phase in ("backup", "backup_unchanged", "backup_last_cluster", "restore"):
+        if phase not in results or phase not in baseline:
+            continue
+        for name in ("objects_per_second", "megabytes_per_second", "k8s_requests", "s3_requests", "peak_memory_megabytes"):
+            old = baseline[phase].get(name)
+            new = results[phase].get(name)
+            change = "{:+.1f}%".format((new - old) * 100.0 / old) if old else "n/a"
+            print("{:<17} {:<22} {:>14} {:>14} {:>9}".format(phase, name, old, new, change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backup and restore throughput benchmark")
+    parser.add_argument("--namespaces", type=int, default=10, help="number of namespaces")
+    parser.add_argument("--objects", type=int, default=1000, help="number of objects in each namespace")
+    parser.add_argument("--size", type=int, default=1024, help="payload size of each object in bytes")
+    parser.add_argument("--kinds", default="ConfigMap,Secret,Deployment", help="comma separated kinds to generate")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="simulated API call latency in seconds")
+    parser.add_argument("--k8s-workers", type=int, default=1, help="backup k8s_workers")
+    parser.add_argument("--s3-workers", type=int, default=1, help="backup s3_workers")
+    parser.add_argument("--prefetch-workers", type=int, default=1, help="restore prefetch_workers")
+    parser.add_argument("--restore-workers", type=int, default=1, help="namespaces restored concurrently")
+    parser.add_argument("--skip-unchanged", action="store_true", help="back up twice with skip_unchanged")
+    parser.add_argument("--layout", default="objects", choices=Backup.layouts, help="backup layout")
+    parser.add_argument("--clusters", type=int, default=1,
+                        help="back up the cluster under this many cluster names, reporting the last one")
+    parser.add_argument("--compression", choices=sorted(lib.COMPRESSION_LEVELS.keys()), help="compress stored objects")
+    parser.add_argument("--compression-level", type=int, help="compression level")
+    parser.add_argument("--backup-only", action="store_true", help="do not run the restore")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="measure peak python memory with tracemalloc, slower but per phase")
+    parser.add_argument("--log-level", default="WARNING", help="log level")
+    parser.add_argument("--output", help="file to write the results to as JSON")
+    parser.add_argument("--compare", help="JSON results file to compare with")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Microbenchmarks for resource serialization
+
+Times K8s.process_data, Backup._create_key_from_object and yaml encoding
+and decoding on realistic Deployment, ConfigMap and Secret objects. The
+process_data fast path is compared with K8s.process_data_recursive, the
+recursive implementation it replaced, and the libyaml dumper and loader
+with the pure Python ones.
+
+Example:
+    python -m benchmarks.serialization --number 2000
+"""
+import argparse
+import base64
+import json
+import timeit
+
+import yaml
+from urllib3 import HTTPResponse
+from kubernetes import client
+
+import utilslib.library as lib
+from utilslib.dr import K8s, Backup
+
+
+def _metadata(name, namespace):
+    return {"name": name, "namespace": namespace, "uid": "6f1c1f3e-4a5b-4f7e-9c36-2a0a7d6e0b11",
+            "resourceVersion": "123456789", "generation": 7, "creationTimestamp": "2020-05-01T10:00:00Z",
+            "labels": {"app.kubernetes.io/name": name, "app.kubernetes.io/part-of": "shop",
+                       "app.kubernetes.io/version": "1.4.2", "team": "payments"},
+            "annotations": {"deployment.kubernetes.io/revision": "12",
+                            "kubectl.kubernetes.io/last-applied-configuration": json.dumps({"kind": "x", "spec": "y" * 600})},
+            "managedFields": [{"manager": "kubectl", "operation": "Update", "apiVersion": "apps/v1",
+                               "time": "2020-05-01T10:00:00Z", "fieldsType": "FieldsV1",
+                               "fieldsV1": {"f:metadata": {"f:labels": {}}}}]}
+
+
+def _container(name, image):
+    return {"name": name, "image": image, "imagePullPolicy": "IfNotPresent",
+            "args": ["--port=8080", "--log-level=info", "--metrics"],
+            "ports": [{"name": "http", "containerPort": 8080, "protocol": "TCP"},
+                      {"name": "metrics", "containerPort": 9090, "protocol": "TCP"}],
+            "env": [{"name": "SETTING_{}".format(i), "value": "value-{}".format(i)} for i in range(12)] +
+                   [{"name": "PASSWORD", "valueFrom": {"secretKeyRef": {"name": "db", "key": "password"}}}],
+            "resources": {"limits": {"cpu": "1", "memory": "512Mi"}, "requests": {"cpu": "100m", "memory": "128Mi"}},
+            "livenessProbe": {"httpGet": {"path": "/healthz", "port": 8080}, "initialDelaySeconds": 10, "periodSeconds": 10},
+            "readinessProbe": {"httpGet": {"path": "/ready", "port": 8080}, "periodSeconds": 5},
+            "volumeMounts": [{"name": "config", "mountPath": "/etc/app"}, {"name": "tmp", "mountPath": "/tmp"}]}
+
+
+def deployment(name="checkout", namespace="shop"):
+    """Returns a realistic V1Deployment"""
+    return _deserialize({"apiVersion": "apps/v1", "kind": "Deployment", "metadata": _metadata(name, namespace),
+                         "spec": {"replicas": 3, "revisionHistoryLimit": 10,
+                                  "selector": {"matchLabels": {"app.kubernetes.io/name": name}},
+                                  "strategy": {"type": "RollingUpdate", "rollingUpdate": {"maxSurge": "25%", "maxUnavailable": "25%"}},
+                                  "template": {"metadata": {"labels": {"app.kubernetes.io/name": name}},
+                                               "spec": {"serviceAccountName": name,
+                                                        "containers": [_container(name, "registry.example.com/shop/{}:1.4.2".format(name)),
+                                                                       _container("proxy", "registry.example.com/proxy:2.1.0")],
+                                                        "volumes": [{"name": "config", "configMap": {"name": name}},
+                                                                    {"name": "tmp", "emptyDir": {}}]}}},
+                         "status": {"replicas": 3, "readyReplicas": 3, "availableReplicas": 3, "observedGeneration": 7}},
+                        "V1Deployment")
+
+
+def config_map(name="checkout", namespace="shop"):
+    """Returns a realistic V1ConfigMap"""
+    return _deserialize({"apiVersion": "v1", "kind": "ConfigMap", "metadata": _metadata(name, namespace),
+                         "data": dict([("key-{}".format(i), "value {} ".format(i) * 8) for i in range(20)] +
+                                      [("app.yaml", "server:\n  port: 8080\n" * 40)])},
+                        "V1ConfigMap")
+
+
+def secret(name="checkout", namespace="shop"):
+    """Returns a realistic V1Secret"""
+    return _deserialize({"apiVersion": "v1", "kind": "Secret", "type": "Opaque", "metadata": _metadata(name, namespace),
+                         "data": {"key-{}".format(i): base64.b64encode(("secret-{}".format(i) * 16).encode()).decode()
+                                  for i in range(5)}},
+                        "V1Secret")
+
+
+def _deserialize(data, response_type):
+    return client.ApiClient().deserialize(HTTPResponse(body=json.dumps(data)), response_type)
+
+
+def run(number=1000):
+    """Run the microbenchmarks, returns the microseconds per call of each"""
+    backup = Backup.__new__(Backup)
+    backup.prefix = ''
+    backup.k8s = K8s.__new__(K8s)
+    backup.k8s.cluster_info = {"cluster.set": "bench", "cluster.name": "synthetic"}
+
+    results = {}
+    for kind, obj in (("Deployment", deployment()), ("ConfigMap", config_map()), ("Secret", secret())):
+        processed = K8s.process_data(obj)
+        text = lib.yaml_dump(processed)
+        cases = {"process_data": lambda: K8s.process_data(obj),
+                 "process_data_reference": lambda: K8s.process_data_recursive(obj),
+                 "create_key_from_object": lambda: backup._create_key_from_object(obj),
+                 "yaml_dump": lambda: lib.yaml_dump(processed),
+                 "yaml_dump_python": lambda: yaml.dump(processed, Dumper=yaml.Dumper),
+                 "yaml_safe_load": lambda: lib.yaml_safe_load(text),
+                 "yaml_safe_load_python": lambda: yaml.load(text, Loader=yaml.SafeLoader)}
+        results[kind] = {name: round(min(timeit.repeat(case, number=number, repeat=3)) * 1e6 / number, 1)
+                         for name, case in cases.items()}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resource serialization microbenchmarks")
+    parser.add_argument("--number", type=int, default=1000, help="calls to time for each benchmark")
+    args = parser.parse_args(argv)
+
+    results = run(args.number)
+    print("microseconds per call, libyaml available: {}".format(yaml.__with_libyaml__))
+    for kind, timings in results.items():
+        for name, micros in timings.items():
+            print("{:<12} {:<24} {:>10}".format(kind, name, micros))
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+This module contains a synthetic Kubernetes API used by the benchmarks
+"""
+import base64
+import functools
+import threading
+import time
+from types import SimpleNamespace
+
+from kubernetes import client
+
+import utilslib.library as lib
+from utilslib.dr import K8s
+from utilslib.restore.strategy import RestoreStrategy
+
+
+class SyntheticCluster(object):
+    """A cluster of generated namespaces served through fake Kubernetes API objects
+
+    Each namespace holds objects_per_namespace objects spread evenly over
+    kinds, each with a payload of object_size bytes. Objects are generated
+    when they are listed rather than held in memory, so large clusters can
+    be simulated. Each API call sleeps for api_latency seconds to stand in
+    for the round trip to a real API server.
+
+    Arguments:
+        namespaces {int} -- the number of namespaces
+        objects_per_namespace {int} -- the number of objects in each namespace
+        object_size {int} -- the size of each object's payload in bytes
+        kinds {str[]} -- the kinds to generate, ConfigMap, Secret and Deployment are supported
+        api_latency {float} -- the time each API call takes in seconds
+    """
+
+    def __init__(self, namespaces=10, objects_per_namespace=1000, object_size=1024,
+                 kinds=("ConfigMap", "Secret", "Deployment"), api_latency=0.0):
+        unsupported = set(kinds) - set(_GENERATORS.keys())
+        if len(unsupported) > 0:
+            raise Exception("unsupported kinds: {}".format(", ".join(sorted(unsupported))))
+
+        self.namespaces = ["bench-{:04d}".format(i) for i in range(namespaces)]
+        self.objects_per_namespace = objects_per_namespace
+        self.object_size = object_size
+        self.kinds = list(kinds)
+        self.api_latency = api_latency
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._payload = "x" * object_size
+
+    @property
+    def total_objects(self):
+        """The number of objects in the cluster, not counting the namespaces"""
+        return len(self.namespaces) * self.objects_per_namespace
+
+    def count(self, namespace, kind):
+        """Returns the number of objects of a kind in a namespace"""
+        per_kind, extra = divmod(self.objects_per_namespace, len(self.kinds))
+        return per_kind + (1 if self.kinds.index(kind) < extra else 0) if kind in self.kinds else 0
+
+    def attach(self, k8s):
+        """Replace the API objects of a K8s object with ones served by this cluster
+
+        Arguments:
+            k8s {K8s} -- the object to attach to
+
+        Returns:
+            K8s -- the object
+        """
+        for attr in set(api for api, _, _ in K8s.supported_kinds.values()) | {"v1beta1", "custom"}:
+            setattr(k8s, attr, _FakeApi(self))
+        return k8s
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+        if self.api_latency > 0:
+            time.sleep(self.api_latency)
+
+    def list_objects(self, kind, namespace, limit=100, next=''):
+        """Returns a page of objects and the continue token for the next page"""
+        self._call()
+        start = int(next) if next else 0
+        end = min(start + limit, self.count(namespace, kind))
+        items = [_GENERATORS[kind](self, namespace, "{}-{:07d}".format(kind.lower(), i)) for i in range(start, end)]
+        return items, str(end) if end < self.count(namespace, kind) else None
+
+    def read_object(self, kind, namespace, name):
+        """Returns a single object"""
+        self._call()
+        if kind == "Namespace":
+            return _namespace(name)
+        return _GENERATORS[kind](self, namespace, name)
+
+    def list_namespaces(self, limit=100, next=''):
+        """Returns a page of namespaces and the continue token for the next page"""
+        self._call()
+        start = int(next) if next else 0
+        end = min(start + limit, len(self.namespaces))
+        items = [_namespace(name) for name in self.namespaces[start:end]]
+        return items, str(end) if end < len(self.namespaces) else None
+
+
+class _FakeApi(object):
+    """Stands in for the kubernetes client API classes, dispatching calls to a SyntheticCluster"""
+
+    def __init__(self, cluster):
+        self._cluster = cluster
+        self._kinds = {method: kind for kind, (_, method, _) in K8s.supported_kinds.items()}
+
+    def __getattr__(self, name):
+        if name.startswith("list_namespaced_") and name[len("list_namespaced_"):] in self._kinds:
+            return functools.partial(self._list, self._kinds[name[len("list_namespaced_"):]])
+        if name.startswith("read_namespaced_") and name[len("read_namespaced_"):] in self._kinds:
+            return functools.partial(self._read, self._kinds[name[len("read_namespaced_"):]])
+        raise AttributeError(name)
+
+    def _list(self, kind, namespace, limit=100, _continue=''):
+        items, next_item = self._cluster.list_objects(kind, namespace, limit=limit, next=_continue)
+        return _list_response(items, next_item)
+
+    def _read(self, kind, name, namespace):
+        return self._cluster.read_object(kind, namespace, name)
+
+    def list_namespace(self, limit=100, _continue='', label_selector=''):
+        items, next_item = self._cluster.list_namespaces(limit=limit, next=_continue)
+        return _list_response(items, next_item)
+
+    def read_namespace(self, name):
+        return self._cluster.read_object("Namespace", None, name)
+
+    def list_namespaced_custom_object(self, group, version, namespace, plural):
+        self._cluster._call()
+        return {"items": []}
+
+    def list_custom_resource_definition(self, limit=100, _continue=''):
+        self._cluster._call()
+        return _list_response([], None)
+
+
+class CountingStrategy(RestoreStrategy):
+    """A restore strategy that parses each resource and counts them, without applying anything"""
+
+    def __init__(self, cluster_name, **kwargs):
+        super(CountingStrategy, self).__init__(cluster_name, **kwargs)
+        self.processed = 0
+        self._lock = threading.Lock()
+
+    def start_namespace(self, namespace):
+        self.namespace = namespace
+
+    def process_resource(self, resource_data):
+        lib.yaml_safe_load(resource_data)
+        with self._lock:
+            self.processed += 1
+
+    def finish_namespace(self):
+        pass
+
+
+def _list_response(items, next_item):
+    return SimpleNamespace(items=items, metadata=SimpleNamespace(_continue=next_item))
+
+
+def _metadata(namespace, name):
+    return client.V1ObjectMeta(name=name, namespace=namespace, labels={"app": name, "benchmark": "true"},
+                               resource_version="1", uid="00000000-0000-0000-0000-000000000000")
+
+
+def _namespace(name):
+    return client.V1Namespace(metadata=client.V1ObjectMeta(name=name, labels={"benchmark": "true"}))
+
+
+def _config_map(cluster, namespace, name):
+    return client.V1ConfigMap(metadata=_metadata(namespace, name), data={"payload": cluster._payload})
+
+
+def _secret(cluster, namespace, name):
+    payload = base64.b64encode(cluster._payload.encode()).decode()
+    return client.V1Secret(metadata=_metadata(namespace, name), type="Opaque", data={"payload": payload})
+
+
+def _deployment(cluster, namespace, name):
+    container = client.V1Container(name="app", image="registry.example.com/app:1.0.0",
+                                   env=[client.V1EnvVar(name="PAYLOAD", value=cluster._payload)])
+    template = client.V1PodTemplateSpec(metadata=client.V1ObjectMeta(labels={"app": name}),
+                                        spec=client.V1PodSpec(containers=[container]))
+    spec = client.V1DeploymentSpec(replicas=1, selector=client.V1LabelSelector(match_labels={"app": name}),
+                                   template=template)
+    return client.V1Deployment(metadata=_metadata(namespace, name), spec=spec)
+
+
+_GENERATORS = {"ConfigMap": _config_map,
+               "Secret": _secret,
+               "Deployment": _deployment}
@@ -25,6 +25,8 @@ setuptools.setup(
                 'pytest-cov',
                 'pytest-mock',
                 'pylint'],
+        'bench': ['moto[s3]>=5'],
+        'zstd': ['zstandard'],
     },
-    packages=setuptools.find_packages()
+    packages=setuptools.find_packages(exclude=['benchmarks'])
 )
\ No newline at end of file
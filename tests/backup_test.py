@@ -1,7 +1,12 @@
 # pylint: skip-file
+import io
+import pytest
 import os
+import json
 from utilslib.dr import Backup
 from botocore.stub import ANY
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
 from .testutils import create_response_data
 
 def test_backup(s3_stub, mocker, datadir):
@@ -89,13 +94,13 @@ def test_backup(s3_stub, mocker, datadir):
     )
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': prefix},
+        expected_params={'Bucket': bucket_name, 'Prefix': prefix + '/'},
         service_response=STUB_LIST_RESPONSE
     )
     s3_stub.add_response(
-        'delete_object',
-        expected_params={'Key': 'default/cluster1/kube-system/Deployment/apps_v1/appdeleted.yaml', 'Bucket': bucket_name},
-        service_response={'DeleteMarker': False, 'VersionId': '1234'},
+        'delete_objects',
+        expected_params={'Bucket': bucket_name, 'Delete': {'Objects': [{'Key': 'default/cluster1/kube-system/Deployment/apps_v1/appdeleted.yaml'}], 'Quiet': True}},
+        service_response={},
     )
     s3_stub.activate()
 
@@ -103,6 +108,7 @@ def test_backup(s3_stub, mocker, datadir):
     num_stored, num_deleted = backup.save_namespace(namespace)
     assert num_stored == 5
     assert num_deleted == 1
+    assert backup.last_report["totals"].get("skipped", 0) == 0
 
 def test_backup_prefix(s3_stub, mocker, datadir):
     bucket_name = 'test-bucket'
@@ -189,13 +195,13 @@ def test_backup_prefix(s3_stub, mocker, datadir):
     )
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': "cluster1/application-backups/default/cluster1/kube-system"},
+        expected_params={'Bucket': bucket_name, 'Prefix': "cluster1/application-backups/default/cluster1/kube-system/"},
         service_response=STUB_LIST_RESPONSE_PREFIX
     )
     s3_stub.add_response(
-        'delete_object',
-        expected_params={'Key': 'cluster1/application-backups/default/cluster1/kube-system/Deployment/apps_v1/appdeleted.yaml', 'Bucket': bucket_name},
-        service_response={'DeleteMarker': False, 'VersionId': '1234'},
+        'delete_objects',
+        expected_params={'Bucket': bucket_name, 'Delete': {'Objects': [{'Key': 'cluster1/application-backups/default/cluster1/kube-system/Deployment/apps_v1/appdeleted.yaml'}], 'Quiet': True}},
+        service_response={},
     )
     s3_stub.activate()
 
@@ -203,6 +209,255 @@ def test_backup_prefix(s3_stub, mocker, datadir):
     num_stored, num_deleted = backup.save_namespace(namespace)
     assert num_stored == 5
     assert num_deleted == 1
+    assert backup.last_report["totals"].get("skipped", 0) == 0
+
+def test_backup_from_list(s3_stub, mocker, datadir):
+    bucket_name = 'test-bucket'
+    namespace = 'kube-system'
+    cluster_name = 'cluster1'
+    cluster_set = 'default'
+
+    patched_reads = _patch_k8s(mocker, datadir)
+    _add_backup_responses(s3_stub, bucket_name)
+    s3_stub.activate()
+
+    backup = Backup(client=s3_stub.client, bucket_name=bucket_name, cluster_set=cluster_set, cluster_name=cluster_name, kube_config=datadir.join('kubeconfig').strpath)
+    num_stored, num_deleted = backup.save_namespace(namespace)
+    assert num_stored == 5
+    assert num_deleted == 1
+    assert backup.last_report["totals"].get("skipped", 0) == 0
+    for patched in patched_reads:
+        assert not patched.called
+
+def test_backup_read_objects(s3_stub, mocker, datadir):
+    bucket_name = 'test-bucket'
+    namespace = 'kube-system'
+    cluster_name = 'cluster1'
+    cluster_set = 'default'
+
+    patched_reads = _patch_k8s(mocker, datadir)
+    _add_backup_responses(s3_stub, bucket_name)
+    s3_stub.activate()
+
+    backup = Backup(client=s3_stub.client, bucket_name=bucket_name, cluster_set=cluster_set, cluster_name=cluster_name, kube_config=datadir.join('kubeconfig').strpath, read_objects=True)
+    num_stored, num_deleted = backup.save_namespace(namespace)
+    assert num_stored == 5
+    assert num_deleted == 1
+    assert backup.last_report["totals"].get("skipped", 0) == 0
+    for patched in patched_reads:
+        assert patched.called
+
+def test_backup_concurrent(mocker, datadir):
+    bucket_name = 'test-bucket'
+    namespace = 'kube-system'
+    cluster_name = 'cluster1'
+    cluster_set = 'default'
+
+    _patch_k8s(mocker, datadir)
+    s3_client = mocker.MagicMock()
+    s3_client.list_objects_v2.return_value = STUB_LIST_RESPONSE
+
+    backup = Backup(client=s3_client, bucket_name=bucket_name, cluster_set=cluster_set, cluster_name=cluster_name, kube_config=datadir.join('kubeconfig').strpath, k8s_workers=4, s3_workers=4)
+    num_stored, num_deleted = backup.save_namespace(namespace)
+    assert num_stored == 5
+    assert num_deleted == 1
+    assert backup.last_report["totals"].get("skipped", 0) == 0
+
+    keys = [call[1]['Key'] for call in s3_client.put_object.call_args_list]
+    assert sorted(keys) == ['default/cluster1/bank-app2/VirtualService/networking.istio.io_v1alpha3/ingress-podinfo.yaml',
+                            'default/cluster1/bank-sys/ServiceAccount/v1/s3-backup.yaml',
+                            'default/cluster1/kube-system/ConfigMap/v1/coredns.yaml',
+                            'default/cluster1/kube-system/Deployment/apps_v1/coredns.yaml',
+                            'default/cluster1/kube-system/Namespace/v1/kube-system.yaml']
+    s3_client.delete_objects.assert_called_once_with(Bucket=bucket_name, Delete={'Objects': [{'Key': 'default/cluster1/kube-system/Deployment/apps_v1/appdeleted.yaml'}], 'Quiet': True})
+
+def test_backup_skip_unchanged(s3_stub, mocker, datadir):
+    bucket_name = 'test-bucket'
+    namespace = 'kube-system'
+    cluster_name = 'cluster1'
+    cluster_set = 'default'
+    manifest_key = 'default/cluster1/_manifests/kube-system.json'
+    manifest = _Capture()
+
+    _patch_k8s(mocker, datadir)
+    s3_stub.add_response(
+        'list_objects_v2',
+        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/'},
+        service_response=STUB_LIST_RESPONSE
+    )
+    s3_stub.add_client_error(
+        'get_object',
+        service_error_code='NoSuchKey',
+        http_status_code=404,
+        expected_params={'Bucket': bucket_name, 'Key': manifest_key}
+    )
+    for key in ['default/cluster1/kube-system/Namespace/v1/kube-system.yaml',
+                'default/cluster1/kube-system/ConfigMap/v1/coredns.yaml',
+                'default/cluster1/bank-sys/ServiceAccount/v1/s3-backup.yaml',
+                'default/cluster1/kube-system/Deployment/apps_v1/coredns.yaml',
+                'default/cluster1/bank-app2/VirtualService/networking.istio.io_v1alpha3/ingress-podinfo.yaml']:
+        s3_stub.add_response(
+            'put_object',
+            expected_params={'Key': key, 'Bucket': bucket_name, 'Body': ANY},
+            service_response={'ETag': '1234abc', 'VersionId': '1234'},
+        )
+    s3_stub.add_response(
+        'delete_objects',
+        expected_params={'Bucket': bucket_name, 'Delete': {'Objects': [{'Key': 'default/cluster1/kube-system/Deployment/apps_v1/appdeleted.yaml'}], 'Quiet': True}},
+        service_response={},
+    )
+    s3_stub.add_response(
+        'put_object',
+        expected_params={'Key': manifest_key, 'Bucket': bucket_name, 'Body': manifest},
+        service_response={'ETag': '1234abc', 'VersionId': '1234'},
+    )
+    s3_stub.activate()
+
+    backup = Backup(client=s3_stub.client, bucket_name=bucket_name, cluster_set=cluster_set, cluster_name=cluster_name, kube_config=datadir.join('kubeconfig').strpath, skip_unchanged=True)
+    num_stored, num_deleted = backup.save_namespace(namespace)
+    assert num_stored == 5
+    assert num_deleted == 1
+    assert backup.last_report["totals"].get("skipped", 0) == 0
+    assert backup.last_report["totals"]["uploaded"] == 5
+    assert backup.last_report["namespaces"]["kube-system"]["kinds"]["Deployment"] == {'objects': 1, 'bytes': ANY, 'uploaded': 1, 'deleted': 1}
+    assert backup.last_report["metrics"]["s3_requests_total"] == 9
+    s3_stub.assert_no_pending_responses()
+
+    # Second backup with nothing changed only rewrites the manifest
+    s3_stub.add_response(
+        'list_objects_v2',
+        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/'},
+        service_response=_list_response(json.loads(manifest.value)["objects"].keys())
+    )
+    s3_stub.add_response(
+        'get_object',
+        expected_params={'Bucket': bucket_name, 'Key': manifest_key},
+        service_response={'Body': StreamingBody(io.BytesIO(manifest.value), len(manifest.value))}
+    )
+    s3_stub.add_response(
+        'put_object',
+        expected_params={'Key': manifest_key, 'Bucket': bucket_name, 'Body': ANY},
+        service_response={'ETag': '1234abc', 'VersionId': '1234'},
+    )
+
+    num_stored, num_deleted = backup.save_namespace(namespace)
+    assert num_stored == 0
+    assert num_deleted == 0
+    assert backup.last_report["totals"].get("skipped", 0) == 5
+    assert backup.last_report["totals"] == {'objects': 5, 'bytes': ANY, 'skipped': 5}
+    assert backup.last_report["metrics"]["s3_requests_total"] == 3
+    assert set(backup.last_report["phases"].keys()) == {'diff', 'list', 'serialize', 'upload'}
+
+def test_backup_cluster(mocker, datadir):
+    bucket_name = 'test-bucket'
+    cluster_name = 'cluster1'
+    cluster_set = 'default'
+
+    patched_list_ns = mocker.patch("kubernetes.client.apis.core_v1_api.CoreV1Api.list_namespace", autospec=True)
+    patched_list_ns.return_value = create_response_data(datadir.join('namespacelist.json').strpath, 'V1NamespaceList')
+
+    def _save_namespace(self, namespace, namespace_object=None):
+        if namespace == 'app1':
+            raise Exception("failed to save app1")
+        assert namespace_object.metadata.name == namespace
+        return 5, 1
+
+    mocker.patch.object(Backup, 'save_namespace', _save_namespace)
+
+    backup = Backup(client=mocker.MagicMock(), bucket_name=bucket_name, cluster_set=cluster_set, cluster_name=cluster_name, kube_config=datadir.join('kubeconfig').strpath)
+    results, errors = backup.save_cluster(label_selector='backup=true')
+
+    assert results == {'kube-system': (5, 1)}
+    assert errors == {'app1': 'failed to save app1'}
+    assert patched_list_ns.call_args[1]['label_selector'] == 'backup=true'
+
+def test_backup_cluster_workers(mocker, datadir, tmpdir):
+    patched_list_ns = mocker.patch("kubernetes.client.apis.core_v1_api.CoreV1Api.list_namespace", autospec=True)
+    patched_list_ns.return_value = create_response_data(datadir.join('namespacelist.json').strpath, 'V1NamespaceList')
+    pool = mocker.patch("utilslib.dr.ProcessPoolExecutor")
+    pool.return_value.__enter__.return_value.map.return_value = [('kube-system', (5, 1), None, None)]
+
+    report_file = tmpdir.join('report.json').strpath
+    backup = Backup(client=mocker.MagicMock(), bucket_name='test-bucket', cluster_set='default', cluster_name='cluster1',
+                    kube_config=datadir.join('kubeconfig').strpath, report_file=report_file)
+    results, errors = backup.save_cluster(workers=2)
+
+    assert results == {'kube-system': (5, 1)}
+    assert errors == {}
+    _, kwargs = pool.call_args[1]['initargs']
+    assert 'report_file' not in kwargs
+    assert 'client' not in kwargs
+    assert kwargs['bucket_name'] == 'test-bucket'
+    assert os.path.exists(report_file)
+
+def _patch_k8s(mocker, datadir):
+    patched_read_ns = mocker.patch("kubernetes.client.apis.core_v1_api.CoreV1Api.read_namespace", autospec=True)
+    patched_read_ns.return_value = create_response_data(datadir.join('namespace.json').strpath, 'V1Namespace')
+
+    lists = [("core_v1_api.CoreV1Api.list_namespaced_config_map", 'configmaplist_single.json', 'V1ConfigMapList'),
+             ("core_v1_api.CoreV1Api.list_namespaced_limit_range", 'limitrangelist_empty.json', 'V1LimitRangeList'),
+             ("core_v1_api.CoreV1Api.list_namespaced_resource_quota", 'resourcequotalist_empty.json', 'V1ResourceQuotaList'),
+             ("core_v1_api.CoreV1Api.list_namespaced_secret", 'secretlist_empty.json', 'V1SecretList'),
+             ("core_v1_api.CoreV1Api.list_namespaced_service", 'servicelist_empty.json', 'V1ServiceList'),
+             ("apps_v1_api.AppsV1Api.list_namespaced_deployment", 'deploymentlist.json', 'V1DeploymentList'),
+             ("core_v1_api.CoreV1Api.list_namespaced_service_account", 'serviceaccountlist.json', 'V1ServiceAccountList'),
+             ("core_v1_api.CoreV1Api.list_namespaced_pod_template", 'podtemplatelist_empty.json', 'V1PodTemplateList'),
+             ("rbac_authorization_v1_api.RbacAuthorizationV1Api.list_namespaced_role", 'list_empty.json', 'V1RoleList'),
+             ("rbac_authorization_v1_api.RbacAuthorizationV1Api.list_namespaced_role_binding", 'list_empty.json', 'V1RoleBindingList'),
+             ("autoscaling_v1_api.AutoscalingV1Api.list_namespaced_horizontal_pod_autoscaler", 'list_empty.json', 'V1HorizontalPodAutoscalerList')]
+    for method, testfile, response_type in lists:
+        patched = mocker.patch("kubernetes.client.apis." + method, autospec=True)
+        patched.return_value = create_response_data(datadir.join(testfile).strpath, response_type)
+
+    mocker.patch("kubernetes.client.apis.custom_objects_api.CustomObjectsApi.list_namespaced_custom_object", new=_list_namespaced_custom_object)
+
+    reads = [("core_v1_api.CoreV1Api.read_namespaced_config_map", 'configmap.json', 'V1ConfigMap'),
+             ("apps_v1_api.AppsV1Api.read_namespaced_deployment", 'deployment.json', 'V1Deployment'),
+             ("core_v1_api.CoreV1Api.read_namespaced_service_account", 'serviceaccount.json', 'V1ServiceAccount')]
+    patched_reads = []
+    for method, testfile, response_type in reads:
+        patched = mocker.patch("kubernetes.client.apis." + method, autospec=True)
+        patched.return_value = create_response_data(datadir.join(testfile).strpath, response_type)
+        patched_reads.append(patched)
+
+    patched_get_custom = mocker.patch("kubernetes.client.apis.custom_objects_api.CustomObjectsApi.get_namespaced_custom_object", autospec=True)
+    patched_get_custom.side_effect = _get_namespaced_custom_object
+    patched_reads.append(patched_get_custom)
+    return patched_reads
+
+def _add_backup_responses(s3_stub, bucket_name):
+    for key in ['default/cluster1/kube-system/Namespace/v1/kube-system.yaml',
+                'default/cluster1/kube-system/ConfigMap/v1/coredns.yaml',
+                'default/cluster1/bank-sys/ServiceAccount/v1/s3-backup.yaml',
+                'default/cluster1/kube-system/Deployment/apps_v1/coredns.yaml',
+                'default/cluster1/bank-app2/VirtualService/networking.istio.io_v1alpha3/ingress-podinfo.yaml']:
+        s3_stub.add_response(
+            'put_object',
+            expected_params={'Key': key, 'Bucket': bucket_name, 'Body': ANY},
+            service_response={'ETag': '1234abc', 'VersionId': '1234'},
+        )
+    s3_stub.add_response(
+        'list_objects_v2',
+        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/'},
+        service_response=STUB_LIST_RESPONSE
+    )
+    s3_stub.add_response(
+        'delete_objects',
+        expected_params={'Bucket': bucket_name, 'Delete': {'Objects': [{'Key': 'default/cluster1/kube-system/Deployment/apps_v1/appdeleted.yaml'}], 'Quiet': True}},
+        service_response={},
+    )
+
+class _Capture(object):
+    """Matches any stubbed parameter value, recording the value"""
+    value = None
+
+    def __eq__(self, other):
+        self.value = other
+        return True
+
+def _list_response(keys):
+    contents = [{"Key": key, "ETag": "126abc", "Size": 4321, "StorageClass": "STANDARD"} for key in keys]
+    return {"KeyCount": len(contents), "Contents": contents}
 
 def _list_namespaced_custom_object(self, group, version, namespace, plural, **kwargs):
     if plural == "virtualservices":
@@ -296,4 +551,72 @@ STUB_LIST_RESPONSE_PREFIX = {
             "StorageClass": "STANDARD"
         }
     ]
-}
\ No newline at end of file
+}
+def test_backup_namespace_prefix_isolated(mocker, datadir):
+    bucket_name = 'test-bucket'
+    keys = ['default/cluster1/app/ConfigMap/v1/config.yaml',
+            'default/cluster1/app/Deployment/apps_v1/appdeleted.yaml',
+            'default/cluster1/app/_bundle.yaml.gz',
+            'default/cluster1/app1/ConfigMap/v1/config.yaml',
+            'default/cluster1/app-web/Deployment/apps_v1/web.yaml']
+
+    _patch_k8s(mocker, datadir)
+    s3_client = mocker.MagicMock()
+    s3_client.list_objects_v2.side_effect = lambda **kwargs: _list_response([key for key in keys if key.startswith(kwargs['Prefix'])])
+
+    backup = Backup(client=s3_client, bucket_name=bucket_name, cluster_set='default', cluster_name='cluster1', kube_config=datadir.join('kubeconfig').strpath)
+    backup._report = backup._start_report("backup")
+    deleted = backup._handle_deleted_resources(['default/cluster1/app/ConfigMap/v1/config.yaml'], 'app')
+
+    assert s3_client.list_objects_v2.call_args[1]['Prefix'] == 'default/cluster1/app/'
+    assert deleted == ['default/cluster1/app/Deployment/apps_v1/appdeleted.yaml', 'default/cluster1/app/_bundle.yaml.gz']
+    s3_client.delete_objects.assert_called_once_with(Bucket=bucket_name, Delete={'Objects': [{'Key': key} for key in deleted], 'Quiet': True})
+
+def test_store_content_known(mocker, datadir):
+    _patch_k8s(mocker, datadir)
+    s3_client = mocker.MagicMock()
+    s3_client.list_objects_v2.return_value = _list_response(['default/_objects/aa/aa11.yaml'])
+    s3_client.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+
+    backup = Backup(client=s3_client, bucket_name='test-bucket', cluster_set='default', cluster_name='cluster1',
+                    kube_config=datadir.join('kubeconfig').strpath, layout='content')
+    backup._add_stored_content({'default/cluster1/app/ConfigMap/v1/one.yaml': 'bb22'})
+
+    # content referenced by the previous backup is neither checked nor uploaded
+    assert not backup._store_content('bb22', 'one')
+    s3_client.head_object.assert_not_called()
+
+    # other content is checked with HEAD once the content path is found not to be empty
+    assert backup._store_content('cc33', 'two')
+    s3_client.head_object.assert_called_once_with(Bucket='test-bucket', Key='default/_objects/cc/cc33.yaml')
+    s3_client.put_object.assert_called_once()
+    assert not backup._store_content('cc33', 'two')
+    assert s3_client.list_objects_v2.call_count == 1
+
+def test_backup_bundle_compression(mocker, datadir):
+    with pytest.raises(ValueError, match="bundle layout"):
+        Backup(client=mocker.MagicMock(), bucket_name='test-bucket', cluster_set='default', cluster_name='cluster1',
+               kube_config=datadir.join('kubeconfig').strpath, layout='bundle', compression='gzip')
+
+def test_backup_bundle_streamed_without_manifest(mocker, datadir):
+    _patch_k8s(mocker, datadir)
+    s3_client = mocker.MagicMock()
+    s3_client.list_objects_v2.return_value = _list_response([])
+    s3_client.get_object.side_effect = ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+    pack = mocker.spy(Backup, '_pack_object')
+
+    backup = Backup(client=s3_client, bucket_name='test-bucket', cluster_set='default', cluster_name='cluster1',
+                    kube_config=datadir.join('kubeconfig').strpath, layout='bundle', skip_unchanged=True)
+    packed_at_first_chunk = []
+    def _store_stream_in_bucket(key, chunks, **kwargs):
+        chunks = iter(chunks)
+        next(chunks)
+        packed_at_first_chunk.append(pack.call_count)
+        return sum(len(chunk) for chunk in chunks)
+    mocker.patch.object(backup.store, 'store_stream_in_bucket', side_effect=_store_stream_in_bucket)
+
+    num_stored, _ = backup.save_namespace('kube-system')
+
+    # the first run has no manifest to compare with, so the bundle is uploaded as resources are packed
+    assert num_stored == 5
+    assert packed_at_first_chunk[0] < pack.call_count
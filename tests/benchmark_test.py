@@ -0,0 +1,46 @@
+# pylint: skip-file
+import pytest
+
+pytest.importorskip("moto")
+
+from benchmarks import run
+
+
+@pytest.fixture
+def run_benchmark(monkeypatch):
+    """Runs the benchmark on a small synthetic cluster against moto"""
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    return lambda *args: run.main(["--namespaces", "2", "--objects", "7", "--size", "64", "--s3-workers", "2"] + list(args))
+
+def test_benchmark_smoke(run_benchmark, tmpdir):
+    output = tmpdir.join("results.json").strpath
+
+    results = run_benchmark("--prefetch-workers", "2", "--skip-unchanged", "--output", output)
+
+    assert results["backup"]["objects"] == 2 * 7 + 2
+    # per namespace: list keys, get manifest, put namespace and objects, put manifest
+    assert results["backup"]["s3_requests"] == 2 * (1 + 1 + 8 + 1)
+    assert results["backup_unchanged"]["s3_requests"] == 2 * 3
+    assert results["restore"]["objects"] == 2 * 7 + 2
+    assert results["backup"]["k8s_requests"] > 0
+
+def test_benchmark_bundle_layout(run_benchmark):
+    results = run_benchmark("--prefetch-workers", "2", "--skip-unchanged", "--layout", "bundle")
+
+    # per namespace: list keys, get manifest, put bundle, put manifest
+    assert results["backup"]["s3_requests"] == 2 * 4
+    assert results["backup_unchanged"]["s3_requests"] == 2 * 3
+    assert results["restore"]["objects"] == 2 * 7 + 2
+
+def test_benchmark_content_layout(run_benchmark):
+    results = run_benchmark("--skip-unchanged", "--layout", "content", "--clusters", "2")
+
+    # check the content is empty, then per namespace: list keys, get references, put content and references
+    assert results["backup"]["s3_requests"] == 1 + 2 * (1 + 1 + 8 + 1)
+    # the content referenced by the previous backup is known to be stored
+    assert results["backup_unchanged"]["s3_requests"] == 2 * 3
+    # the second cluster shares all the content with the first, so only checks it
+    assert results["backup_last_cluster"]["s3_requests"] == 1 + 2 * (1 + 1 + 8 + 1)
+    assert results["restore"]["objects"] == 2 * 7 + 2
@@ -0,0 +1,49 @@
+# pylint: skip-file
+import gzip
+import hashlib
+import pytest
+import yaml
+
+from utilslib import bundle
+
+
+def _build(documents):
+    writer = bundle.BundleWriter('app1')
+    data = b''.join(writer.add(key, kind, 'v1', name, body) for key, kind, name, body in documents)
+    return writer, data + writer.finish()
+
+DOCUMENTS = [('default/cluster1/app1/Namespace/v1/app1.yaml', 'Namespace', 'app1', b'kind: Namespace\nmetadata:\n  name: app1\n'),
+             ('default/cluster1/app1/ConfigMap/v1/config.yaml', 'ConfigMap', 'config', b'kind: ConfigMap\ndata:\n  a: b\n')]
+
+def test_bundle_index():
+    writer, data = _build(DOCUMENTS)
+
+    offset, length = bundle.read_footer(data[-bundle.FOOTER_SIZE:])
+    index = bundle.read_index(data[offset:offset + length])
+
+    assert index['namespace'] == 'app1'
+    assert index['objects'] == writer.entries
+    for entry, (key, kind, name, body) in zip(index['objects'], DOCUMENTS):
+        assert (entry['key'], entry['kind'], entry['name'], entry['size']) == (key, kind, name, len(body))
+        assert entry['sha256'] == hashlib.sha256(body).hexdigest()
+        member = data[entry['offset']:entry['offset'] + entry['length']]
+        assert bundle.read_document(member) == body
+
+def test_bundle_is_multi_document_yaml():
+    _, data = _build(DOCUMENTS)
+
+    documents = [d for d in yaml.safe_load_all(gzip.decompress(data)) if d is not None]
+
+    assert [d['kind'] for d in documents] == ['Namespace', 'ConfigMap']
+
+def test_bundle_empty():
+    writer = bundle.BundleWriter('app1')
+    data = writer.finish()
+
+    offset, length = bundle.read_footer(data[-bundle.FOOTER_SIZE:])
+    assert offset == 0
+    assert bundle.read_index(data[offset:offset + length])['objects'] == []
+
+def test_bundle_invalid_footer():
+    with pytest.raises(Exception, match="not a bundle"):
+        bundle.read_footer(b'x' * bundle.FOOTER_SIZE)
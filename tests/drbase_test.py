@@ -1,4 +1,5 @@
 # pylint: skip-file
+from datetime import datetime, timezone
 from utilslib.dr import DRBase
 from .testutils import create_response_data
 
@@ -34,3 +35,40 @@ def test_create_s3_namespace_prefix_template(mocker, datadir):
     key = drbase.create_s3_key("bank-app1", "Deployment", "v1/apps", "test-app")
 
     assert key == "cluster2/application-backups/default/cluster2/bank-app1/Deployment/v1_apps/test-app.yaml"
+
+def test_create_s3_content_key(mocker, datadir):
+    patched = mocker.patch("kubernetes.client.apis.core_v1_api.CoreV1Api.read_namespaced_config_map", autospec=True)
+    patched.return_value = create_response_data(datadir.join('clusterdata.json').strpath, 'V1ConfigMap')
+
+    drbase = DRBase(kube_config=datadir.join('kubeconfig').strpath, prefix='application-backups')
+
+    content_path = drbase.get_s3_content_path("default")
+    key = drbase.get_s3_content_key(content_path, "ab12cd")
+
+    assert key == "application-backups/default/_objects/ab/ab12cd.yaml"
+    assert drbase.get_s3_references_key("default", "cluster2", "bank-app1") == "application-backups/default/cluster2/bank-app1/_references.json"
+
+def test_create_s3_snapshot_key(mocker, datadir):
+    patched = mocker.patch("kubernetes.client.apis.core_v1_api.CoreV1Api.read_namespaced_config_map", autospec=True)
+    patched.return_value = create_response_data(datadir.join('clusterdata.json').strpath, 'V1ConfigMap')
+
+    drbase = DRBase(kube_config=datadir.join('kubeconfig').strpath)
+
+    earlier = drbase.get_s3_snapshot_key("default", "cluster2", "bank-app1", datetime(2020, 5, 1, 10, 0, 0))
+    later = drbase.get_s3_snapshot_key("default", "cluster2", "bank-app1", datetime(2020, 5, 1, 10, 0, 0, 1000, tzinfo=timezone.utc))
+
+    assert earlier == "default/cluster2/_snapshots/bank-app1/{:013d}.json".format(10 ** 13 - 1 - 1588327200000)
+    assert later < earlier
+    assert drbase.epoch_ms(1588327200.5) == 1588327200500
+
+def test_retry_budget_per_object(mocker, datadir):
+    patched = mocker.patch("kubernetes.client.apis.core_v1_api.CoreV1Api.read_namespaced_config_map", autospec=True)
+    patched.return_value = create_response_data(datadir.join('clusterdata.json').strpath, 'V1ConfigMap')
+
+    drbase = DRBase(kube_config=datadir.join('kubeconfig').strpath, retry_budget=3)
+    drbase.retry_budget.acquire()
+    DRBase(kube_config=datadir.join('kubeconfig').strpath)
+
+    assert drbase.k8s.retry_budget is drbase.retry_budget
+    assert drbase.retry_budget.max_retries == 3
+    assert drbase.retry_budget.used == 1
@@ -1,5 +1,11 @@
 # pylint: skip-file
-from utilslib.dr import K8s
+import json
+import pytest
+import yaml
+import utilslib.library as lib
+from kubernetes import client
+from kubernetes.config import incluster_config
+from utilslib.dr import K8s, Clients
 from .testutils import create_response_data, create_k8s
 
 def test_read_namespace(mocker, datadir):
@@ -54,3 +60,89 @@ def test_get_cluster_info(mocker, datadir):
     result = k8s.get_cluster_info()
     assert result["cluster.set"] == "default"
     assert result["cluster.name"] == "cluster2"
+
+def test_set_type_meta(mocker, datadir):
+    data = create_response_data(datadir.join('configmaplist_single.json').strpath, 'V1ConfigMapList')
+    item = data.items[0]
+    assert item.kind is None
+
+    result = K8s.set_type_meta(item, "ConfigMap", "v1")
+    assert result.kind == "ConfigMap"
+    assert result.api_version == "v1"
+
+    result = K8s.set_type_meta({"kind": "VirtualService"}, "Gateway", "networking.istio.io/v1alpha3")
+    assert result["kind"] == "VirtualService"
+    assert result["apiVersion"] == "networking.istio.io/v1alpha3"
+
+def test_shared_api_client(mocker, datadir):
+    kube_config = datadir.join('kubeconfig').strpath
+    k8s1 = K8s(cluster_name='cluster2', kube_config=kube_config)
+    k8s2 = K8s(cluster_name='cluster2', kube_config=kube_config)
+
+    assert k8s1.v1.api_client is k8s2.v1.api_client
+    assert k8s1.rbac.api_client is k8s1.v1.api_client
+    assert k8s1.v1.api_client.configuration.connection_pool_maxsize == 10
+
+    k8s3 = K8s(cluster_name='cluster2', kube_config=kube_config, k8s_workers=32)
+
+    assert k8s3.v1.api_client is not k8s1.v1.api_client
+    assert k8s3.v1.api_client.configuration.connection_pool_maxsize == 32
+    assert K8s(cluster_name='cluster2', kube_config=kube_config).v1.api_client is k8s3.v1.api_client
+
+def test_shared_in_cluster_api_client(monkeypatch, tmpdir):
+    token = tmpdir.join('token')
+    token.write('in-cluster-token')
+    cert = tmpdir.join('ca.crt')
+    cert.write('certificate')
+    monkeypatch.setenv('KUBERNETES_SERVICE_HOST', '10.0.0.1')
+    monkeypatch.setenv('KUBERNETES_SERVICE_PORT', '443')
+    monkeypatch.setattr(incluster_config, 'SERVICE_TOKEN_FILENAME', token.strpath)
+    monkeypatch.setattr(incluster_config, 'SERVICE_CERT_FILENAME', cert.strpath)
+    monkeypatch.setattr(client.Configuration, '_default', client.Configuration._default)
+    Clients.clear()
+
+    configuration = Clients.k8s(pool_size=16).configuration
+
+    assert configuration.host == 'https://10.0.0.1:443'
+    assert 'in-cluster-token' in str(configuration.api_key)
+    assert configuration.ssl_ca_cert == cert.strpath
+    assert configuration.connection_pool_maxsize == 16
+    Clients.clear()
+
+@pytest.mark.parametrize("testfile,response_type", [
+    ('configmaplist.json', 'V1ConfigMapList'),
+    ('deploymentlist.json', 'V1DeploymentList'),
+    ('roleslist.json', 'V1RoleList'),
+    ('serviceaccountlist.json', 'V1ServiceAccountList'),
+    ('namespace.json', 'V1Namespace'),
+    ('virtualservice_list.json', None),
+])
+def test_process_data_matches_reference(datadir, testfile, response_type):
+    def load():
+        if response_type is None:
+            return json.load(open(datadir.join(testfile).strpath))
+        return create_response_data(datadir.join(testfile).strpath, response_type)
+
+    result = K8s.process_data(load())
+
+    assert result == K8s.process_data_recursive(load())
+    assert lib.yaml_safe_load(lib.yaml_dump(result)) == yaml.safe_load(yaml.dump(result))
+
+@pytest.mark.parametrize("testfile,response_type", [
+    ('deployment_realistic.json', 'V1Deployment'),
+    ('configmap_realistic.json', 'V1ConfigMap'),
+    ('secret_realistic.json', 'V1Secret'),
+])
+def test_process_data_realistic_objects(datadir, testfile, response_type):
+    result = K8s.process_data(create_response_data(datadir.join(testfile).strpath, response_type))
+
+    assert result == K8s.process_data_recursive(create_response_data(datadir.join(testfile).strpath, response_type))
+    assert lib.yaml_safe_load(lib.yaml_dump(result)) == yaml.safe_load(yaml.dump(result))
+    assert "managedFields" not in result["metadata"] and "status" not in result
+
+def test_process_data_dicts():
+    data = {"metadata": {"name": "a", "uid": "1", "_private": 1, "labels": None},
+            "spec": [{"status": "x", "value": 1}, None, "text"],
+            "status": {}}
+
+    assert K8s.process_data(data) == {"metadata": {"name": "a"}, "spec": [{"value": 1}, None, "text"]}
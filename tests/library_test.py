@@ -0,0 +1,282 @@
+# pylint: skip-file
+import time
+import random
+import threading
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+from kubernetes.client.rest import ApiException
+import utilslib.library as lib
+
+
+def test_ordered_prefetch_order():
+    def fetch(item):
+        time.sleep(random.random() / 100)
+        return item * 2
+
+    results = list(lib.ordered_prefetch(fetch, range(50), workers=8))
+
+    assert results == [(i, i * 2) for i in range(50)]
+
+def test_ordered_prefetch_byte_budget():
+    lock = threading.Lock()
+    state = {'in_flight': 0, 'max_in_flight': 0}
+
+    def fetch(item):
+        with lock:
+            state['in_flight'] += item
+            state['max_in_flight'] = max(state['max_in_flight'], state['in_flight'])
+        time.sleep(0.001)
+        return item
+
+    items = [10] * 20 + [100] + [10] * 20
+    for item, _ in lib.ordered_prefetch(fetch, items, workers=8, max_bytes=30, size_of=lambda item: item):
+        with lock:
+            state['in_flight'] -= item
+
+    assert state['max_in_flight'] <= 100
+
+def test_dependency_tiers():
+    tiers = lib.dependency_tiers({'a': [], 'b': ['a'], 'c': ['a'], 'd': ['b', 'c'], 'e': []})
+
+    assert tiers == [['a', 'e'], ['b', 'c'], ['d']]
+
+def test_dependency_tiers_cycle():
+    with pytest.raises(Exception, match="cycle"):
+        lib.dependency_tiers({'a': ['b'], 'b': ['a']})
+
+    with pytest.raises(Exception, match="unknown"):
+        lib.dependency_tiers({'a': ['z']})
+
+def _api_exception(status, headers=None):
+    e = ApiException(status=status, reason="reason")
+    e.headers = headers
+    return e
+
+def test_classify_error():
+    throttled = ClientError({'Error': {'Code': 'SlowDown'}, 'ResponseMetadata': {'HTTPStatusCode': 503}}, 'PutObject')
+    missing = ClientError({'Error': {'Code': 'NoSuchKey'}, 'ResponseMetadata': {'HTTPStatusCode': 404}}, 'GetObject')
+
+    assert lib.classify_error(throttled) == (True, None)
+    assert lib.classify_error(missing) == (False, None)
+    assert lib.classify_error(EndpointConnectionError(endpoint_url="http://s3")) == (True, None)
+    assert lib.classify_error(_api_exception(429, {'Retry-After': '3'})) == (True, 3.0)
+    assert lib.classify_error(_api_exception(500)) == (True, None)
+    for status in (400, 404, 409, 422):
+        assert lib.classify_error(_api_exception(status)) == (False, None)
+    assert lib.classify_error(Exception("bad")) == (False, None)
+
+def test_retry_wrapper(mocker):
+    sleep = mocker.patch("time.sleep")
+    calls = []
+
+    @lib.retry_wrapper
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise _api_exception(429, {'Retry-After': '2'})
+        return "ok"
+
+    assert flaky() == "ok"
+    assert len(calls) == 3
+    sleep.assert_called_with(2.0)
+
+def test_retry_wrapper_not_retryable(mocker):
+    mocker.patch("time.sleep")
+    calls = []
+
+    @lib.retry_wrapper
+    def conflict():
+        calls.append(1)
+        raise _api_exception(409)
+
+    with pytest.raises(ApiException):
+        conflict()
+    assert len(calls) == 1
+
+def test_retry_wrapper_nested(mocker):
+    sleep = mocker.patch("time.sleep")
+    calls = []
+
+    @lib.retry_wrapper
+    def inner():
+        calls.append(1)
+        raise _api_exception(503)
+
+    @lib.retry_wrapper
+    def outer():
+        return inner()
+
+    with pytest.raises(ApiException):
+        outer()
+    assert len(calls) == 5
+    for call in sleep.call_args_list:
+        assert 0 <= call[0][0] <= 30
+
+def test_retry_wrapper_budget(mocker):
+    mocker.patch("time.sleep")
+    calls = []
+
+    @lib.retry_wrapper
+    def failing():
+        calls.append(1)
+        raise _api_exception(503)
+
+    lib.retry_budget.reset(2)
+    try:
+        with pytest.raises(ApiException):
+            failing()
+        with pytest.raises(ApiException):
+            failing()
+    finally:
+        lib.retry_budget.reset()
+    assert len(calls) == 4
+
+def test_retry_wrapper_object_budget(mocker):
+    mocker.patch("time.sleep")
+    calls = []
+
+    class Client(object):
+        def __init__(self, max_retries):
+            self.retry_budget = lib.RetryBudget(max_retries)
+
+        @lib.retry_wrapper
+        def failing(self):
+            calls.append(1)
+            raise _api_exception(503)
+
+    limited = Client(1)
+    # another object's budget and the module budget do not change this object's
+    Client(None)
+    lib.retry_budget.reset()
+    with pytest.raises(ApiException):
+        limited.failing()
+    assert len(calls) == 2
+    assert limited.retry_budget.used == 1
+
+def test_rate_limiter_waits(mocker):
+    sleep = mocker.patch("time.sleep")
+    limiter = lib.RateLimiter(10, burst=2)
+
+    waits = [limiter.acquire() for _ in range(4)]
+
+    assert waits[:2] == [0, 0]
+    assert waits[2] > 0 and waits[3] > waits[2]
+    assert sleep.call_count == 2
+
+def test_rate_limiter_adapts(mocker):
+    limiter = lib.RateLimiter(8, burst=8, min_qps=1)
+
+    limiter.throttled()
+    limiter.throttled()
+    assert limiter.rate == 2
+    limiter.throttled()
+    limiter.throttled()
+    assert limiter.rate == 1
+
+    for _ in range(30):
+        limiter.succeeded()
+    assert limiter.rate == 8
+    assert limiter.stats() == {"qps": 8, "burst": 8, "rate": 8, "throttled": 4}
+
+def test_rate_limit_wrapper(mocker):
+    mocker.patch("time.sleep")
+
+    class Client(object):
+        rate_limiter = lib.RateLimiter(100)
+        calls = 0
+
+        @lib.retry_wrapper
+        @lib.rate_limit_wrapper
+        def call(self):
+            self.calls += 1
+            if self.calls == 1:
+                raise _api_exception(429, {'Retry-After': '1'})
+            return self.calls
+
+    c = Client()
+    assert c.call() == 2
+    assert c.rate_limiter.throttled_count == 1
+    assert c.rate_limiter.rate == 55
+
+def test_timing_wrapper_metrics():
+    registry = lib.metrics
+    registry.reset()
+
+    @lib.timing_wrapper
+    def list_kind(namespace, kind, limit=100):
+        if kind == "Bad":
+            raise Exception("bad kind")
+        return []
+
+    list_kind("ns1", "ConfigMap")
+    list_kind("ns1", kind="Secret")
+    list_kind("ns2", "ConfigMap")
+    with pytest.raises(Exception):
+        list_kind("ns2", "Bad")
+
+    assert registry.histogram("operation_seconds", operation="list_kind")["count"] == 4
+    assert registry.histogram("operation_seconds", operation="list_kind", namespace="ns1")["count"] == 2
+    assert registry.histogram("operation_seconds", kind="ConfigMap")["count"] == 2
+    assert registry.counter("operation_errors_total", operation="list_kind") == 1
+    registry.reset()
+
+def test_metrics_prometheus(tmpdir):
+    registry = lib.MetricsRegistry()
+    registry.inc("s3_uploaded_bytes_total", 100)
+    registry.inc("s3_uploaded_bytes_total", 50)
+    registry.set("rate_limit_qps", 25.0)
+    registry.observe("operation_seconds", 0.02, operation="read_kind", namespace='a"b')
+
+    text = registry.to_prometheus()
+
+    assert "# TYPE k8sdr_s3_uploaded_bytes_total counter\nk8sdr_s3_uploaded_bytes_total 150\n" in text
+    assert "k8sdr_rate_limit_qps 25.0\n" in text
+    assert 'k8sdr_operation_seconds_bucket{namespace="a\\"b",operation="read_kind",le="0.01"} 0\n' in text
+    assert 'k8sdr_operation_seconds_bucket{namespace="a\\"b",operation="read_kind",le="0.025"} 1\n' in text
+    assert 'k8sdr_operation_seconds_count{namespace="a\\"b",operation="read_kind"} 1\n' in text
+
+    path = tmpdir.join("metrics.prom").strpath
+    registry.write_prometheus(path)
+    assert open(path).read() == text
+
+def test_metrics_serve():
+    import urllib.request
+    registry = lib.MetricsRegistry()
+    registry.inc("retries_total", operation="store_in_bucket")
+    server = registry.serve(port=0)
+    try:
+        url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+        body = urllib.request.urlopen(url).read().decode()
+    finally:
+        server.shutdown()
+
+    assert 'k8sdr_retries_total{operation="store_in_bucket"} 1' in body
+
+@pytest.mark.parametrize("method", ["gzip", "zstd"])
+def test_compress_round_trip(method):
+    if method == "zstd":
+        pytest.importorskip("zstandard")
+    data = b"apiVersion: v1\nkind: ConfigMap\n" + b"key: value\n" * 1000
+
+    compressed = lib.compress(data, method, level=1)
+
+    assert len(compressed) < len(data) / 10
+    assert lib.decompress(compressed, method) == data
+
+def test_compress_unsupported():
+    with pytest.raises(Exception, match="compression must be one of"):
+        lib.compress(b"data", "lzma")
+
+def test_run_report_compression():
+    lib.metrics.reset()
+    report = lib.RunReport("backup")
+    lib.metrics.inc("compression_input_bytes_total", 1000)
+    lib.metrics.inc("compression_output_bytes_total", 250)
+    lib.metrics.inc("compression_cpu_seconds_total", 0.5)
+
+    result = report.to_dict()
+
+    assert result["compression"]["ratio"] == 4
+    assert result["compression"]["saved_bytes"] == 750
+    assert result["compression"]["cpu_seconds"] == 0.5
+    assert "compression" not in lib.RunReport("restore").to_dict()
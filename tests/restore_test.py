@@ -1,7 +1,14 @@
 # pylint: skip-file
+import json
+import hashlib
+from datetime import datetime
+import pytest
 import io
+import sys
+import threading
 from utilslib.dr import Restore
-from utilslib.restore.strategy import NullStrategy
+from utilslib import bundle
+from utilslib.restore.strategy import NullStrategy, StreamingKubectlRestoreStrategy, SingleResourceApplyStrategy
 from botocore.stub import ANY
 from botocore.response import StreamingBody
 from .testutils import create_response_data, read_file
@@ -13,166 +20,41 @@ def test_restore_all_namespaces(s3_stub, mocker, datadir):
 
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': "{}/{}".format(cluster_set, cluster_name)},
-        service_response=STUB_LIST_RESPONSE_MULTINS
+        expected_params={'Bucket': bucket_name, 'Prefix': "{}/{}/".format(cluster_set, cluster_name), 'Delimiter': '/'},
+        service_response=STUB_PREFIXES_MULTINS
     )
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/Namespace'},
-        service_response=STUB_LIST_RESPONSE_KS_NS
+        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/app1/'},
+        service_response=STUB_LIST_RESPONSE_APP_NS
     )
 
-    body = read_file(datadir.join('namespace.json').strpath)
+    body = read_file(datadir.join('namespace_app1.json').strpath)
     response_stream = StreamingBody(
         io.BytesIO(body.encode()),
         len(body)
     )
     s3_stub.add_response(
         'get_object',
-        expected_params={'Bucket': bucket_name, 'Key': 'default/cluster1/kube-system/Namespace/v1/kube-system.yaml'},
+        expected_params={'Bucket': bucket_name, 'Key': 'default/cluster1/app1/Namespace/v1/app1.yaml'},
         service_response={'Body': response_stream}
     )
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/LimitRange'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/ResourceQuota'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/ConfigMap'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/Secret'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/Service'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/Role'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/ServiceAccount'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/RoleBinding'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/HorizontalPodAutoscaler'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/Deployment'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/Gateway'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/VirtualService'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/app1/Namespace'},
-        service_response=STUB_LIST_RESPONSE_APP_NS
+        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/'},
+        service_response=STUB_LIST_RESPONSE_KS_NS
     )
 
-    body = read_file(datadir.join('namespace_app1.json').strpath)
+    body = read_file(datadir.join('namespace.json').strpath)
     response_stream = StreamingBody(
         io.BytesIO(body.encode()),
         len(body)
     )
     s3_stub.add_response(
         'get_object',
-        expected_params={'Bucket': bucket_name, 'Key': 'default/cluster1/app1/Namespace/v1/app1.yaml'},
+        expected_params={'Bucket': bucket_name, 'Key': 'default/cluster1/kube-system/Namespace/v1/kube-system.yaml'},
         service_response={'Body': response_stream}
     )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/app1/LimitRange'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/app1/ResourceQuota'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/app1/ConfigMap'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/app1/Secret'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/app1/Service'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/app1/Role'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/app1/ServiceAccount'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/app1/RoleBinding'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/app1/HorizontalPodAutoscaler'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/app1/Deployment'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/app1/Gateway'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/app1/VirtualService'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-        # s3_stub.add_response(
-        #     'list_objects_v2',
-        #     expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/app1/Namespace'},
-        #     service_response=STUB_LIST_RESPONSE_EMPTY
-        # )
 
     s3_stub.activate()
 
@@ -190,12 +72,12 @@ def test_restore_single_namespaces(s3_stub, mocker, datadir):
 
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': "{}/{}".format(cluster_set, cluster_name)},
-        service_response=STUB_LIST_RESPONSE_MULTINS
+        expected_params={'Bucket': bucket_name, 'Prefix': "{}/{}/".format(cluster_set, cluster_name), 'Delimiter': '/'},
+        service_response=STUB_PREFIXES_MULTINS
     )
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/Namespace'},
+        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/'},
         service_response=STUB_LIST_RESPONSE_KS_NS
     )
 
@@ -209,66 +91,6 @@ def test_restore_single_namespaces(s3_stub, mocker, datadir):
         expected_params={'Bucket': bucket_name, 'Key': 'default/cluster1/kube-system/Namespace/v1/kube-system.yaml'},
         service_response={'Body': response_stream}
     )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/LimitRange'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/ResourceQuota'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/ConfigMap'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/Secret'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/Service'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/Role'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/ServiceAccount'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/RoleBinding'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/HorizontalPodAutoscaler'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/Deployment'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/Gateway'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/VirtualService'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
 
     s3_stub.activate()
 
@@ -291,12 +113,12 @@ def test_restore_single_namespaces_with_prefix(s3_stub, mocker, datadir):
 
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': "cluster2/application-backups/default/cluster2"},
-        service_response=STUB_LIST_RESPONSE_MULTINS_PREFIX
+        expected_params={'Bucket': bucket_name, 'Prefix': "cluster2/application-backups/default/cluster2/", 'Delimiter': '/'},
+        service_response=STUB_PREFIXES_MULTINS_PREFIX
     )
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'cluster2/application-backups/default/cluster2/kube-system/Namespace'},
+        expected_params={'Bucket': bucket_name, 'Prefix': 'cluster2/application-backups/default/cluster2/kube-system/'},
         service_response=STUB_LIST_RESPONSE_KS_NS_PREFIX
     )
 
@@ -310,114 +132,400 @@ def test_restore_single_namespaces_with_prefix(s3_stub, mocker, datadir):
         expected_params={'Bucket': bucket_name, 'Key': 'cluster2/application-backups/default/cluster2/kube-system/Namespace/v1/kube-system.yaml'},
         service_response={'Body': response_stream}
     )
+
+    s3_stub.activate()
+
+    strategy = NullStrategy(cluster_name)
+
+    restore = Restore(bucket_name,strategy, client=s3_stub.client, kube_config=datadir.join('kubeconfig').strpath, prefix=prefix)
+    num_processed = restore.restore_namespaces(cluster_set, cluster_name, namespace)
+
+    assert num_processed == 1
+
+def test_restore_namespace_kind_order(s3_stub, mocker, datadir):
+    bucket_name = 'test-bucket'
+    namespace = 'kube-system'
+    cluster_name = 'cluster1'
+    cluster_set = 'default'
+
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'cluster2/application-backups/default/cluster2/kube-system/LimitRange'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'cluster2/application-backups/default/cluster2/kube-system/ResourceQuota'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'cluster2/application-backups/default/cluster2/kube-system/ConfigMap'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
-    )
-    s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'cluster2/application-backups/default/cluster2/kube-system/Secret'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
+        expected_params={'Bucket': bucket_name, 'Prefix': "{}/{}/".format(cluster_set, cluster_name), 'Delimiter': '/'},
+        service_response=STUB_PREFIXES_MULTINS
     )
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'cluster2/application-backups/default/cluster2/kube-system/Service'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
+        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/kube-system/'},
+        service_response=STUB_LIST_RESPONSE_KS_KINDS
     )
+    for key in ['default/cluster1/kube-system/Namespace/v1/kube-system.yaml',
+                'default/cluster1/kube-system/ConfigMap/v1/coredns.yaml',
+                'default/cluster1/kube-system/Role/rbac.authorization.k8s.io_v1/reader.yaml',
+                'default/cluster1/kube-system/RoleBinding/rbac.authorization.k8s.io_v1/reader.yaml',
+                'default/cluster1/kube-system/Deployment/apps_v1/coredns.yaml']:
+        s3_stub.add_response(
+            'get_object',
+            expected_params={'Bucket': bucket_name, 'Key': key},
+            service_response={'Body': StreamingBody(io.BytesIO(key.encode()), len(key))}
+        )
+    s3_stub.activate()
+
+    strategy = RecordingStrategy(cluster_name)
+
+    report_file = datadir.join('report.json').strpath
+    restore = Restore(bucket_name, strategy, client=s3_stub.client, cluster_set=cluster_set, cluster_name=cluster_name, kube_config=datadir.join('kubeconfig').strpath, report_file=report_file)
+    num_processed = restore.restore_namespaces(cluster_set, cluster_name, namespace)
+
+    assert num_processed == 5
+    assert [kind for _, kind, _ in strategy.processed] == ['Namespace', 'ConfigMap', 'Role', 'RoleBinding', 'Deployment']
+    assert strategy.tiers == 4
+
+    with open(report_file) as f:
+        report = json.load(f)
+    assert report["operation"] == "restore"
+    assert report["totals"]["objects"] == 5
+    assert report["namespaces"]["kube-system"]["kinds"]["Role"] == {'objects': 1, 'bytes': len('default/cluster1/kube-system/Role/rbac.authorization.k8s.io_v1/reader.yaml')}
+    assert report["metrics"]["s3_requests_total"] == 7
+    assert set(report["phases"].keys()) == {'list', 'download', 'apply'}
+
+def test_restore_namespaces_parallel(mocker, datadir):
+    bucket_name = 'test-bucket'
+    cluster_name = 'cluster1'
+    cluster_set = 'default'
+
+    def _list_objects_v2(**kwargs):
+        if kwargs.get('Delimiter') == '/':
+            return STUB_PREFIXES_MULTINS
+        if kwargs['Prefix'] == 'default/cluster1/app1/':
+            return STUB_LIST_RESPONSE_APP_NS
+        return STUB_LIST_RESPONSE_KS_KINDS
+
+    def _get_object(**kwargs):
+        if kwargs['Key'] == 'default/cluster1/app1/Namespace/v1/app1.yaml':
+            raise Exception("failed to get app1")
+        return {'Body': io.BytesIO(kwargs['Key'].encode())}
+
+    s3_client = mocker.MagicMock()
+    s3_client.list_objects_v2.side_effect = _list_objects_v2
+    s3_client.get_object.side_effect = _get_object
+    mocker.patch("time.sleep")
+
+    strategy = RecordingStrategy(cluster_name)
+
+    restore = Restore(bucket_name, strategy, client=s3_client, cluster_set=cluster_set, cluster_name=cluster_name, kube_config=datadir.join('kubeconfig').strpath)
+    num_processed = restore.restore_namespaces(cluster_set, cluster_name, "*", workers=2)
+
+    assert num_processed == 5
+    assert list(restore.namespace_errors.keys()) == ['app1']
+    assert [kind for _, kind, _ in strategy.processed] == ['Namespace', 'ConfigMap', 'Role', 'RoleBinding', 'Deployment']
+    assert strategy.namespace is None
+
+def test_restore_namespaces_parallel_releases_kubectl(mocker, datadir, tmpdir):
+    bucket_name = 'test-bucket'
+    cluster_name = 'cluster1'
+    cluster_set = 'default'
+    namespaces = ['app{}'.format(i) for i in range(5)]
+
+    kubectl = tmpdir.join("kubectl")
+    kubectl.write("#!{}\nimport sys\nsys.stdin.read()\n".format(sys.executable))
+    kubectl.chmod(0o755)
+
+    def _list_objects_v2(**kwargs):
+        if kwargs.get('Delimiter') == '/':
+            return {'KeyCount': len(namespaces), 'CommonPrefixes': [{'Prefix': 'default/cluster1/{}/'.format(ns)} for ns in namespaces]}
+        namespace = kwargs['Prefix'].split('/')[2]
+        return {'KeyCount': 1, 'Contents': [{'Key': 'default/cluster1/{0}/Namespace/v1/{0}.yaml'.format(namespace)}]}
+
+    def _get_object(**kwargs):
+        if kwargs['Key'].split('/')[2] != 'app4':
+            raise Exception("failed to get {}".format(kwargs['Key']))
+        return {'Body': io.BytesIO(b"apiVersion: v1\nkind: Namespace\nmetadata:\n  name: app4\n")}
+
+    s3_client = mocker.MagicMock()
+    s3_client.list_objects_v2.side_effect = _list_objects_v2
+    s3_client.get_object.side_effect = _get_object
+    mocker.patch("time.sleep")
+
+    strategy = StreamingKubectlRestoreStrategy(cluster_name, kubectl.strpath, max_concurrent=2)
+    restore = Restore(bucket_name, strategy, client=s3_client, cluster_set=cluster_set, cluster_name=cluster_name, kube_config=datadir.join('kubeconfig').strpath)
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(restore.restore_namespaces(cluster_set, cluster_name, "*", workers=2)), daemon=True)
+    thread.start()
+    thread.join(60)
+
+    # four namespaces fail, more than max_concurrent, without holding on to kubectl process slots
+    assert not thread.is_alive()
+    assert result == [1]
+    assert sorted(restore.namespace_errors.keys()) == ['app0', 'app1', 'app2', 'app3']
+
+def test_restore_kind_tiers():
+    assert Restore.kind_tiers[0] == ['Namespace']
+    assert Restore.kind_tiers[1] == ['LimitRange', 'ResourceQuota']
+    assert 'ConfigMap' in Restore.kind_tiers[2] and 'Secret' in Restore.kind_tiers[2]
+    assert Restore.kind_order[-1] == 'VirtualService'
+
+    class ExtendedRestore(Restore):
+        pass
+
+    ExtendedRestore.add_kind('PodDisruptionBudget', ['Deployment'])
+    assert ExtendedRestore.kind_tiers[-2] == ['Gateway', 'PodDisruptionBudget']
+    assert 'PodDisruptionBudget' not in Restore.kind_order
+
+def test_get_s3_namespaces_with_template_prefix(s3_stub, mocker, datadir):
+    bucket_name = 'test-bucket'
+    prefix = '$cluster_name/application-backups'
+
+    patched = mocker.patch("kubernetes.client.apis.core_v1_api.CoreV1Api.read_namespaced_config_map", autospec=True)
+    patched.return_value = create_response_data(datadir.join('clusterdata.json').strpath, 'V1ConfigMap')
+
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'cluster2/application-backups/default/cluster2/kube-system/Role'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
+        expected_params={'Bucket': bucket_name, 'Prefix': "cluster2/application-backups/default/cluster2/", 'Delimiter': '/'},
+        service_response=STUB_PREFIXES_MULTINS_PREFIX
     )
+    s3_stub.activate()
+
+    restore = Restore(bucket_name, NullStrategy('cluster2'), client=s3_stub.client, kube_config=datadir.join('kubeconfig').strpath, prefix=prefix)
+    path = restore.get_s3_namespaces_path('default', 'cluster2')
+    namespaces = restore.get_s3_namespaces(path)
+
+    assert namespaces == ['app1', 'kube-system']
+
+
+def test_restore_namespace_from_bundle(mocker, datadir):
+    bucket_name = 'test-bucket'
+    cluster_name = 'cluster1'
+    cluster_set = 'default'
+    bundle_key = 'default/cluster1/kube-system/_bundle.yaml.gz'
+
+    writer = bundle.BundleWriter('kube-system')
+    data = b''
+    for key in ['default/cluster1/kube-system/Namespace/v1/kube-system.yaml',
+                'default/cluster1/kube-system/Deployment/apps_v1/coredns.yaml',
+                'default/cluster1/kube-system/ConfigMap/v1/coredns.yaml']:
+        _, _, _, kind, api_version, name = key.split('/')
+        data += writer.add(key, kind, api_version.replace('_', '/'), name[:-5], key.encode())
+    data += writer.finish()
+
+    def _get_object(**kwargs):
+        assert kwargs['Key'] == bundle_key
+        start, end = kwargs['Range'][len('bytes='):].split('-')
+        body = data[-int(end):] if start == '' else data[int(start):int(end) + 1]
+        return {'Body': io.BytesIO(body)}
+
+    s3_client = mocker.MagicMock()
+    s3_client.list_objects_v2.side_effect = lambda **kwargs: STUB_PREFIXES_MULTINS if kwargs.get('Delimiter') == '/' else \
+        {'KeyCount': 1, 'Contents': [{'Key': bundle_key, 'Size': len(data)}]}
+    s3_client.get_object.side_effect = _get_object
+
+    strategy = RecordingStrategy(cluster_name)
+    restore = Restore(bucket_name, strategy, client=s3_client, cluster_set=cluster_set, cluster_name=cluster_name, kube_config=datadir.join('kubeconfig').strpath)
+
+    assert restore.restore_namespaces(cluster_set, cluster_name, ['kube-system']) == 3
+    assert [kind for _, kind, _ in strategy.processed] == ['Namespace', 'ConfigMap', 'Deployment']
+    # footer, index, the Namespace and ConfigMap with the Deployment between them, the Deployment
+    assert s3_client.get_object.call_count == 4
+
+    strategy.processed = []
+    s3_client.get_object.reset_mock()
+    assert restore.restore_namespaces(cluster_set, cluster_name, ['kube-system'], kinds=['Deployment']) == 1
+    assert strategy.processed[0][2] == b'default/cluster1/kube-system/Deployment/apps_v1/coredns.yaml'
+    assert s3_client.get_object.call_count == 3
+
+    strategy.processed = []
+    s3_client.get_object.reset_mock()
+    restore.range_gap = 0
+    assert restore.restore_namespaces(cluster_set, cluster_name, ['kube-system'], names=['kube-system', 'ConfigMap/coredns']) == 2
+    assert [kind for _, kind, _ in strategy.processed] == ['Namespace', 'ConfigMap']
+    assert s3_client.get_object.call_count == 4
+
+    writer.entries[1]['sha256'] = '0' * 64
+    index = writer.finish()
+    data = data[:writer.offset] + index
+    restore.range_gap = 64 * 1024
+    assert restore.restore_namespaces(cluster_set, cluster_name, ['kube-system'], kinds=['Deployment']) == 0
+    assert "hash mismatch" in restore.namespace_errors['kube-system']
+
+def test_restore_namespace_from_content(mocker, datadir):
+    bucket_name = 'test-bucket'
+    cluster_name = 'cluster1'
+    cluster_set = 'default'
+    references_key = 'default/cluster1/kube-system/_references.json'
+
+    contents = {}
+    objects = {}
+    for key in ['default/cluster1/kube-system/Namespace/v1/kube-system.yaml',
+                'default/cluster1/kube-system/Deployment/apps_v1/coredns.yaml',
+                'default/cluster1/kube-system/ConfigMap/v1/coredns.yaml']:
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        contents['default/_objects/{}/{}.yaml'.format(digest[:2], digest)] = key.encode()
+        objects[key] = digest
+    contents[references_key] = json.dumps({'namespace': 'kube-system', 'objects': objects,
+                                           'content_path': 'default/_objects',
+                                           'sizes': {digest: 100 for digest in objects.values()}}).encode()
+
+    s3_client = mocker.MagicMock()
+    s3_client.list_objects_v2.side_effect = lambda **kwargs: STUB_PREFIXES_MULTINS if kwargs.get('Delimiter') == '/' else \
+        {'KeyCount': 1, 'Contents': [{'Key': references_key}]}
+    s3_client.get_object.side_effect = lambda **kwargs: {'Body': io.BytesIO(contents[kwargs['Key']])}
+
+    strategy = RecordingStrategy(cluster_name)
+    restore = Restore(bucket_name, strategy, client=s3_client, cluster_set=cluster_set, cluster_name=cluster_name, kube_config=datadir.join('kubeconfig').strpath)
+
+    assert restore.restore_namespaces(cluster_set, cluster_name, ['kube-system']) == 3
+    assert [kind for _, kind, _ in strategy.processed] == ['Namespace', 'ConfigMap', 'Deployment']
+    assert s3_client.get_object.call_count == 4
+    referenced = restore._get_referenced_objects_by_kind(references_key, 'default/cluster1', 'kube-system')
+    assert [obj['Size'] for obj in referenced['Deployment']] == [100]
+
+    digest = objects['default/cluster1/kube-system/Namespace/v1/kube-system.yaml']
+    contents['default/_objects/{}/{}.yaml'.format(digest[:2], digest)] = b'changed'
+    assert restore.restore_namespaces(cluster_set, cluster_name, ['kube-system']) == 0
+    assert "hash mismatch" in restore.namespace_errors['kube-system']
+
+def test_restore_namespaces_at_snapshot(s3_stub, datadir):
+    bucket_name = 'test-bucket'
+    cluster_name = 'cluster1'
+    cluster_set = 'default'
+    key = 'default/cluster1/kube-system/Namespace/v1/kube-system.yaml'
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    snapshot_key = 'default/cluster1/_snapshots/kube-system/8411672799999.json'
+    snapshot = json.dumps({'namespace': 'kube-system', 'objects': {key: digest}, 'content_path': 'default/_objects',
+                           'timestamp': '2020-05-01T10:00:00+00:00'}).encode()
+
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'cluster2/application-backups/default/cluster2/kube-system/ServiceAccount'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
+        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/_snapshots/', 'Delimiter': '/'},
+        service_response={'KeyCount': 1, 'CommonPrefixes': [{'Prefix': 'default/cluster1/_snapshots/kube-system/'}]}
     )
+    # the closest snapshot at or before 2020-05-01T10:00:00 is found with one request
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'cluster2/application-backups/default/cluster2/kube-system/RoleBinding'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
+        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/_snapshots/kube-system/',
+                         'StartAfter': 'default/cluster1/_snapshots/kube-system/8411672799998.json', 'MaxKeys': 1},
+        service_response={'KeyCount': 1, 'Contents': [{'Key': snapshot_key}]}
     )
     s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'cluster2/application-backups/default/cluster2/kube-system/HorizontalPodAutoscaler'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
+        'get_object',
+        expected_params={'Bucket': bucket_name, 'Key': snapshot_key},
+        service_response={'Body': StreamingBody(io.BytesIO(snapshot), len(snapshot))}
     )
     s3_stub.add_response(
-        'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'cluster2/application-backups/default/cluster2/kube-system/Deployment'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
+        'get_object',
+        expected_params={'Bucket': bucket_name, 'Key': 'default/_objects/{}/{}.yaml'.format(digest[:2], digest)},
+        service_response={'Body': StreamingBody(io.BytesIO(key.encode()), len(key))}
     )
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'cluster2/application-backups/default/cluster2/kube-system/Gateway'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
+        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/_snapshots/', 'Delimiter': '/'},
+        service_response={'KeyCount': 1, 'CommonPrefixes': [{'Prefix': 'default/cluster1/_snapshots/kube-system/'}]}
     )
     s3_stub.add_response(
         'list_objects_v2',
-        expected_params={'Bucket': bucket_name, 'Prefix': 'cluster2/application-backups/default/cluster2/kube-system/VirtualService'},
-        service_response=STUB_LIST_RESPONSE_EMPTY
+        expected_params={'Bucket': bucket_name, 'Prefix': 'default/cluster1/_snapshots/kube-system/',
+                         'StartAfter': ANY, 'MaxKeys': 1},
+        service_response={'KeyCount': 0}
     )
-
     s3_stub.activate()
 
-    strategy = NullStrategy(cluster_name)
+    strategy = RecordingStrategy(cluster_name)
+    restore = Restore(bucket_name, strategy, client=s3_stub.client, cluster_set=cluster_set, cluster_name=cluster_name, kube_config=datadir.join('kubeconfig').strpath)
 
-    restore = Restore(bucket_name,strategy, client=s3_stub.client, kube_config=datadir.join('kubeconfig').strpath, prefix=prefix)
-    num_processed = restore.restore_namespaces(cluster_set, cluster_name, namespace)
+    assert restore.restore_namespaces(cluster_set, cluster_name, "*", timestamp=datetime(2020, 5, 1, 10, 0, 0)) == 1
+    assert strategy.processed == [('kube-system', 'Namespace', key.encode())]
 
-    assert num_processed == 1
+    # namespaces created after the time are skipped
+    strategy.processed = []
+    assert restore.restore_namespaces(cluster_set, cluster_name, "*", timestamp=1000000000) == 0
+    assert strategy.processed == []
+    assert restore.namespace_errors == {}
 
+def test_restore_namespaces_parallel_pool_size(mocker, datadir):
+    strategy = SingleResourceApplyStrategy('cluster1', kubeconfig=datadir.join('kubeconfig').strpath, workers=8)
+    restore = Restore('test-bucket', strategy, cluster_set='default', cluster_name='cluster1',
+                      kube_config=datadir.join('kubeconfig').strpath, prefetch_workers=4)
+    mocker.patch.object(restore, 'get_s3_namespaces', return_value=['app1', 'app2', 'app3'])
 
-STUB_LIST_RESPONSE_MULTINS = {
-    "KeyCount": 2,
-    "Contents": [
-        {
-            "Key": "default/cluster1/kube-system/Namespace/v1/kube-system.yaml",
-            "LastModified": "2020-02-06T11:48:37.000Z",
-            "ETag": "2537abc",
-            "Size": 1234,
-            "StorageClass": "STANDARD"
-        },
-        {
-            "Key": "default/cluster1/app1/Namespace/v1/app1.yaml",
-            "LastModified": "2020-02-06T11:48:37.000Z",
-            "ETag": "126abc",
-            "Size": 4321,
-            "StorageClass": "STANDARD"
-        }
+    pools = []
+    def _restore_namespace(ns_path, namespace, instance, kinds=None, names=None, snapshot=None):
+        pools.append((restore.retrieve.client.meta.config.max_pool_connections,
+                      instance._client.configuration.connection_pool_maxsize))
+        return 1
+    mocker.patch.object(restore, '_restore_namespace', side_effect=_restore_namespace)
+
+    assert restore.restore_namespaces('default', 'cluster1', '*', workers=3) == 3
+    # three namespaces each with four prefetch workers and eight apply workers
+    assert pools == [(12, 24)] * 3
+
+def test_find_snapshot_templated_prefix(mocker):
+    restore = Restore.__new__(Restore)
+    restore.prefix = '$cluster_name/application-backups'
+    restore.k8s = mocker.MagicMock(cluster_info={'cluster.name': 'cluster1', 'cluster.set': 'default'})
+    restore.retrieve = mocker.MagicMock()
+    written = restore.get_s3_snapshot_key('default', 'cluster1', 'kube-system', 1588327200)
+    restore.retrieve.iter_bucket_keys.return_value = iter([written])
+
+    assert restore._find_snapshot('default', 'cluster1', 'kube-system', 1588327200) == written
+    prefix = restore.retrieve.iter_bucket_keys.call_args[0][0]
+    assert prefix == 'cluster1/application-backups/default/cluster1/_snapshots/kube-system/'
+    assert written.startswith(prefix)
+    assert restore.retrieve.iter_bucket_keys.call_args[1]['start_after'] < written
+
+def test_group_ranges():
+    restore = Restore.__new__(Restore)
+    restore.range_gap = 10
+    restore.range_size = 100
+    objects = [(0, {'Key': 'a', 'Bundle': 'b1', 'Offset': 0, 'Length': 40}),
+               (0, {'Key': 'b', 'Bundle': 'b1', 'Offset': 50, 'Length': 40}),
+               (1, {'Key': 'c', 'Bundle': 'b1', 'Offset': 90, 'Length': 40}),
+               (1, {'Key': 'd', 'Bundle': 'b1', 'Offset': 135, 'Length': 10}),
+               (1, {'Key': 'e', 'Bundle': 'b1', 'Offset': 100, 'Length': 10}),
+               (2, {'Key': 'f', 'Bundle': 'b2', 'Offset': 0, 'Length': 10}),
+               (2, {'Key': 'g'}),
+               (2, {'Key': 'h'})]
+
+    groups = restore._group_ranges(objects)
+
+    assert [[item['Key'] for _, item in group] for group in groups] == [['a', 'b'], ['c', 'd'], ['e'], ['f'], ['g'], ['h']]
+
+class RecordingStrategy(NullStrategy):
+    """Records the resources processed"""
+
+    shared_attributes = ("processed",)
+
+    def __init__(self, cluster_name, **kwargs):
+        super(RecordingStrategy, self).__init__(cluster_name, **kwargs)
+        self.processed = []
+        self.namespace = None
+        self.tiers = 0
+
+    def start_namespace(self, namespace):
+        self.namespace = namespace
+
+    def process_resource(self, resource_data):
+        self.processed.append((self.namespace, resource_data.decode().split('/')[3], resource_data))
+
+    def finish_tier(self):
+        self.tiers += 1
+
+    def finish_namespace(self):
+        pass
+
+STUB_PREFIXES_MULTINS = {
+    "KeyCount": 3,
+    "CommonPrefixes": [
+        {"Prefix": "default/cluster1/_manifests/"},
+        {"Prefix": "default/cluster1/app1/"},
+        {"Prefix": "default/cluster1/kube-system/"}
     ]
 }
 
-STUB_LIST_RESPONSE_MULTINS_PREFIX = {
+STUB_PREFIXES_MULTINS_PREFIX = {
     "KeyCount": 2,
-    "Contents": [
-        {
-            "Key": "cluster2/application-backups/default/cluster2/kube-system/Namespace/v1/kube-system.yaml",
-            "LastModified": "2020-02-06T11:48:37.000Z",
-            "ETag": "2537abc",
-            "Size": 1234,
-            "StorageClass": "STANDARD"
-        },
-        {
-            "Key": "cluster2/application-backups/default/cluster1/app1/Namespace/v1/app1.yaml",
-            "LastModified": "2020-02-06T11:48:37.000Z",
-            "ETag": "126abc",
-            "Size": 4321,
-            "StorageClass": "STANDARD"
-        }
+    "CommonPrefixes": [
+        {"Prefix": "cluster2/application-backups/default/cluster2/app1/"},
+        {"Prefix": "cluster2/application-backups/default/cluster2/kube-system/"}
     ]
 }
 
@@ -460,20 +568,19 @@ STUB_LIST_RESPONSE_APP_NS = {
     ]
 }
 
-STUB_LIST_RESPONSE_APP_NS_PREFIX = {
-    "KeyCount": 1,
-    "Contents": [
-        {
-            "Key": "cluster2/application-backups/default/cluster2/app1/Namespace/v1/app1.yaml",
-            "LastModified": "2020-02-06T11:48:37.000Z",
-            "ETag": "126abc",
-            "Size": 4321,
-            "StorageClass": "STANDARD"
-        }
-    ]
-}
-
 STUB_LIST_RESPONSE_EMPTY = {
     "KeyCount": 0,
     "Contents": []
-}
\ No newline at end of file
+}
+
+STUB_LIST_RESPONSE_KS_KINDS = {
+    "KeyCount": 6,
+    "Contents": [
+        {"Key": "default/cluster1/kube-system/ConfigMap/v1/coredns.yaml", "Size": 1234},
+        {"Key": "default/cluster1/kube-system/Deployment/apps_v1/coredns.yaml", "Size": 1234},
+        {"Key": "default/cluster1/kube-system/Endpoints/v1/kube-dns.yaml", "Size": 1234},
+        {"Key": "default/cluster1/kube-system/Namespace/v1/kube-system.yaml", "Size": 1234},
+        {"Key": "default/cluster1/kube-system/Role/rbac.authorization.k8s.io_v1/reader.yaml", "Size": 1234},
+        {"Key": "default/cluster1/kube-system/RoleBinding/rbac.authorization.k8s.io_v1/reader.yaml", "Size": 1234}
+    ]
+}
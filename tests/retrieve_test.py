@@ -1,8 +1,10 @@
 # pylint: skip-file
 import io
+import pytest
 from botocore.response import StreamingBody
 
 from utilslib.dr import Retrieve
+import utilslib.library as lib
 
 def test_get_bucket_keys_exists(s3_stub):
     prefix = 'default/cluster2/'
@@ -36,6 +38,45 @@ def test_get_bucket_keys_no_contents(s3_stub):
 
     assert len(result) == 0
 
+def test_get_bucket_keys_paginated(s3_stub):
+    prefix = 'default/cluster2/'
+    bucket_name = 'test-bucket'
+
+    s3_stub.add_response(
+        'list_objects_v2',
+        expected_params={'Bucket': bucket_name, 'Prefix': prefix},
+        service_response=dict(STUB_LIST_RESPONSE, IsTruncated=True, NextContinuationToken='page2')
+    )
+    s3_stub.add_response(
+        'list_objects_v2',
+        expected_params={'Bucket': bucket_name, 'Prefix': prefix, 'ContinuationToken': 'page2'},
+        service_response=STUB_LIST_RESPONSE_PAGE2
+    )
+    s3_stub.activate()
+
+    retrieve = Retrieve(client=s3_stub.client, bucket_name=bucket_name)
+    result = retrieve.get_bucket_keys(prefix)
+
+    assert len(result) == 4
+    assert result[3] == 'default/cluster2/namespace3/abc.yaml'
+
+def test_iter_bucket_keys_options(s3_stub):
+    prefix = 'default/cluster2/'
+    bucket_name = 'test-bucket'
+
+    s3_stub.add_response(
+        'list_objects_v2',
+        expected_params={'Bucket': bucket_name, 'Prefix': prefix, 'StartAfter': 'default/cluster2/namespace2/def.yaml', 'Delimiter': '/', 'MaxKeys': 1},
+        service_response=STUB_LIST_RESPONSE_PAGE2
+    )
+    s3_stub.activate()
+
+    retrieve = Retrieve(client=s3_stub.client, bucket_name=bucket_name)
+    keys = retrieve.iter_bucket_keys(prefix, start_after='default/cluster2/namespace2/def.yaml', delimiter='/', page_size=1)
+
+    assert next(keys) == 'default/cluster2/namespace3/abc.yaml'
+    assert list(keys) == []
+
 def test_get_bucket_item(s3_stub):
     key = 'default/cluster2/bank-app2/Deployment/apps-v1/podinfo.yaml'
     bucket_name = 'test-bucket'
@@ -58,6 +99,65 @@ def test_get_bucket_item(s3_stub):
 
     assert result == body
 
+def test_get_bucket_item_if_exists_missing(s3_stub):
+    key = 'default/cluster2/_manifests/bank-app2.json'
+    bucket_name = 'test-bucket'
+
+    s3_stub.add_client_error(
+        'get_object',
+        service_error_code='NoSuchKey',
+        http_status_code=404,
+        expected_params={'Bucket': bucket_name, 'Key': key}
+    )
+    s3_stub.activate()
+
+    retrieve = Retrieve(client=s3_stub.client, bucket_name=bucket_name)
+    result = retrieve.get_bucket_item_if_exists(key)
+
+    assert result is None
+
+def test_bucket_item_exists(s3_stub):
+    key = 'default/_objects/ab/ab12cd.yaml'
+    bucket_name = 'test-bucket'
+
+    s3_stub.add_response(
+        'head_object',
+        expected_params={'Bucket': bucket_name, 'Key': key},
+        service_response={'ContentLength': 10}
+    )
+    s3_stub.add_client_error(
+        'head_object',
+        service_error_code='404',
+        http_status_code=404,
+        expected_params={'Bucket': bucket_name, 'Key': key}
+    )
+    s3_stub.activate()
+
+    retrieve = Retrieve(client=s3_stub.client, bucket_name=bucket_name)
+    assert retrieve.bucket_item_exists(key)
+    assert not retrieve.bucket_item_exists(key)
+
+@pytest.mark.parametrize("method", ["gzip", "zstd"])
+def test_get_bucket_item_compressed(s3_stub, method):
+    if method == "zstd":
+        pytest.importorskip("zstandard")
+    key = 'default/cluster2/bank-app2/Deployment/apps-v1/podinfo.yaml'
+    bucket_name = 'test-bucket'
+    body = 'hello world'.encode()
+    compressed = lib.compress(body, method)
+
+    s3_stub.add_response(
+        'get_object',
+        expected_params={'Bucket': bucket_name, 'Key': key},
+        service_response={'Body': StreamingBody(io.BytesIO(compressed), len(compressed)), 'ContentEncoding': method}
+    )
+    s3_stub.activate()
+
+    retrieve = Retrieve(client=s3_stub.client, bucket_name=bucket_name)
+    result = retrieve.get_bucket_item(key)
+
+    assert result == body
+
 STUB_NO_CONTENTS = {
     "KeyCount": 0,
     "Contents": []
@@ -89,3 +189,16 @@ STUB_LIST_RESPONSE = {
         }
     ]
 }
+
+STUB_LIST_RESPONSE_PAGE2 = {
+    "KeyCount": 1,
+    "Contents": [
+        {
+            "Key": "default/cluster2/namespace3/abc.yaml",
+            "LastModified": "2020-02-06T11:48:37.000Z",
+            "ETag": "2537abc",
+            "Size": 1234,
+            "StorageClass": "STANDARD"
+        }
+    ]
+}
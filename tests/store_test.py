@@ -1,7 +1,9 @@
 # pylint: skip-file
+import gzip
 import pytest
+from botocore.stub import ANY
 
-from utilslib.dr import Store
+from utilslib.dr import Store, Retrieve, Clients
 
 
 def test_store_object(s3_stub):
@@ -51,3 +53,135 @@ def test_delete_object_from_unversioned_bucket(s3_stub):
 
     assert result['DeleteMarker'] == False
 
+def test_delete_keys_from_bucket_in_batches(s3_stub):
+    bucket_name = 'test-bucket'
+    keys = ['id/test/key/{}'.format(i) for i in range(1001)]
+
+    s3_stub.add_response(
+        'delete_objects',
+        expected_params={'Bucket': bucket_name, 'Delete': {'Objects': [{'Key': key} for key in keys[:1000]], 'Quiet': True}},
+        service_response={'Errors': [{'Key': 'id/test/key/5', 'Code': 'AccessDenied', 'Message': 'Access Denied'}]},
+    )
+    s3_stub.add_response(
+        'delete_objects',
+        expected_params={'Bucket': bucket_name, 'Delete': {'Objects': [{'Key': 'id/test/key/1000'}], 'Quiet': True}},
+        service_response={},
+    )
+    s3_stub.activate()
+
+    store = Store(client=s3_stub.client, bucket_name=bucket_name)
+    deleted, errors = store.delete_keys_from_bucket(keys)
+
+    assert len(deleted) == 1000
+    assert 'id/test/key/5' not in deleted
+    assert errors == {'id/test/key/5': 'AccessDenied: Access Denied'}
+
+def test_shared_s3_client():
+    Clients.clear()
+    store = Store(bucket_name='test-bucket')
+    retrieve = Retrieve(bucket_name='test-bucket')
+
+    assert store.client is retrieve.client
+    assert store.client.meta.config.max_pool_connections == 10
+
+    retrieve = Retrieve(bucket_name='test-bucket', prefetch_workers=16)
+
+    assert retrieve.client is not store.client
+    assert retrieve.client.meta.config.max_pool_connections == 16
+    assert Store(bucket_name='test-bucket', read_timeout=10).client is not retrieve.client
+
+def test_store_stream_multipart(s3_stub):
+    key = 'id/test/bundle'
+    bucket_name = 'test-bucket'
+
+    s3_stub.add_response(
+        'create_multipart_upload',
+        expected_params={'Bucket': bucket_name, 'Key': key, 'ContentType': 'application/gzip'},
+        service_response={'UploadId': 'upload1'},
+    )
+    for number, body in ((1, b'aaaabb'), (2, b'c')):
+        s3_stub.add_response(
+            'upload_part',
+            expected_params={'Bucket': bucket_name, 'Key': key, 'UploadId': 'upload1', 'PartNumber': number, 'Body': body},
+            service_response={'ETag': 'etag{}'.format(number)},
+        )
+    s3_stub.add_response(
+        'complete_multipart_upload',
+        expected_params={'Bucket': bucket_name, 'Key': key, 'UploadId': 'upload1',
+                         'MultipartUpload': {'Parts': [{'ETag': 'etag1', 'PartNumber': 1}, {'ETag': 'etag2', 'PartNumber': 2}]}},
+        service_response={},
+    )
+    s3_stub.activate()
+
+    store = Store(client=s3_stub.client, bucket_name=bucket_name)
+    size = store.store_stream_in_bucket(key, iter([b'aaaa', b'bb', b'c']), part_size=5, content_type='application/gzip')
+
+    assert size == 7
+
+def test_store_stream_small(s3_stub):
+    key = 'id/test/bundle'
+    bucket_name = 'test-bucket'
+
+    s3_stub.add_response(
+        'put_object',
+        expected_params={'Bucket': bucket_name, 'Key': key, 'Body': b'aaaabb'},
+        service_response={'ETag': '1234abc'},
+    )
+    s3_stub.activate()
+
+    store = Store(client=s3_stub.client, bucket_name=bucket_name)
+    store.store_stream_in_bucket(key, iter([b'aaaa', b'bb']))
+
+def test_store_stream_aborts_failed_upload(s3_stub):
+    key = 'id/test/bundle'
+    bucket_name = 'test-bucket'
+
+    s3_stub.add_response(
+        'create_multipart_upload',
+        expected_params={'Bucket': bucket_name, 'Key': key},
+        service_response={'UploadId': 'upload1'},
+    )
+    s3_stub.add_response(
+        'upload_part',
+        expected_params={'Bucket': bucket_name, 'Key': key, 'UploadId': 'upload1', 'PartNumber': 1, 'Body': b'aaaa'},
+        service_response={'ETag': 'etag1'},
+    )
+    s3_stub.add_response(
+        'abort_multipart_upload',
+        expected_params={'Bucket': bucket_name, 'Key': key, 'UploadId': 'upload1'},
+        service_response={},
+    )
+    s3_stub.activate()
+
+    def chunks():
+        yield b'aaaa'
+        raise Exception("failed to serialize")
+
+    store = Store(client=s3_stub.client, bucket_name=bucket_name)
+    with pytest.raises(Exception, match="failed to serialize"):
+        store.store_stream_in_bucket(key, chunks(), part_size=4)
+
+def test_store_object_compressed(s3_stub):
+    key = 'id/test/key/1234'
+    bucket_name = 'test-bucket'
+    data = 'hello world ' * 100
+    bodies = []
+
+    s3_stub.add_response(
+        'put_object',
+        expected_params={'Key': key, 'Bucket': bucket_name, 'Body': ANY, 'ContentEncoding': 'gzip',
+                         'Metadata': {'uncompressed-size': str(len(data))}},
+        service_response={'ETag': '1234abc'},
+    )
+    s3_stub.activate()
+    s3_stub.client.meta.events.register('before-parameter-build.s3.PutObject', lambda params, **kwargs: bodies.append(params['Body']))
+
+    store = Store(client=s3_stub.client, bucket_name=bucket_name, compression='gzip', compression_level=9)
+    store.store_in_bucket(key, data)
+
+    assert gzip.decompress(bodies[0]) == data.encode()
+    assert len(bodies[0]) < len(data) / 10
+
+def test_store_unsupported_compression(s3_stub):
+    with pytest.raises(Exception, match="compression must be one of"):
+        Store(client=s3_stub.client, bucket_name='test-bucket', compression='lzma')
@@ -0,0 +1,126 @@
+# pylint: skip-file
+import sys
+import pytest
+from kubernetes.client import V1APIResource, V1APIResourceList
+from utilslib.restore.strategy import StreamingKubectlRestoreStrategy, SingleResourceApplyStrategy
+
+FAKE_KUBECTL = """#!{python}
+import sys
+action = "serverside-applied" if "--server-side" in sys.argv else "created"
+for doc in sys.stdin.read().split("---\\n"):
+    for line in doc.splitlines():
+        if line.startswith("  name: "):
+            print("configmap/{{}} {{}}".format(line.split(": ")[1], action))
+        if line.startswith("  name: fail"):
+            print("error applying fail", file=sys.stderr)
+            sys.exit(1)
+"""
+
+@pytest.fixture
+def kubectl(tmpdir):
+    path = tmpdir.join("kubectl")
+    path.write(FAKE_KUBECTL.format(python=sys.executable))
+    path.chmod(0o755)
+    return path.strpath
+
+def test_streaming_kubectl(kubectl):
+    strategy = StreamingKubectlRestoreStrategy('cluster1', kubectl, server_side=True)
+
+    strategy.start_namespace('app1')
+    strategy.process_resource(b"kind: ConfigMap\nmetadata:\n  name: one\n  namespace: app1\n")
+    strategy.process_resource(b"kind: ConfigMap\nmetadata:\n  name: two\n  namespace: app1")
+    strategy.finish_namespace()
+
+    assert strategy.results == {'configmap/one': 'serverside-applied', 'configmap/two': 'serverside-applied'}
+
+def test_streaming_kubectl_failure(kubectl):
+    strategy = StreamingKubectlRestoreStrategy('cluster1', kubectl, max_concurrent=1)
+
+    strategy.start_namespace('app1')
+    strategy.process_resource(b"kind: ConfigMap\nmetadata:\n  name: fail\n  namespace: app1\n")
+    with pytest.raises(Exception, match="error applying fail"):
+        strategy.finish_namespace()
+
+    # the process slot is released after a failure
+    instance = strategy.new_instance()
+    instance.start_namespace('app2')
+    instance.finish_namespace()
+    assert instance.results == {}
+
+def test_new_instance_isolated(kubectl, mocker):
+    strategy = StreamingKubectlRestoreStrategy('cluster1', kubectl, max_concurrent=1)
+    instance = strategy.new_instance()
+
+    assert instance.results is not strategy.results
+    assert instance._stdout is not strategy._stdout
+    assert instance._slots is strategy._slots
+
+    api_client = mocker.MagicMock()
+    strategy = SingleResourceApplyStrategy('cluster1', api_client=api_client)
+    instance = strategy.new_instance()
+
+    assert instance._pending is not strategy._pending
+    assert instance._client is api_client
+    assert instance._api_resources is strategy._api_resources
+
+def test_single_resource_apply(mocker):
+    api_client = mocker.MagicMock()
+    api_client.call_api.side_effect = _call_api
+
+    strategy = SingleResourceApplyStrategy('cluster1', field_manager='restore', workers=4, api_client=api_client)
+    strategy.start_namespace('app1')
+    strategy.process_resource(b"apiVersion: v1\nkind: Namespace\nmetadata:\n  name: app1\n")
+    strategy.finish_tier()
+    strategy.process_resource(b"apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: one\n  namespace: app1\n")
+    strategy.process_resource(b"apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: two\n  namespace: app1\n")
+    strategy.process_resource(b"apiVersion: apps/v1\nkind: Deployment\nmetadata:\n  name: web\n  namespace: app1\n  creationTimestamp: 2020-01-02T03:04:05Z\n")
+    strategy.finish_namespace()
+
+    assert strategy.results == {'namespace/app1': 'serverside-applied',
+                                'configmap/one': 'serverside-applied',
+                                'configmap/two': 'serverside-applied',
+                                'deployment/web': 'serverside-applied'}
+
+    calls = api_client.call_api.call_args_list
+    discovery = sorted(call[0][0] for call in calls if call[0][1] == 'GET')
+    patches = sorted(call[0][0] for call in calls if call[0][1] == 'PATCH')
+    assert discovery == ['/api/v1', '/apis/apps/v1']
+    assert patches == ['/api/v1/namespaces/app1',
+                       '/api/v1/namespaces/app1/configmaps/one',
+                       '/api/v1/namespaces/app1/configmaps/two',
+                       '/apis/apps/v1/namespaces/app1/deployments/web']
+    patch = [call for call in calls if call[0][1] == 'PATCH'][0]
+    assert patch[1]['header_params']['Content-Type'] == 'application/apply-patch+yaml'
+    assert ('fieldManager', 'restore') in patch[1]['query_params']
+    assert '_preload_content' not in patch[1]
+    web = [call for call in calls if call[0][0].endswith('/deployments/web')][0]
+    assert web[1]['body'] == "apiVersion: apps/v1\nkind: Deployment\nmetadata:\n  name: web\n  namespace: app1\n  creationTimestamp: 2020-01-02T03:04:05Z\n"
+
+def test_single_resource_apply_same_name(mocker):
+    api_client = mocker.MagicMock()
+    def _call_api_failing(path, method, **kwargs):
+        if method == 'PATCH' and path.startswith('/api/v1/namespaces/app2/'):
+            raise Exception("conflict")
+        return _call_api(path, method, **kwargs)
+    api_client.call_api.side_effect = _call_api_failing
+
+    strategy = SingleResourceApplyStrategy('cluster1', workers=2, api_client=api_client)
+    strategy.start_namespace('app1')
+    strategy.process_resource(b"apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: one\n  namespace: app2\n")
+    strategy.process_resource(b"apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: one\n  namespace: app1\n")
+    with pytest.raises(Exception, match="failed to apply 1 resources"):
+        strategy.finish_tier()
+
+    assert strategy.results == {'configmap/one': 'failed'}
+    assert len([call for call in api_client.call_api.call_args_list if call[0][1] == 'PATCH']) == 2
+
+def _call_api(path, method, **kwargs):
+    if method == 'PATCH':
+        return None
+    if path == '/api/v1':
+        return V1APIResourceList(group_version='v1', resources=[
+            V1APIResource(kind='Namespace', name='namespaces', namespaced=False, singular_name='', verbs=[]),
+            V1APIResource(kind='Namespace', name='namespaces/status', namespaced=False, singular_name='', verbs=[]),
+            V1APIResource(kind='ConfigMap', name='configmaps', namespaced=True, singular_name='', verbs=[])])
+    return V1APIResourceList(group_version='apps/v1', resources=[
+        V1APIResource(kind='Deployment', name='deployments', namespaced=True, singular_name='', verbs=[])])
@@ -0,0 +1,151 @@
+"""
+This module reads and writes namespace bundles
+
+A bundle holds all the resources of a namespace in a single S3 object. Each
+resource is a separate gzip member holding one yaml document, so any
+resource can be read on its own with a ranged GET and decompressed. The
+members are followed by an index member and a fixed size footer member.
+
+The index member decompresses to yaml comment lines holding the index as
+json, and the footer member is empty apart from a gzip extra field holding
+the offset and length of the index member. As gzip members can be
+concatenated, decompressing the whole bundle with gunzip gives a valid
+multi-document yaml file.
+"""
+import gzip
+import hashlib
+import json
+import struct
+import zlib
+
+# Name of the bundle object within the namespace path
+BUNDLE_NAME = "_bundle.yaml.gz"
+
+INDEX_VERSION = 1
+INDEX_HEADER = b"# k8s-dr-utils bundle index\n"
+
+_DOCUMENT_START = b"---\n"
+
+# Footer: gzip header with FEXTRA, a 'KI' extra subfield holding the index
+# offset and length, an empty deflate block and the crc32 and size of no data
+_FOOTER_SUBFIELD = b"KI"
+_FOOTER_HEADER = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff" + struct.pack("<H", 20) + \
+    _FOOTER_SUBFIELD + struct.pack("<H", 16)
+_FOOTER_TRAILER = b"\x03\x00" + struct.pack("<II", 0, 0)
+FOOTER_SIZE = len(_FOOTER_HEADER) + 16 + len(_FOOTER_TRAILER)
+
+
+class BundleWriter(object):
+    """Builds a bundle one resource at a time
+
+    Arguments:
+        namespace {str} -- the namespace the bundle is for
+        compresslevel {int} -- the gzip compression level, defaults to 6
+    """
+
+    def __init__(self, namespace, compresslevel=6):
+        self.namespace = namespace
+        self.compresslevel = compresslevel
+        self.entries = []
+        self.offset = 0
+
+    def add(self, key, kind, api_version, name, data, digest=None):
+        """Add a resource to the bundle
+
+        Arguments:
+            key {str} -- the key of the resource in the per object layout
+            kind {str} -- the kind name of the resource
+            api_version {str} -- the api version of the resource
+            name {str} -- the name of the resource
+            data {bytes} -- the resource's yaml
+            digest {str} -- the sha256 hash of data, calculated if not given
+
+        Returns:
+            bytes -- the gzip member to append to the bundle
+        """
+        return self.add_member(key, kind, api_version, name, compress_document(data, self.compresslevel),
+                               digest if digest is not None else hashlib.sha256(data).hexdigest(), len(data))
+
+    def add_member(self, key, kind, api_version, name, member, digest, size):
+        """Add a resource already compressed with compress_document to the bundle
+
+        Returns:
+            bytes -- the gzip member to append to the bundle
+        """
+        self.entries.append({"key": key, "kind": kind, "apiVersion": api_version, "name": name,
+                             "offset": self.offset, "length": len(member), "size": size, "sha256": digest})
+        self.offset += len(member)
+        return member
+
+    def finish(self):
+        """Returns the index and footer members that end the bundle"""
+        index = {"version": INDEX_VERSION, "namespace": self.namespace, "objects": self.entries}
+        text = INDEX_HEADER + b"# " + json.dumps(index, separators=(",", ":"), sort_keys=True).encode() + b"\n"
+        member = gzip.compress(text, compresslevel=self.compresslevel, mtime=0)
+        return member + make_footer(self.offset, len(member))
+
+
+def compress_document(data, compresslevel=6):
+    """Compress a resource's yaml into a bundle member
+
+    Arguments:
+        data {bytes} -- the resource's yaml
+        compresslevel {int} -- the gzip compression level
+
+    Returns:
+        bytes -- the gzip member
+    """
+    return gzip.compress(_DOCUMENT_START + data, compresslevel=compresslevel, mtime=0)
+
+
+def read_document(member):
+    """Decompress a bundle member back to the resource's yaml
+
+    Arguments:
+        member {bytes} -- the gzip member
+
+    Returns:
+        bytes -- the resource's yaml
+    """
+    data = gzip.decompress(member)
+    if data.startswith(_DOCUMENT_START):
+        data = data[len(_DOCUMENT_START):]
+    return data
+
+
+def make_footer(index_offset, index_length):
+    """Returns the footer member recording the position of the index member"""
+    return _FOOTER_HEADER + struct.pack("<QQ", index_offset, index_length) + _FOOTER_TRAILER
+
+
+def read_footer(footer):
+    """Read the position of the index member from the footer
+
+    Arguments:
+        footer {bytes} -- the last FOOTER_SIZE bytes of the bundle
+
+    Returns:
+        int -- the offset of the index member
+        int -- the length of the index member
+    """
+    if len(footer) != FOOTER_SIZE or not footer.startswith(_FOOTER_HEADER) or not footer.endswith(_FOOTER_TRAILER):
+        raise Exception("not a bundle, footer is missing or invalid")
+    return struct.unpack("<QQ", footer[len(_FOOTER_HEADER):len(_FOOTER_HEADER) + 16])
+
+
+def read_index(member):
+    """Read the index member
+
+    Arguments:
+        member {bytes} -- the gzip index member
+
+    Returns:
+        dict -- the index, with the namespace and a list of objects
+    """
+    text = zlib.decompress(member, 16 + zlib.MAX_WBITS)
+    if not text.startswith(INDEX_HEADER):
+        raise Exception("not a bundle index")
+    index = json.loads(text[len(INDEX_HEADER):].lstrip(b"# "))
+    if index.get("version") != INDEX_VERSION:
+        raise Exception("unsupported bundle index version: {}".format(index.get("version")))
+    return index
@@ -1,14 +1,22 @@
 """
 This module contains DR classes
 """
+import os
+import time
+import datetime
+import hashlib
+import json
+import threading
 from string import Template
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import boto3
 import boto3.s3
 from botocore.config import Config
-import yaml
+from botocore.exceptions import ClientError
 from kubernetes import client, config
 from kubernetes.client.rest import ApiException
 import utilslib.library as lib
+from utilslib import bundle
 
 class Base(object):
     """Base class that provides a logger
@@ -37,8 +45,106 @@ class Base(object):
         lib.log.setLevel(log_level)
 
 
+class Clients(object):
+    """Registry of the S3 and Kubernetes clients shared by all objects in a process
+
+    Creating a client per object means a connection pool per object, each
+    needing its own TLS handshakes. The registry hands out one client per
+    configuration instead, with a connection pool of at least pool_size
+    connections. When a larger pool is asked for a new client is created
+    and used from then on. Clients are not shared with forked processes.
+    """
+    _lock = threading.Lock()
+    _pid = None
+    _s3 = {}
+    _k8s = {}
+
+    @classmethod
+    def _check_pid(cls):
+        if cls._pid != os.getpid():
+            cls._pid = os.getpid()
+            cls._s3 = {}
+            cls._k8s = {}
+
+    @classmethod
+    def s3(cls, connect_timeout=5, read_timeout=60, pool_size=10):
+        """Returns the shared boto3 S3 client for the timeouts
+
+        Arguments:
+            connect_timeout {int} -- the connect timeout in seconds
+            read_timeout {int} -- the read timeout in seconds
+            pool_size {int} -- the minimum number of connections in the pool
+
+        Returns:
+            S3.Client -- the client
+        """
+        key = (connect_timeout, read_timeout)
+        with cls._lock:
+            cls._check_pid()
+            if key not in cls._s3 or cls._s3[key][1] < pool_size:
+                s3_config = Config(connect_timeout=connect_timeout, read_timeout=read_timeout,
+                                   retries={'max_attempts': 0}, max_pool_connections=pool_size)
+                cls._s3[key] = (boto3.client('s3', config=s3_config), pool_size)
+            return cls._s3[key][0]
+
+    @classmethod
+    def k8s(cls, kube_config='', pool_size=10):
+        """Returns the shared Kubernetes ApiClient for the kube config file
+
+        Arguments:
+            kube_config {str} -- the kube config file, an empty string uses the in-cluster config
+            pool_size {int} -- the minimum number of connections in the pool
+
+        Returns:
+            ApiClient -- the client
+        """
+        with cls._lock:
+            cls._check_pid()
+            if kube_config not in cls._k8s or cls._k8s[kube_config][1] < pool_size:
+                if kube_config and len(kube_config) > 0:
+                    lib.log.info("using kube_config=%s", kube_config)
+                    configuration = client.Configuration()
+                    config.load_kube_config(config_file=kube_config, client_configuration=configuration)
+                else:
+                    lib.log.info("no kube_config, running in-cluster")
+                    # the in-cluster config is loaded into the default configuration, new
+                    # configurations are copied from it before kubernetes 12 but not after
+                    config.load_incluster_config()
+                    if hasattr(client.Configuration, "get_default_copy"):
+                        configuration = client.Configuration.get_default_copy()
+                    else:
+                        configuration = client.Configuration()
+                configuration.connection_pool_maxsize = pool_size
+                cls._k8s[kube_config] = (client.ApiClient(configuration), pool_size)
+            return cls._k8s[kube_config][0]
+
+    @classmethod
+    def clear(cls):
+        """Forget all clients, new ones are created when next asked for"""
+        with cls._lock:
+            cls._s3 = {}
+            cls._k8s = {}
+
+
+def _pool_size(kwargs, worker_args):
+    """Returns the connection pool size for the concurrency set in kwargs
+
+    The max_pool_connections keyword argument sets the size explicitly,
+    otherwise it is the largest of the worker counts named in worker_args
+    and 10.
+    """
+    if "max_pool_connections" in kwargs:
+        return kwargs["max_pool_connections"]
+    return max([10] + [kwargs[k] for k in worker_args if k in kwargs])
+
+
 class S3(Base):
     """Base class for S3
+
+    Unless a client is passed, the boto3 client is shared with the other
+    objects in the process using the same timeouts. Its connection pool has
+    max_pool_connections connections, defaulting to the larger of s3_workers,
+    prefetch_workers and 10, and can be grown with grow_pool.
     """
     @lib.retry_wrapper
     def __init__(self, *args, **kwargs):
@@ -55,17 +161,30 @@ class S3(Base):
         super(S3, self).__init__(*args, **kwargs)
         lib.log.debug("S3 init", extra=dict(**kwargs))
 
+        self._timeouts = None
         if 'client' in kwargs:
             self.client = kwargs.get("client")
         else:
             read_timout = kwargs["read_timeout"] if "read_timeout" in kwargs else 60
             connect_timout = kwargs["connect_timeout"] if "connect_timeout" in kwargs else 5
 
-            kube_config = Config(connect_timeout=connect_timout, read_timeout=read_timout, retries={'max_attempts': 0})
-            self.client = boto3.client('s3', config=kube_config)
+            self._timeouts = (connect_timout, read_timout)
+            self.client = Clients.s3(connect_timeout=connect_timout, read_timeout=read_timout,
+                                     pool_size=_pool_size(kwargs, ("s3_workers", "prefetch_workers")))
 
         self.bucket_name = kwargs.get("bucket_name", None)
 
+    def grow_pool(self, pool_size):
+        """Make sure the shared client's connection pool has at least pool_size connections
+
+        Does nothing if a client was passed in.
+
+        Arguments:
+            pool_size {int} -- the number of concurrent requests to allow for
+        """
+        if self._timeouts is not None:
+            self.client = Clients.s3(connect_timeout=self._timeouts[0], read_timeout=self._timeouts[1], pool_size=pool_size)
+
     @staticmethod
     def parse_key(key):
         """
@@ -87,6 +206,13 @@ class S3(Base):
 
 class Store(S3):
     """Class to store or remove items from S3
+
+    Set the compression keyword argument to gzip, or zstd if the zstandard
+    package is installed, to compress objects stored with store_in_bucket.
+    The method is recorded as the object's Content-Encoding and Retrieve
+    decompresses it. compression_level sets the level, the default is 6 for
+    gzip and 3 for zstd. The bytes before and after compression and the CPU
+    time spent compressing are recorded in the metrics.
     """
     @lib.retry_wrapper
     def __init__(self, *args, **kwargs):
@@ -103,6 +229,11 @@ class Store(S3):
         super(Store, self).__init__(*args, **kwargs)
         lib.log.debug("Store init", extra=dict(**kwargs))
 
+        self.compression = kwargs["compression"] if "compression" in kwargs else None
+        self.compression_level = kwargs["compression_level"] if "compression_level" in kwargs else None
+        if self.compression:
+            lib.check_compression(self.compression)
+
     @lib.timing_wrapper
     @lib.retry_wrapper
     def store_in_bucket(self, key, data):
@@ -112,7 +243,91 @@ class Store(S3):
         :param key: The key.
         :param data: The dictionary to store
         """
-        return self.client.put_object(Bucket=self.bucket_name, Key=key, Body=data.encode())
+        body = data.encode()
+        extra = {}
+        if self.compression:
+            started = time.thread_time()
+            compressed = lib.compress(body, self.compression, self.compression_level)
+            lib.metrics.inc("compression_cpu_seconds_total", time.thread_time() - started)
+            lib.metrics.inc("compression_input_bytes_total", len(body))
+            lib.metrics.inc("compression_output_bytes_total", len(compressed))
+            extra = {'ContentEncoding': self.compression, 'Metadata': {'uncompressed-size': str(len(body))}}
+            body = compressed
+        lib.metrics.inc("s3_uploaded_bytes_total", len(body))
+        lib.metrics.inc("s3_requests_total", operation="put_object")
+        return self.client.put_object(Bucket=self.bucket_name, Key=key, Body=body, **extra)
+
+    @lib.timing_wrapper
+    def store_stream_in_bucket(self, key, chunks, part_size=8 * 1024 * 1024, content_type=None):
+        """
+        store bytes from an iterable of chunks in an S3 bucket with the provided key.
+
+        The chunks are uploaded as they are produced using a multipart upload
+        once there is more than part_size bytes of data, smaller data is
+        stored with a single put. A failed multipart upload is aborted.
+
+        :param key: The key.
+        :param chunks: an iterable of bytes to store
+        :param part_size: the size of each part of a multipart upload, at least 5MiB
+        :param content_type: the content type of the object
+        :return: the number of bytes stored
+        """
+        extra = {'ContentType': content_type} if content_type else {}
+        buffer = bytearray()
+        upload_id = None
+        parts = []
+        size = 0
+        try:
+            for chunk in chunks:
+                buffer += chunk
+                size += len(chunk)
+                if len(buffer) >= part_size:
+                    if upload_id is None:
+                        upload_id = self._create_multipart_upload(key, extra)
+                    parts.append(self._upload_part(key, upload_id, len(parts) + 1, bytes(buffer)))
+                    buffer = bytearray()
+            if upload_id is None:
+                self._put_bytes(key, bytes(buffer), extra)
+                return size
+            if len(buffer) > 0:
+                parts.append(self._upload_part(key, upload_id, len(parts) + 1, bytes(buffer)))
+            self._complete_multipart_upload(key, upload_id, parts)
+            return size
+        except Exception:
+            if upload_id is not None:
+                lib.log.error("aborting multipart upload of key %s", key)
+                self._abort_multipart_upload(key, upload_id)
+            raise
+
+    @lib.retry_wrapper
+    def _put_bytes(self, key, body, extra):
+        lib.metrics.inc("s3_uploaded_bytes_total", len(body))
+        lib.metrics.inc("s3_requests_total", operation="put_object")
+        return self.client.put_object(Bucket=self.bucket_name, Key=key, Body=body, **extra)
+
+    @lib.retry_wrapper
+    def _create_multipart_upload(self, key, extra):
+        lib.metrics.inc("s3_requests_total", operation="create_multipart_upload")
+        return self.client.create_multipart_upload(Bucket=self.bucket_name, Key=key, **extra)['UploadId']
+
+    @lib.retry_wrapper
+    def _upload_part(self, key, upload_id, part_number, body):
+        lib.metrics.inc("s3_uploaded_bytes_total", len(body))
+        lib.metrics.inc("s3_requests_total", operation="upload_part")
+        response = self.client.upload_part(Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                                           PartNumber=part_number, Body=body)
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+    @lib.retry_wrapper
+    def _complete_multipart_upload(self, key, upload_id, parts):
+        lib.metrics.inc("s3_requests_total", operation="complete_multipart_upload")
+        return self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                                                      MultipartUpload={'Parts': parts})
+
+    @lib.retry_wrapper
+    def _abort_multipart_upload(self, key, upload_id):
+        lib.metrics.inc("s3_requests_total", operation="abort_multipart_upload")
+        return self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
 
     @lib.timing_wrapper
     @lib.retry_wrapper
@@ -122,12 +337,44 @@ class Store(S3):
 
         :param key: the s3 key of the object to delete
         """
+        lib.metrics.inc("s3_requests_total", operation="delete_object")
         return self.client.delete_object(Bucket=self.bucket_name, Key=key)
 
+    @lib.timing_wrapper
+    def delete_keys_from_bucket(self, keys, batch_size=1000):
+        """
+        delete objects in s3 using multi-object deletes of up to batch_size keys.
+
+        :param keys: the s3 keys of the objects to delete
+        :param batch_size: the number of keys per request, s3 allows at most 1000
+        :return: the keys deleted and a dictionary of the error message for each key that failed
+        """
+        deleted = []
+        errors = {}
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            response = self._delete_batch(batch)
+            failed = {}
+            for error in response.get('Errors', []):
+                failed[error['Key']] = "{}: {}".format(error.get('Code'), error.get('Message'))
+                lib.log.error("failed to delete key %s from s3, %s", error['Key'], failed[error['Key']])
+            errors.update(failed)
+            deleted += [key for key in batch if key not in failed]
+        return deleted, errors
+
+    @lib.retry_wrapper
+    def _delete_batch(self, keys):
+        lib.metrics.inc("s3_requests_total", operation="delete_objects")
+        return self.client.delete_objects(Bucket=self.bucket_name,
+                                          Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+
 
 
 class Retrieve(S3):
     """Retrieve keys and items from S3
+
+    Items stored compressed by Store are decompressed by get_bucket_item and
+    get_bucket_item_if_exists, using their Content-Encoding.
     """
     @lib.retry_wrapper
     def __init__(self, *args, **kwargs):
@@ -144,19 +391,77 @@ class Retrieve(S3):
         super(Retrieve, self).__init__(*args, **kwargs)
         lib.log.debug("Retrieve init", extra=dict(**kwargs))
 
-    @lib.timing_wrapper
-    @lib.retry_wrapper
     def get_bucket_keys(self, prefix):
         """
-        retrieve items in an S3 bucket with the provided prefix.
+        retrieve all the keys in an S3 bucket with the provided prefix.
 
         :param prefix: The key prefix .
         """
-        response = self.client.list_objects_v2(Bucket=self.bucket_name, Prefix=prefix)
-        #lib.log.debug("response: {}".format(response))
-        if response['KeyCount'] == 0:
-            return []
-        return list(map(lambda i: i['Key'], response['Contents']))
+        return list(self.iter_bucket_keys(prefix))
+
+    def iter_bucket_keys(self, prefix, start_after=None, delimiter=None, page_size=None):
+        """
+        generator yielding the keys in an S3 bucket with the provided prefix, one page at a time.
+
+        :param prefix: The key prefix.
+        :param start_after: only return keys after this key.
+        :param delimiter: do not return keys containing the delimiter after the prefix.
+        :param page_size: the maximum number of keys to request per page, defaults to the s3 maximum of 1000.
+        """
+        for item in self.iter_bucket_objects(prefix, start_after, delimiter, page_size):
+            yield item['Key']
+
+    def iter_bucket_objects(self, prefix, start_after=None, delimiter=None, page_size=None):
+        """
+        generator yielding the object summaries in an S3 bucket with the provided prefix,
+        following continuation tokens until all pages have been read.
+
+        :param prefix: The key prefix.
+        :param start_after: only return objects after this key.
+        :param delimiter: do not return objects containing the delimiter after the prefix.
+        :param page_size: the maximum number of objects to request per page, defaults to the s3 maximum of 1000.
+        """
+        for response in self._iter_pages(prefix, start_after, delimiter, page_size):
+            for item in response.get('Contents', []):
+                yield item
+
+    def iter_common_prefixes(self, prefix, delimiter='/', page_size=None):
+        """
+        generator yielding the distinct prefixes up to the next delimiter after the provided prefix,
+        e.g. the namespace paths below a cluster path. This lists one entry per prefix rather than
+        one per object.
+
+        :param prefix: The key prefix, normally ending with the delimiter.
+        :param delimiter: The delimiter that separates path segments.
+        :param page_size: the maximum number of prefixes to request per page, defaults to the s3 maximum of 1000.
+        """
+        for response in self._iter_pages(prefix, None, delimiter, page_size):
+            for item in response.get('CommonPrefixes', []):
+                yield item['Prefix']
+
+    def _iter_pages(self, prefix, start_after, delimiter, page_size):
+        continuation_token = None
+        while True:
+            response = self._list_objects_page(prefix, continuation_token, start_after, delimiter, page_size)
+            yield response
+            if not response.get('IsTruncated', False):
+                return
+            continuation_token = response['NextContinuationToken']
+
+    @lib.timing_wrapper
+    @lib.retry_wrapper
+    def _list_objects_page(self, prefix, continuation_token=None, start_after=None, delimiter=None, page_size=None):
+        params = {'Bucket': self.bucket_name, 'Prefix': prefix}
+        if continuation_token:
+            params['ContinuationToken'] = continuation_token
+        elif start_after:
+            params['StartAfter'] = start_after
+        if delimiter:
+            params['Delimiter'] = delimiter
+        if page_size:
+            params['MaxKeys'] = page_size
+        lib.metrics.inc("s3_requests_total", operation="list_objects_v2")
+        return self.client.list_objects_v2(**params)
 
     @lib.timing_wrapper
     @lib.retry_wrapper
@@ -166,11 +471,108 @@ class Retrieve(S3):
 
         :param key: they key of the item to get
         """
+        lib.metrics.inc("s3_requests_total", operation="get_object")
         response = self.client.get_object(Bucket=self.bucket_name, Key=key)
-        return response['Body'].read()
+        return self._read_body(response)
+
+    @lib.timing_wrapper
+    @lib.retry_wrapper
+    def get_bucket_item_range(self, key, start, end):
+        """
+        retrieve a byte range of an item from s3 for a particular key
+
+        :param key: they key of the item to get
+        :param start: the offset of the first byte
+        :param end: the offset of the last byte, inclusive
+        """
+        lib.metrics.inc("s3_requests_total", operation="get_object")
+        response = self.client.get_object(Bucket=self.bucket_name, Key=key, Range="bytes={}-{}".format(start, end))
+        body = response['Body'].read()
+        lib.metrics.inc("s3_downloaded_bytes_total", len(body))
+        return body
+
+    @lib.timing_wrapper
+    @lib.retry_wrapper
+    def get_bucket_item_tail(self, key, length):
+        """
+        retrieve the last bytes of an item from s3 for a particular key
+
+        :param key: they key of the item to get
+        :param length: the number of bytes to get
+        """
+        lib.metrics.inc("s3_requests_total", operation="get_object")
+        response = self.client.get_object(Bucket=self.bucket_name, Key=key, Range="bytes=-{}".format(length))
+        body = response['Body'].read()
+        lib.metrics.inc("s3_downloaded_bytes_total", len(body))
+        return body
+
+    @lib.timing_wrapper
+    @lib.retry_wrapper
+    def get_bucket_item_if_exists(self, key):
+        """
+        retrieve an item from s3 for a particular key, returning None if there is no such key
+
+        :param key: they key of the item to get
+        """
+        try:
+            lib.metrics.inc("s3_requests_total", operation="get_object")
+            response = self.client.get_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return self._read_body(response)
+
+    @lib.timing_wrapper
+    @lib.retry_wrapper
+    def bucket_item_exists(self, key):
+        """
+        check whether there is an item in s3 for a particular key, without downloading it
+
+        :param key: they key of the item to check
+        """
+        try:
+            lib.metrics.inc("s3_requests_total", operation="head_object")
+            self.client.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return False
+            raise
+        return True
+
+    @staticmethod
+    def _read_body(response):
+        body = response['Body'].read()
+        lib.metrics.inc("s3_downloaded_bytes_total", len(body))
+        encoding = response.get('ContentEncoding')
+        if encoding in lib.COMPRESSION_LEVELS:
+            started = time.thread_time()
+            body = lib.decompress(body, encoding)
+            lib.metrics.inc("decompression_cpu_seconds_total", time.thread_time() - started)
+        return body
+
+# Name of the manifest referencing the content of each resource in a namespace
+# saved with the content layout, within the namespace path
+REFERENCES_NAME = "_references.json"
+
+# Snapshot manifest names count down from this, in milliseconds since the epoch,
+# so that listing a namespace's snapshots returns the most recent first
+SNAPSHOT_EPOCH_MS_MAX = 10 ** 13 - 1
+
+# Types process_data copies as they are
+_LEAF_TYPES = frozenset([str, int, float, bool, bytes, type(None), datetime.datetime, datetime.date])
+
 
 class K8s(Base):
     """A class to perform actions against Kubernetes
+
+    API calls are limited to k8s_qps calls per second with bursts of up to
+    k8s_burst calls, defaulting to 50 and 100, and slow down while the API
+    server rejects calls as overloaded. Set k8s_qps to 0 to disable this, or
+    pass a lib.RateLimiter as rate_limiter to share one between objects.
+
+    All API objects use one ApiClient, shared with other objects in the
+    process using the same kube_config, or the api_client keyword argument.
     """
     v1 = None
     v1App = None
@@ -181,18 +583,36 @@ class K8s(Base):
     
     cluster_name = None
     kube_config = None
-
-    supported_kinds = {'ConfigMap': ('v1', 'config_map'),
-                       'LimitRange': ('v1', 'limit_range'),
-                       'ResourceQuota': ('v1', 'resource_quota'),
-                       'Secret': ('v1', 'secret'),
-                       'Service': ('v1', 'service'),
-                       'ServiceAccount': ('v1', 'service_account'),
-                       'PodTemplate': ('v1', 'pod_template'),
-                       'Deployment': ('v1App', 'deployment'),
-                       'Role': ('rbac', 'role'),
-                       'RoleBinding': ('rbac', 'role_binding'),
-                       'HorizontalPodAutoscaler': ('auto_scaler', 'horizontal_pod_autoscaler')}
+    rate_limiter = None
+
+    # Fields that are removed from resources at every level before they are backed up
+    removed_fields = ('clusterName',
+                      'creationTimestamp',
+                      'deletionTimestamp',
+                      'finalizers',
+                      'stringData',
+                      'generation',
+                      'initializers',
+                      'managedFields',
+                      'ownerReferences',
+                      'resourceVersion',
+                      'uid',
+                      'selfLink',
+                      'status')
+    _removed_set = frozenset(removed_fields)
+    _field_plans = {}
+
+    supported_kinds = {'ConfigMap': ('v1', 'config_map', 'v1'),
+                       'LimitRange': ('v1', 'limit_range', 'v1'),
+                       'ResourceQuota': ('v1', 'resource_quota', 'v1'),
+                       'Secret': ('v1', 'secret', 'v1'),
+                       'Service': ('v1', 'service', 'v1'),
+                       'ServiceAccount': ('v1', 'service_account', 'v1'),
+                       'PodTemplate': ('v1', 'pod_template', 'v1'),
+                       'Deployment': ('v1App', 'deployment', 'apps/v1'),
+                       'Role': ('rbac', 'role', 'rbac.authorization.k8s.io/v1'),
+                       'RoleBinding': ('rbac', 'role_binding', 'rbac.authorization.k8s.io/v1'),
+                       'HorizontalPodAutoscaler': ('auto_scaler', 'horizontal_pod_autoscaler', 'autoscaling/v1')}
     
     supported_custom_kinds = {'VirtualService': ('networking.istio.io', 'v1alpha3', 'virtualservices'),
                               'Gateway': ('networking.istio.io', 'v1alpha3', 'gateways')}
@@ -213,21 +633,26 @@ class K8s(Base):
 
         lib.log.debug("K8s init", extra=dict(**kwargs))
 
-        kube_config = kwargs["kube_config"] if "kube_config" in kwargs else ""
-        if kube_config and len(kube_config) > 0:
-            lib.log.info("using kube_config=%s", kube_config)
-            config.load_kube_config(config_file=kube_config)
+        if "api_client" in kwargs:
+            api_client = kwargs["api_client"]
         else:
-            lib.log.info("no kube_config, running in-cluster")
-            config.load_incluster_config()
-
-        self.v1 = client.CoreV1Api()
-        self.v1App = client.AppsV1Api()
-        self.v1ext = client.ExtensionsV1beta1Api()
-        self.v1beta1 = client.ApiextensionsV1beta1Api()
-        self.custom = client.CustomObjectsApi()
-        self.auto_scaler = client.AutoscalingV1Api()
-        self.rbac = client.RbacAuthorizationV1Api()
+            kube_config = kwargs["kube_config"] if "kube_config" in kwargs else ""
+            api_client = Clients.k8s(kube_config, pool_size=_pool_size(kwargs, ("k8s_workers",)))
+
+        self.v1 = client.CoreV1Api(api_client)
+        self.v1App = client.AppsV1Api(api_client)
+        self.v1ext = client.ExtensionsV1beta1Api(api_client)
+        self.v1beta1 = client.ApiextensionsV1beta1Api(api_client)
+        self.custom = client.CustomObjectsApi(api_client)
+        self.auto_scaler = client.AutoscalingV1Api(api_client)
+        self.rbac = client.RbacAuthorizationV1Api(api_client)
+
+        if "rate_limiter" in kwargs:
+            self.rate_limiter = kwargs["rate_limiter"]
+        else:
+            qps = kwargs["k8s_qps"] if "k8s_qps" in kwargs else 50
+            burst = kwargs["k8s_burst"] if "k8s_burst" in kwargs else 100
+            self.rate_limiter = lib.RateLimiter(qps, burst) if qps else None
 
         if 'cluster_name' in kwargs:
             lib.log.info("using explicit cluster_set= %s, cluster_name=%s",  kwargs.get('cluster_set'), kwargs.get('cluster_name'))
@@ -247,19 +672,7 @@ class K8s(Base):
 
     @staticmethod
     def process_dict(d):
-        [d.pop(x, None) for x in ['clusterName',
-                                  'creationTimestamp', 
-                                  'deletionTimestamp',
-                                  'finalizers',
-                                  'stringData',
-                                  'generation',
-                                  'initializers',
-                                  'managedFields', 
-                                  'ownerReferences',
-                                  'resourceVersion',
-                                  'uid',
-                                  'selfLink',
-                                  'status']]
+        [d.pop(x, None) for x in K8s.removed_fields]
         d = K8s.strip_nulls(d)
         d = K8s.strip_underscores(d)
         return d
@@ -285,18 +698,115 @@ class K8s(Base):
         return K8s.process_dict(d)
 
     @staticmethod
-    def process_data(data):
+    def process_data_recursive(data):
+        """Convert a resource by applying object_to_dict at every level
+
+        This is the recursive implementation that process_data replaced, it is
+        kept as the reference process_data is tested and benchmarked against.
+        """
         d = K8s.object_to_dict(data)
         if isinstance(d, dict):
             for k, v in d.items():
-                d[k] = K8s.process_data(v)
+                d[k] = K8s.process_data_recursive(v)
         if isinstance(d, list):
-            l = []
-            for i in d:
-                l.append(K8s.process_data(i))
-            d = l
+            d = [K8s.process_data_recursive(i) for i in d]
         return d
 
+    @staticmethod
+    def process_data(data):
+        """Convert a resource to plain dicts and lists without the fields that are not backed up
+
+        This gives the same result as applying object_to_dict at every level
+        of the resource. The resource is walked using a stack rather than
+        recursion, and the fields to copy from each model class are worked
+        out once and kept in _field_plans.
+
+        Arguments:
+            data {object} -- the kubernetes model object, dict, list or value to convert
+
+        Returns:
+            object -- the converted data
+        """
+        removed = K8s._removed_set
+        plans = K8s._field_plans
+        root = {}
+        stack = [(data, root, 0)]
+        while stack:
+            value, parent, key = stack.pop()
+            value_type = value.__class__
+            if value_type in _LEAF_TYPES:
+                parent[key] = value
+                continue
+
+            plan = plans.get(value_type)
+            if plan is None and hasattr(value, "attribute_map"):
+                plan = K8s._field_plan(value_type, value.attribute_map)
+            if plan is not None:
+                d = {}
+                for attr, name in plan:
+                    v = getattr(value, attr)
+                    if v is not None:
+                        d[name] = None
+                        stack.append((v, d, name))
+            elif isinstance(value, dict):
+                if "attribute_map" in value:
+                    value = K8s.object_to_dict(value)
+                d = {}
+                for k, v in value.items():
+                    if v is not None and k not in removed and not k.startswith("_"):
+                        d[k] = None
+                        stack.append((v, d, k))
+            elif isinstance(value, list):
+                d = [None] * len(value)
+                for i, v in enumerate(value):
+                    stack.append((v, d, i))
+            else:
+                d = value
+            parent[key] = d
+        return root[0]
+
+    @classmethod
+    def _field_plan(cls, model, attribute_map):
+        """Work out the attribute and field name of each field of a model class to convert"""
+        fields = {}
+        for attr, name in attribute_map.items():
+            fields[name] = attr
+        plan = tuple((attr, name) for name, attr in fields.items()
+                     if name not in cls._removed_set and not name.startswith("_"))
+        cls._field_plans[model] = plan
+        return plan
+
+    @staticmethod
+    def set_type_meta(data, kind, api_version):
+        """Set the kind and apiVersion of an object taken from a list response
+
+        Items in a list response do not carry their own kind and apiVersion,
+        these are only set on the list itself.
+
+        Arguments:
+            data {object} -- the kubernetes model object or dict to update
+            kind {str} -- the kind name of the resource
+            api_version {str} -- the api version of the resource
+
+        Returns:
+            object -- the updated object
+        """
+        if isinstance(data, dict):
+            data.setdefault("kind", kind)
+            data.setdefault("apiVersion", api_version)
+            return data
+        if not getattr(data, "kind", None):
+            data.kind = kind
+        if not getattr(data, "api_version", None):
+            data.api_version = api_version
+        return data
+
+    def get_api_version(self, kind):
+        try:
+            return K8s.supported_kinds.get(kind)[2]
+        except Exception as e:
+            raise e
+
     def get_api_method(self, kind):
         try:
             api_name = K8s.supported_kinds.get(kind)[0]
@@ -308,35 +818,39 @@ class K8s(Base):
 
     @lib.timing_wrapper
     @lib.retry_wrapper
+    @lib.rate_limit_wrapper
     def list_custom_kind(self, namespace, group, version, kinds):
         resources = self.custom.list_namespaced_custom_object(group, version, namespace, kinds)
         return resources['items']
  
     @lib.timing_wrapper
     @lib.retry_wrapper
+    @lib.rate_limit_wrapper
     def read_custom_kind(self, namespace, group, version, kind, name):
         return self.custom.get_namespaced_custom_object(group, version, namespace, kind, name)
     
     @lib.timing_wrapper
     @lib.k8s_chunk_wrapper
     @lib.retry_wrapper
+    @lib.rate_limit_wrapper
     def list_custom_resource_definitions(self, limit=100, next=next):
         return self.v1beta1.list_custom_resource_definition(limit=limit, _continue=next)
 
     @lib.timing_wrapper
     @lib.retry_wrapper
+    @lib.rate_limit_wrapper
     def read_resource_definition(self, name):
         return self.v1beta1.read_custom_resource_definition(name=name)
 
     @lib.timing_wrapper
-    @lib.retry_wrapper
     def get_custom_resource_definitions(self, limit=100, next=''):
         for resource in self.list_custom_resource_definitions(limit=limit, next=next):
-            yield self.v1beta1.read_custom_resource_definition(resource.metadata.name)
+            yield self.read_resource_definition(resource.metadata.name)
 
     @lib.timing_wrapper
     @lib.k8s_chunk_wrapper
     @lib.retry_wrapper
+    @lib.rate_limit_wrapper
     def list_namespaces(self, limit=100, next='', label_selector=''):
         return self.v1.list_namespace(limit=limit, _continue=next, 
                                       label_selector=label_selector)
@@ -344,12 +858,14 @@ class K8s(Base):
 
     @lib.timing_wrapper
     @lib.retry_wrapper
+    @lib.rate_limit_wrapper
     def read_namespace(self, namespace):
         return self.v1.read_namespace(namespace)
 
     @lib.timing_wrapper
     @lib.k8s_chunk_wrapper
     @lib.retry_wrapper
+    @lib.rate_limit_wrapper
     def list_kind(self, namespace, kind, limit=100, next=''):
         api, method = self.get_api_method(kind)
         return lib.dynamic_method_call(namespace, limit=limit, _continue=next,
@@ -359,6 +875,7 @@ class K8s(Base):
 
     @lib.timing_wrapper
     @lib.retry_wrapper
+    @lib.rate_limit_wrapper
     def read_kind(self, namespace, kind, name):
         api, method = self.get_api_method(kind)
         return lib.dynamic_method_call(name, namespace,
@@ -368,6 +885,7 @@ class K8s(Base):
 
     @lib.timing_wrapper
     @lib.retry_wrapper
+    @lib.rate_limit_wrapper
     def delete_kind(self, namespace, kind, name):
         api, method = self.get_api_method(kind)
         return lib.dynamic_method_call(name, namespace,
@@ -377,6 +895,7 @@ class K8s(Base):
 
     @lib.timing_wrapper
     @lib.retry_wrapper
+    @lib.rate_limit_wrapper
     def create_kind(self, namespace, kind, data):
         api, method = self.get_api_method(kind)
         return lib.dynamic_method_call(namespace, data,
@@ -386,6 +905,7 @@ class K8s(Base):
 
     @lib.timing_wrapper
     @lib.retry_wrapper
+    @lib.rate_limit_wrapper
     def replace_kind(self, namespace, kind, name, data):
         api, method = self.get_api_method(kind)
         return lib.dynamic_method_call(name, namespace, data,
@@ -402,7 +922,19 @@ class K8s(Base):
         return K8s.process_data(data)["data"]
 
 class DRBase(Base):
-    """Base class for DR operations"""
+    """Base class for DR operations
+
+    The retry_budget keyword argument limits the number of retries of failed
+    S3 and Kubernetes calls in a run, defaults to no limit. The budget is held
+    in the retry_budget attribute, shared with the S3 and Kubernetes objects
+    used by this object, and is not affected by other objects. A run starts
+    when the object is created and again at each save_cluster or
+    restore_namespaces. Worker processes each have their own budget.
+
+    Each run produces a lib.RunReport, available as a dictionary in
+    last_report once the run is finished. Set the report_file keyword
+    argument to also write it to that file as JSON.
+    """
 
     exclude_list = [("default", "Service", "kubernetes"),
                     ("default", "Endpoints", "kubernetes")]
@@ -412,8 +944,34 @@ class DRBase(Base):
         lib.log.debug("DRBase init", extra=dict(**kwargs))
 
         self.prefix = kwargs["prefix"] if "prefix" in kwargs else ''
+        self.max_retries = kwargs["retry_budget"] if "retry_budget" in kwargs else None
+        self.retry_budget = lib.RetryBudget(self.max_retries)
+        self.report_file = kwargs["report_file"] if "report_file" in kwargs else None
+        self.last_report = None
+        self._report = None
 
         self.k8s = K8s(*args, **kwargs)
+        self.k8s.retry_budget = self.retry_budget
+
+    def _start_report(self, operation, **info):
+        """Start the report for a run"""
+        return lib.RunReport(operation, **info)
+
+    def _finish_report(self, report):
+        """Finish the report for a run, keeping it in last_report and writing it to report_file"""
+        self.last_report = report.to_dict()
+        totals = self.last_report["totals"]
+        lib.log.info("%s report: %d objects, %d bytes, %d s3 requests, %d k8s requests, %d retries in %.3f seconds",
+                     report.operation, totals.get("objects", 0), totals.get("bytes", 0),
+                     self.last_report["metrics"]["s3_requests_total"], self.last_report["metrics"]["k8s_requests_total"],
+                     self.last_report["metrics"]["retries_total"], self.last_report["elapsed_seconds"])
+        if "compression" in self.last_report:
+            compression = self.last_report["compression"]
+            lib.log.info("%s compression: ratio %.2f, %d bytes saved for %.3f cpu seconds", report.operation,
+                         compression["ratio"], compression["saved_bytes"], compression["cpu_seconds"])
+        if self.report_file:
+            report.write(self.report_file)
+        return self.last_report
 
     def exclude_check(self, namespace, kind, name):
         if (namespace, kind, name) in self.exclude_list:
@@ -451,6 +1009,97 @@ class DRBase(Base):
         result = self.untemplated_prefix()
         return "{}/{}".format(result, key)
 
+    def get_s3_manifest_key(self, clusterset, clustername, namespace):
+        """Create the S3 key of the manifest for a namespace
+
+        Manifests are kept under a '_manifests' path alongside the namespaces,
+        kubernetes namespace names cannot start with '_' so this never clashes
+        with a namespace.
+
+        Arguments:
+            clusterset {str} -- the name of the clusterset
+            clustername {str} -- the cluster name
+            namespace {str} -- the namespace
+        """
+        return "{}/_manifests/{}.json".format(self.get_s3_namespaces_path(clusterset, clustername), namespace)
+
+    def get_s3_bundle_key(self, clusterset, clustername, namespace):
+        """Create the S3 key of the bundle for a namespace
+
+        Arguments:
+            clusterset {str} -- the name of the clusterset
+            clustername {str} -- the cluster name
+            namespace {str} -- the namespace
+        """
+        return "{}/{}".format(self.get_s3_namespace_path(clusterset, clustername, namespace), bundle.BUNDLE_NAME)
+
+    def get_s3_references_key(self, clusterset, clustername, namespace):
+        """Create the S3 key of the references manifest for a namespace saved with the content layout
+
+        Arguments:
+            clusterset {str} -- the name of the clusterset
+            clustername {str} -- the cluster name
+            namespace {str} -- the namespace
+        """
+        return "{}/{}".format(self.get_s3_namespace_path(clusterset, clustername, namespace), REFERENCES_NAME)
+
+    def get_s3_content_path(self, clusterset):
+        """Create the S3 path for the content shared by the clusters in a clusterset
+
+        Arguments:
+            clusterset {str} -- the name of the clusterset
+        """
+        key = "{}/_objects".format(clusterset)
+        if len(self.prefix) == 0:
+            return key
+        return "{}/{}".format(self.untemplated_prefix(), key)
+
+    def get_s3_snapshots_path(self, clusterset, clustername, namespace=None):
+        """Create the S3 path for the snapshots of a cluster, or a namespace in the cluster
+
+        Arguments:
+            clusterset {str} -- the name of the clusterset
+            clustername {str} -- the cluster name
+            namespace {str} -- the namespace, defaults to the path of all namespaces
+        """
+        path = "{}/_snapshots".format(self.get_s3_namespaces_path(clusterset, clustername))
+        return path if namespace is None else "{}/{}".format(path, namespace)
+
+    def get_s3_snapshot_key(self, clusterset, clustername, namespace, timestamp):
+        """Create the S3 key of the snapshot manifest of a namespace taken at a time
+
+        The name is the time inverted, so snapshots list most recent first.
+
+        Arguments:
+            clusterset {str} -- the name of the clusterset
+            clustername {str} -- the cluster name
+            namespace {str} -- the namespace
+            timestamp {datetime|float} -- the time of the snapshot, naive datetimes are UTC
+        """
+        return self._snapshot_key(self.get_s3_snapshots_path(clusterset, clustername, namespace), self.epoch_ms(timestamp))
+
+    @staticmethod
+    def _snapshot_key(snapshots_path, epoch_ms):
+        return "{}/{:013d}.json".format(snapshots_path, SNAPSHOT_EPOCH_MS_MAX - epoch_ms)
+
+    @staticmethod
+    def epoch_ms(timestamp):
+        """Returns a datetime, naive ones being UTC, or seconds since the epoch as milliseconds since the epoch"""
+        if isinstance(timestamp, datetime.datetime):
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+            timestamp = timestamp.timestamp()
+        return int(timestamp * 1000)
+
+    @staticmethod
+    def get_s3_content_key(content_path, digest):
+        """Create the S3 key of a resource's yaml stored by its hash
+
+        Arguments:
+            content_path {str} -- the path from get_s3_content_path
+            digest {str} -- the sha256 hash of the yaml
+        """
+        return "{}/{}/{}.yaml".format(content_path, digest[:2], digest)
 
     def create_s3_key(self, namespace, kind, api_version, name):
         """Create the key in S3 for a resource
@@ -498,7 +1147,47 @@ class DRBase(Base):
         return items
 
 class Backup(DRBase):
-    """Backup Kubernetes to S3"""
+    """Backup Kubernetes to S3
+
+    Resources are serialized directly from the list responses. Set the
+    read_objects keyword argument to True to read each resource individually
+    after listing it instead, at the cost of one extra API call per resource.
+
+    The k8s_workers and s3_workers keyword arguments set the number of
+    threads used for Kubernetes API calls and S3 uploads, both default to 1.
+
+    Set the skip_unchanged keyword argument to True to only upload resources
+    whose content differs from the previous backup. A sha256 hash of each
+    resource's yaml is kept in a per-namespace manifest in S3 for this.
+
+    The layout keyword argument selects how resources are stored. With the
+    default, "objects", each resource is a separate S3 object. With "bundle"
+    each namespace is stored as a single bundle object, see utilslib.bundle,
+    streamed to S3 using a multipart upload with parts of bundle_part_size
+    bytes, 8MiB by default. With skip_unchanged a bundle is only uploaded if
+    any resource in the namespace changed.
+
+    With "content" the yaml of each resource is stored once for the whole
+    clusterset, under the clusterset's _objects path keyed by its sha256
+    hash, and each namespace has a manifest referencing the hashes of its
+    resources. Clusters running the same resources then share the stored
+    objects, only content not already in the bucket is uploaded. Stored
+    content is never deleted, not even when the resources or namespaces
+    referencing it are removed, so the content path only grows.
+
+    Set snapshots to True with the content layout to also write an
+    immutable snapshot manifest for each namespace on each backup, under
+    the cluster's _snapshots path. A snapshot references the content of
+    each resource by hash so unchanged resources are not copied, and
+    Restore can restore a namespace as it was at any earlier snapshot.
+
+    With the objects and content layouts, set compression and
+    compression_level to compress each object in memory before it is
+    uploaded, see Store. Setting compression with the bundle layout raises
+    a ValueError.
+    """
+
+    layouts = ("objects", "bundle", "content")
 
     custom_resources = []
 
@@ -508,12 +1197,38 @@ class Backup(DRBase):
 
         lib.log.debug("Backup init", extra=dict(**kwargs))
 
+        self.read_objects = kwargs["read_objects"] if "read_objects" in kwargs else False
+        self.k8s_workers = kwargs["k8s_workers"] if "k8s_workers" in kwargs else 1
+        self.s3_workers = kwargs["s3_workers"] if "s3_workers" in kwargs else 1
+        self.skip_unchanged = kwargs["skip_unchanged"] if "skip_unchanged" in kwargs else False
+        self.layout = kwargs["layout"] if "layout" in kwargs else "objects"
+        self.bundle_part_size = kwargs["bundle_part_size"] if "bundle_part_size" in kwargs else 8 * 1024 * 1024
+
+        self.snapshots = kwargs["snapshots"] if "snapshots" in kwargs else False
+
+        if self.layout not in self.layouts:
+            raise Exception("layout must be one of: {}".format(", ".join(self.layouts)))
+
+        if self.snapshots and self.layout != "content":
+            raise Exception("snapshots need the content layout")
+
+        if self.layout == "bundle" and kwargs.get("compression"):
+            raise ValueError("compression is not supported with the bundle layout, bundle members are already gzipped")
+
         self.store = Store(*args, **kwargs)
         self.retrieve = Retrieve(*args, **kwargs)
+        self.store.retry_budget = self.retrieve.retry_budget = self.retry_budget
+
+        self._args = args
+        self._kwargs = kwargs
+        self._content_keys = set()
+        self._content_empty = None
+        self._content_sizes = {}
+        self._content_lock = threading.Lock()
 
     def _create_key_from_object(self, data):
         d = K8s.process_data(data)
-        y = yaml.dump(d)
+        y = lib.yaml_dump(d)
 
         namespace = d['metadata']['namespace'] if d["kind"] != "Namespace" else d['metadata']['name']
         kind = d["kind"]
@@ -533,20 +1248,87 @@ class Backup(DRBase):
         return resources
 
     @lib.timing_wrapper
-    def save_namespace(self, namespace):
+    def save_cluster(self, label_selector='', workers=1):
+        """Save all namespaces in the cluster to S3
+
+        The namespaces matching the label selector are distributed over a
+        pool of worker processes, each of which builds its own Backup object
+        from the arguments this object was created with. The Kubernetes rate
+        limit is split evenly between the workers. A failure in one
+        namespace is recorded and does not stop the others being saved.
+
+        Arguments:
+            label_selector {str} -- only save namespaces matching this label selector
+            workers {int} -- the number of worker processes, 1 saves the namespaces in this process
+
+        Returns:
+            [dict] -- the (stored, deleted) counts for each namespace saved
+            [dict] -- the error message for each namespace that failed
+        """
+        self.retry_budget.reset(self.max_retries)
+        report = self._start_report("backup", cluster_set=self.k8s.cluster_info["cluster.set"],
+                                    cluster_name=self.k8s.cluster_info["cluster.name"], workers=workers)
+        namespaces = self.k8s.list_namespaces(label_selector=label_selector)
+        lib.log.info("saving %d namespaces using %d workers", len(namespaces), workers)
+
+        results = {}
+        errors = {}
+        if workers <= 1:
+            self._report = report
+            try:
+                for ns in namespaces:
+                    name, result, error, _ = _save_namespace_worker(ns, backup=self)
+                    if error is None:
+                        results[name] = result
+                    else:
+                        errors[name] = error
+            finally:
+                self._report = None
+        else:
+            # only this process writes the run report, from the reports merged from the workers
+            kwargs = {k: v for k, v in self._kwargs.items() if k not in ("client", "api_client", "rate_limiter", "report_file")}
+            if self.k8s.rate_limiter is not None:
+                kwargs["k8s_qps"] = self.k8s.rate_limiter.qps / workers
+                kwargs["k8s_burst"] = max(self.k8s.rate_limiter.burst // workers, 1)
+            kwargs.setdefault("cluster_name", self.k8s.cluster_info["cluster.name"])
+            kwargs.setdefault("cluster_set", self.k8s.cluster_info["cluster.set"])
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_backup_worker,
+                                     initargs=(self._args, kwargs)) as pool:
+                for name, result, error, namespace_report in pool.map(_save_namespace_worker, namespaces):
+                    if namespace_report is not None:
+                        report.merge(namespace_report)
+                    if error is None:
+                        results[name] = result
+                    else:
+                        errors[name] = error
+
+        for name, error in errors.items():
+            lib.log.error("failed to save namespace %s: %s", name, error)
+            report.error(name, error)
+        self._finish_report(report)
+        lib.log.info("saved %d namespaces, %d failed", len(results), len(errors))
+        return results, errors
+
+    @lib.timing_wrapper
+    def save_namespace(self, namespace, namespace_object=None):
         """Save a namespace to S3
 
         This method will enumerate all resources in a namespace
         and then backup the yaml to S3. It will also delete
         any yaml in S3 for resources that no longer exist in
-        the namespace.
+        the namespace. Unless called by save_cluster, the run
+        report covers just this namespace.
 
         Arguments:
             namespace {str} -- the kubernetes namespace to backup
+            namespace_object {V1Namespace} -- the namespace resource if already read, defaults to reading it
 
         Returns:
-            [int] -- number of resources backuped to S3
+            [int] -- number of resources uploaded to S3
             [int] -- number of resources deleted from s3
+
+        The number of unchanged resources not uploaded is recorded as skipped
+        in the run report.
         """
         if not isinstance(namespace, str):
             raise Exception("namespace must be a string")
@@ -556,93 +1338,480 @@ class Backup(DRBase):
 
         lib.log.info("saving namespace %s", namespace)
 
-        keys_stored = self._save_to_s3(namespace)
-        keys_deleted = self._handle_deleted_resources(keys_stored, namespace)
+        own_report = self._report is None
+        if own_report:
+            self._report = self._start_report("backup", cluster_set=self.k8s.cluster_info["cluster.set"],
+                                              cluster_name=self.k8s.cluster_info["cluster.name"])
+        try:
+            bucket_keys = None
+            previous = None
+            if self.skip_unchanged:
+                with self._report.phase("diff", namespace):
+                    bucket_keys = list(self.retrieve.iter_bucket_keys(self._get_namespace_path(namespace) + "/"))
+                    previous = self._load_manifest(namespace, bucket_keys)
+            if self.layout == "content":
+                with self._report.phase("diff", namespace):
+                    self._add_stored_content(previous if previous is not None else self._load_manifest(namespace, []))
+
+            if self.layout == "bundle":
+                stored = self._save_bundle(namespace, namespace_object, previous)
+                keys_stored = [key for key, _, _ in stored]
+                keys_kept = [self._get_bundle_key(namespace)]
+            elif self.layout == "content":
+                stored = self._save_to_s3(namespace, namespace_object, previous)
+                keys_stored = [key for key, _, _ in stored]
+                keys_kept = [self._get_manifest_key(namespace)]
+            else:
+                stored = self._save_to_s3(namespace, namespace_object, previous)
+                keys_stored = keys_kept = [key for key, _, _ in stored]
+            with self._report.phase("diff", namespace):
+                keys_deleted = self._handle_deleted_resources(keys_kept, namespace, bucket_keys)
+
+            if self.skip_unchanged or self.layout == "content":
+                with self._report.phase("upload", namespace):
+                    self._save_manifest(namespace, {key: digest for key, digest, _ in stored})
+            if self.snapshots:
+                with self._report.phase("upload", namespace):
+                    self._save_snapshot(namespace, {key: digest for key, digest, _ in stored})
+        except Exception as e:
+            self._report.error(namespace, str(e))
+            raise
+        finally:
+            if own_report:
+                report = self._report
+                self._report = None
+                self._finish_report(report)
+
+        num_uploaded = len([key for key, _, uploaded in stored if uploaded])
+        num_skipped = len(keys_stored) - num_uploaded
+        lib.log.info("saved %d resources to S3, skipped %d unchanged resources and deleted %d resources from S3",
+                     num_uploaded, num_skipped, len(keys_deleted))
+        return num_uploaded, len(keys_deleted)
+
+    def _get_namespace_path(self, namespace):
+        return self.get_s3_namespace_path(self.k8s.cluster_info["cluster.set"], self.k8s.cluster_info["cluster.name"], namespace)
+
+    def _get_manifest_key(self, namespace):
+        if self.layout == "content":
+            return self.get_s3_references_key(self.k8s.cluster_info["cluster.set"], self.k8s.cluster_info["cluster.name"], namespace)
+        return self.get_s3_manifest_key(self.k8s.cluster_info["cluster.set"], self.k8s.cluster_info["cluster.name"], namespace)
+
+    def _get_bundle_key(self, namespace):
+        return self.get_s3_bundle_key(self.k8s.cluster_info["cluster.set"], self.k8s.cluster_info["cluster.name"], namespace)
+
+    def _load_manifest(self, namespace, bucket_keys):
+        """Load the hashes recorded by the previous backup of a namespace
+
+        Only keys that are still present in the bucket are returned, so an
+        object removed from S3 outside of a backup is uploaded again. With
+        the bundle layout the keys are returned if the bundle is present, with
+        the content layout the manifest holds the references so all its keys
+        are returned.
+
+        Arguments:
+            namespace {str} -- the kubernetes namespace
+            bucket_keys {str[]} -- the keys currently in the bucket for the namespace
 
-        lib.log.info("saved %d resources to S3 and deleted %d resources from S3", len(keys_stored), len(keys_deleted))
-        return len(keys_stored), len(keys_deleted)
+        Returns:
+            dict -- the hash of each key
+        """
+        data = self.retrieve.get_bucket_item_if_exists(self._get_manifest_key(namespace))
+        if data is None:
+            lib.log.info("no manifest for namespace %s, all resources will be uploaded", namespace)
+            return {}
+        existing = set(bucket_keys)
+        objects = json.loads(data.decode("utf-8")).get("objects", {})
+        if self.layout == "bundle":
+            return objects if self._get_bundle_key(namespace) in existing else {}
+        if self.layout == "content":
+            return objects
+        return {key: digest for key, digest in objects.items() if key in existing}
+
+    def _save_manifest(self, namespace, objects):
+        """Store the hashes of the resources saved for a namespace
+
+        Arguments:
+            namespace {str} -- the kubernetes namespace
+            objects {dict} -- the hash of each key stored
+        """
+        manifest = {"namespace": namespace, "objects": objects}
+        if self.layout == "content":
+            manifest["content_path"] = self.get_s3_content_path(self.k8s.cluster_info["cluster.set"])
+            manifest["sizes"] = self._get_content_sizes(objects)
+        self.store.store_in_bucket(self._get_manifest_key(namespace), json.dumps(manifest, sort_keys=True))
+
+    def _save_snapshot(self, namespace, objects):
+        """Store a snapshot manifest referencing the content of the resources saved for a namespace
+
+        Arguments:
+            namespace {str} -- the kubernetes namespace
+            objects {dict} -- the hash of each key stored
+        """
+        timestamp = datetime.datetime.now(datetime.timezone.utc)
+        clusterset, clustername = self.k8s.cluster_info["cluster.set"], self.k8s.cluster_info["cluster.name"]
+        snapshot = {"namespace": namespace, "objects": objects, "timestamp": timestamp.isoformat(),
+                    "content_path": self.get_s3_content_path(clusterset), "sizes": self._get_content_sizes(objects)}
+        key = self.get_s3_snapshot_key(clusterset, clustername, namespace, timestamp)
+        lib.log.info("saving snapshot of namespace %s as %s", namespace, key)
+        self.store.store_in_bucket(key, json.dumps(snapshot, sort_keys=True))
+
+    def _get_content_sizes(self, objects):
+        """Get the size of the yaml for each hash referenced, used by Restore to limit prefetching"""
+        return {digest: self._content_sizes[digest] for digest in objects.values() if digest in self._content_sizes}
 
     @lib.timing_wrapper
-    def _save_to_s3(self, namespace):
+    def _save_to_s3(self, namespace, namespace_object=None, previous=None):
         """Save Kubernetes resources for a namespace to S3
 
+        The namespace read and the kind listings run on a pool of k8s_workers
+        threads, serialization and uploads run on a pool of s3_workers threads
+        so that uploads overlap with the remaining Kubernetes API calls.
+
+        Arguments:
+            namespace {str} -- the kubernetes namespace to backup
+            namespace_object {V1Namespace} -- the namespace resource if already read, defaults to reading it
+            previous {dict} -- the hash of each key from the previous backup, resources with
+                               an unchanged hash are not uploaded. Defaults to uploading all
+
+        Returns:
+            [tuple[]] -- the key, hash and whether it was uploaded for each resource
+        """
+        with ThreadPoolExecutor(max_workers=self.k8s_workers) as k8s_pool, \
+             ThreadPoolExecutor(max_workers=self.s3_workers) as s3_pool:
+            store_futures = [s3_pool.submit(self._store_object, item, previous)
+                             for item in self._iter_resources(namespace, namespace_object, k8s_pool)]
+            return [future.result() for future in store_futures]
+
+    @lib.timing_wrapper
+    def _save_bundle(self, namespace, namespace_object=None, previous=None):
+        """Save Kubernetes resources for a namespace to S3 as a bundle
+
+        Resources are serialized and compressed by s3_workers threads and
+        streamed to S3 in the order they were listed. With a non-empty
+        previous, all the resources are compared, and so held in memory,
+        before anything is uploaded, and the bundle is only uploaded if a
+        resource was changed, added or removed.
+
         Arguments:
             namespace {str} -- the kubernetes namespace to backup
+            namespace_object {V1Namespace} -- the namespace resource if already read, defaults to reading it
+            previous {dict} -- the hash of each key from the previous backup, defaults to uploading the bundle
+
+        Returns:
+            [tuple[]] -- the key, hash and whether it was uploaded for each resource
+        """
+        with ThreadPoolExecutor(max_workers=self.k8s_workers) as k8s_pool:
+            packed = (result for _, result in lib.ordered_prefetch(self._pack_object,
+                                                                    self._iter_resources(namespace, namespace_object, k8s_pool),
+                                                                    workers=self.s3_workers))
+            # without a previous manifest every resource is new, so the bundle is streamed
+            if previous:
+                packed = list(packed)
+                if {key: digest for key, _, _, _, _, digest, _ in packed} == previous:
+                    lib.log.info("namespace %s unchanged, not storing bundle", namespace)
+                    for key, kind, _, _, _, digest, size in packed:
+                        self._report.add(namespace, kind, objects=1, bytes=size, skipped=1)
+                    return [(key, digest, False) for key, _, _, _, _, digest, _ in packed]
+
+            writer = bundle.BundleWriter(namespace)
+
+            def chunks():
+                for key, kind, api_version, name, member, digest, size in packed:
+                    self._report.add(namespace, kind, objects=1, bytes=size, uploaded=1)
+                    yield writer.add_member(key, kind, api_version, name, member, digest, size)
+                yield writer.finish()
+
+            bundle_key = self._get_bundle_key(namespace)
+            lib.log.debug("storing bundle in S3 with key %s", bundle_key)
+            with self._report.phase("upload", namespace):
+                self.store.store_stream_in_bucket(bundle_key, chunks(), part_size=self.bundle_part_size,
+                                                  content_type="application/gzip")
+            return [(entry["key"], entry["sha256"], True) for entry in writer.entries]
+
+    def _iter_resources(self, namespace, namespace_object, k8s_pool):
+        """Generator of the resources in a namespace, starting with the namespace itself
+
+        The namespace read and the kind listings are all started on k8s_pool
+        when the first resource is asked for.
+
+        Arguments:
+            namespace {str} -- the kubernetes namespace
+            namespace_object {V1Namespace} -- the namespace resource if already read, None to read it
+            k8s_pool {ThreadPoolExecutor} -- the pool to run the Kubernetes API calls on
 
         Returns:
-            [str[]] -- an array of keys for the objects stored
+            [object[]] -- the resources
         """
-        keys = []
+        if namespace_object is None:
+            lib.log.debug("reading namespace %s", namespace)
+            ns_future = k8s_pool.submit(self.k8s.read_namespace, namespace)
+        else:
+            ns_future = k8s_pool.submit(K8s.set_type_meta, namespace_object, "Namespace", "v1")
+        list_futures = [k8s_pool.submit(self._list_kind_items, namespace, kind)
+                        for kind in K8s.supported_kinds.keys()]
+        list_futures += [k8s_pool.submit(self._list_custom_kind_items, namespace, kind)
+                         for kind in self.k8s.supported_custom_kinds.keys()]
 
-        # Save the namespace first
-        lib.log.debug("reading namespace %s", namespace)
-        ns = self.k8s.read_namespace(namespace)
-        key, data = self._create_key_from_object(ns)
-        lib.log.debug("storing namespace in S3 with key %s", key)
-        self.store.store_in_bucket(key, data)
-        keys.append(key)
+        yield ns_future.result()
+        for future in list_futures:
+            for item in future.result():
+                yield item
+
+    def _list_kind_items(self, namespace, kind):
+        """List the resources of a supported kind in a namespace
+
+        Arguments:
+            namespace {str} -- the kubernetes namespace
+            kind {str} -- the kind name of the resources
 
-        # Save the kinds that are supported
-        for kind in K8s.supported_kinds.keys():
+        Returns:
+            [object[]] -- the resources with their kind and apiVersion set
+        """
+        items = []
+        api_version = self.k8s.get_api_version(kind)
+        with self._report.phase("list", namespace):
             for item in self.k8s.list_kind(namespace, kind):
-                lib.log.debug("reading kind %s with name %s in namespace %s", kind, item.metadata.name, namespace)
-                read_data = self.k8s.read_kind(namespace, kind, item.metadata.name)
-                key, data = self._create_key_from_object(read_data)
-                lib.log.debug("storing %s in S3 with key %s", kind, key)
-                self.store.store_in_bucket(key, data)
-                keys.append(key)
-        # Save custom kinds
-        for kind in self.k8s.supported_custom_kinds.keys():
-            group, version, kinds = self.k8s.supported_custom_kinds[kind]
+                if self.read_objects:
+                    lib.log.debug("reading kind %s with name %s in namespace %s", kind, item.metadata.name, namespace)
+                    item = self.k8s.read_kind(namespace, kind, item.metadata.name)
+                items.append(K8s.set_type_meta(item, kind, api_version))
+        return items
+
+    def _list_custom_kind_items(self, namespace, kind):
+        """List the resources of a supported custom kind in a namespace
+
+        Arguments:
+            namespace {str} -- the kubernetes namespace
+            kind {str} -- the kind name of the resources
+
+        Returns:
+            [dict[]] -- the resources with their kind and apiVersion set
+        """
+        items = []
+        group, version, kinds = self.k8s.supported_custom_kinds[kind]
+        api_version = "{}/{}".format(group, version)
+        with self._report.phase("list", namespace):
             for item in self.k8s.list_custom_kind(namespace, group, version, kinds):
-                lib.log.debug("reading kind %s with name %s in namespace %s", kind, item['metadata']['name'], namespace)
-                read_data = self.k8s.read_custom_kind(namespace, group, version, kinds, item['metadata']['name'])
-                key, data = self._create_key_from_object(read_data)
-                lib.log.debug("storing %s in S3 with key %s", kind, key)
-                self.store.store_in_bucket(key, data)
-                keys.append(key)         
-        return keys
+                if self.read_objects:
+                    lib.log.debug("reading kind %s with name %s in namespace %s", kind, item['metadata']['name'], namespace)
+                    item = self.k8s.read_custom_kind(namespace, group, version, kinds, item['metadata']['name'])
+                items.append(K8s.set_type_meta(item, kind, api_version))
+        return items
+
+    def _store_object(self, data, previous=None):
+        """Serialize a resource and store it in S3 if it has changed
+
+        Arguments:
+            data {object} -- the resource to store
+            previous {dict} -- the hash of each key from the previous backup
+
+        Returns:
+            str -- the key of the object
+            str -- the sha256 hash of the object's yaml
+            bool -- True if the object was uploaded, False if it was unchanged
+        """
+        started = time.perf_counter()
+        key, y = self._create_key_from_object(data)
+        body = y.encode()
+        digest = hashlib.sha256(body).hexdigest()
+        _, _, namespace, kind, _ = S3.parse_key(self.remove_prefix_from_key(key))
+        self._report.add_phase("serialize", time.perf_counter() - started, namespace)
+        if self.layout == "content":
+            self._content_sizes[digest] = len(body)
+        if previous is not None and previous.get(key) == digest:
+            lib.log.debug("key %s unchanged, not storing", key)
+            self._report.add(namespace, kind, objects=1, bytes=len(body), skipped=1)
+            return key, digest, False
+        if self.layout == "content":
+            with self._report.phase("upload", namespace):
+                uploaded = self._store_content(digest, y)
+            self._report.add(namespace, kind, objects=1, bytes=len(body), uploaded=int(uploaded),
+                             deduplicated=int(not uploaded))
+            return key, digest, uploaded
+        lib.log.debug("storing in S3 with key %s", key)
+        with self._report.phase("upload", namespace):
+            self.store.store_in_bucket(key, y)
+        self._report.add(namespace, kind, objects=1, bytes=len(body), uploaded=1)
+        return key, digest, True
+
+    def _add_stored_content(self, references):
+        """Record the content referenced by a namespace's previous backup as stored
+
+        Arguments:
+            references {dict} -- the hash of each key from the previous references manifest
+        """
+        content_path = self.get_s3_content_path(self.k8s.cluster_info["cluster.set"])
+        with self._content_lock:
+            self._content_keys.update(self.get_s3_content_key(content_path, digest) for digest in references.values())
+
+    def _store_content(self, digest, y):
+        """Store a resource's yaml by its hash unless it is already stored
+
+        Content referenced by the namespace's previous backup, or stored or
+        seen by this object, is known to be stored. Other content is checked
+        for with a HEAD request, unless the clusterset had no content when
+        this object first stored any, found by listing at most one key. The
+        cost then scales with the changed resources rather than with all the
+        content in the clusterset.
+
+        Arguments:
+            digest {str} -- the sha256 hash of the yaml
+            y {str} -- the yaml
+
+        Returns:
+            bool -- True if the yaml was uploaded, False if it was already stored
+        """
+        content_path = self.get_s3_content_path(self.k8s.cluster_info["cluster.set"])
+        content_key = self.get_s3_content_key(content_path, digest)
+        with self._content_lock:
+            if content_key in self._content_keys:
+                lib.log.debug("content %s already stored", content_key)
+                return False
+            self._content_keys.add(content_key)
+            if self._content_empty is None:
+                self._content_empty = next(self.retrieve.iter_bucket_keys(content_path + "/", page_size=1), None) is None
+        try:
+            if not self._content_empty and self.retrieve.bucket_item_exists(content_key):
+                lib.log.debug("content %s already stored", content_key)
+                return False
+            lib.log.debug("storing in S3 with key %s", content_key)
+            self.store.store_in_bucket(content_key, y)
+        except Exception:
+            with self._content_lock:
+                self._content_keys.discard(content_key)
+            raise
+        return True
+
+    def _pack_object(self, data):
+        """Serialize a resource and compress it into a bundle member
+
+        Arguments:
+            data {object} -- the resource to pack
+
+        Returns:
+            str -- the key of the object in the per object layout
+            str -- the kind name of the resource
+            str -- the api version of the resource
+            str -- the name of the resource
+            bytes -- the bundle member
+            str -- the sha256 hash of the object's yaml
+            int -- the size of the object's yaml
+        """
+        started = time.perf_counter()
+        key, y = self._create_key_from_object(data)
+        body = y.encode()
+        digest = hashlib.sha256(body).hexdigest()
+        member = bundle.compress_document(body)
+        _, _, namespace, kind, api_version, name = self.remove_prefix_from_key(key).split("/")
+        api_version, name = api_version.replace("_", "/"), name[:-len(".yaml")]
+        self._report.add_phase("serialize", time.perf_counter() - started, namespace)
+        return key, kind, api_version, name, member, digest, len(body)
 
     @lib.timing_wrapper
-    def _handle_deleted_resources(self, existing_keys, namespace):
+    def _handle_deleted_resources(self, existing_keys, namespace, bucket_keys=None):
         """Delete any artefacts from S3 for non-existent resources
 
         Arguments:
             existing_keys {str[]} -- an array of the keys for resources that exist in the namespace
             namespace {str} -- the kubernetes namespace to backup
+            bucket_keys {str[]} -- the keys in the bucket for the namespace if already listed, defaults to listing them
 
         Returns:
             [str[]] -- an array of the keys deleted from the s3 bucket
         """
-        keys_deleted = []
-
-        prefix = self.get_s3_namespace_path(self.k8s.cluster_info["cluster.set"], self.k8s.cluster_info["cluster.name"], namespace)
-        for key in self.retrieve.get_bucket_keys(prefix):
-            if key not in existing_keys:
-                lib.log.info("key {} doesn't exist in k8s, deleting from s3".format(key))
-                self.store.delete_from_bucket(key)
-                keys_deleted.append(key)
-            else:
-                lib.log.debug("key {} exists in k8s, no action".format(key))
+        if bucket_keys is None:
+            bucket_keys = self.retrieve.iter_bucket_keys(self._get_namespace_path(namespace) + "/")
+
+        existing = set(existing_keys)
+        stale_keys = [key for key in bucket_keys if key not in existing]
+        for key in stale_keys:
+            lib.log.info("key {} doesn't exist in k8s, deleting from s3".format(key))
+
+        keys_deleted, errors = self.store.delete_keys_from_bucket(stale_keys)
+        if len(errors) > 0:
+            lib.log.error("failed to delete %d keys from s3 for namespace %s", len(errors), namespace)
+        for key in keys_deleted:
+            fields = self.remove_prefix_from_key(key).split("/")
+            # metadata such as the bundle or references manifest has no kind in its key
+            kind = fields[3] if len(fields) == 6 else fields[-1]
+            self._report.add(namespace, kind, deleted=1)
         return keys_deleted
 
+# the Backup object of a save_cluster worker process, set by _init_backup_worker
+_worker = {"backup": None}
+
+
+def _init_backup_worker(args, kwargs):
+    """Create the Backup object used by a save_cluster worker process"""
+    _worker["backup"] = Backup(*args, **kwargs)
+
+
+def _save_namespace_worker(namespace_object, backup=None):
+    """Save a single namespace for save_cluster
+
+    Arguments:
+        namespace_object {V1Namespace} -- the namespace to save
+        backup {Backup} -- the Backup object to use, defaults to the worker process one
+
+    Returns:
+        str -- the namespace name
+        tuple -- the result of save_namespace, None if it failed
+        str -- the error message, None if it succeeded
+        dict -- the run report of a worker process, None when saved in this process
+    """
+    in_process = backup is not None
+    backup = backup if in_process else _worker["backup"]
+    name = namespace_object.metadata.name
+    backup.last_report = None
+    try:
+        result = backup.save_namespace(name, namespace_object), None
+    except Exception as e:
+        result = None, str(e)
+    return (name,) + result + (None if in_process else backup.last_report,)
+
 
 class Restore(DRBase):
-    """Restore a Kubernetes cluster from S3"""
-
-    kind_order = ['Namespace',
-                  'LimitRange',
-                  'ResourceQuota',
-                  'ConfigMap',
-                  'Secret',
-                  'Service',
-                  'Role',
-                  'ServiceAccount',
-                  'RoleBinding',
-                  'HorizontalPodAutoscaler',
-                  'Deployment',
-                  'Gateway',
-                  'VirtualService']
+    """Restore a Kubernetes cluster from S3
+
+    Kinds are restored in tiers worked out from kind_dependencies, the kinds
+    in a tier do not depend on each other and the strategy's finish_tier is
+    called between tiers. Objects are downloaded by prefetch_workers threads
+    ahead of the strategy, limited to prefetch_bytes of downloaded but
+    unprocessed data, and passed to the strategy in tier order.
+
+    Namespaces backed up with the bundle layout are read from the bundle
+    using its index, so restoring selected kinds or named objects only
+    downloads those objects. Objects that are close together in the bundle
+    are fetched with a single ranged GET, objects are merged into a range
+    if the gap to the previous object is at most range_gap bytes, 64KiB by
+    default, and the range is at most range_size bytes, 8MiB by default.
+    The sha256 hash of each object is checked against the index.
+
+    Namespaces backed up with the content layout are read using their
+    references manifest, each object is read from the clusterset's content
+    path and its hash checked. With snapshots, restore_namespaces can
+    restore namespaces as they were at the closest snapshot at or before a
+    given time instead, found with a single list request per namespace.
+    """
+
+    # The kinds each kind depends on, kinds are only restored once all the
+    # kinds they depend on have been restored. Use add_kind to extend this.
+    kind_dependencies = {'Namespace': [],
+                         'LimitRange': ['Namespace'],
+                         'ResourceQuota': ['Namespace'],
+                         'ConfigMap': ['LimitRange', 'ResourceQuota'],
+                         'Secret': ['LimitRange', 'ResourceQuota'],
+                         'Service': ['LimitRange', 'ResourceQuota'],
+                         'Role': ['LimitRange', 'ResourceQuota'],
+                         'ServiceAccount': ['LimitRange', 'ResourceQuota'],
+                         'RoleBinding': ['Role', 'ServiceAccount'],
+                         'HorizontalPodAutoscaler': ['LimitRange', 'ResourceQuota'],
+                         'Deployment': ['ConfigMap', 'Secret', 'ServiceAccount', 'RoleBinding', 'HorizontalPodAutoscaler'],
+                         'Gateway': ['Secret', 'Service', 'Deployment'],
+                         'VirtualService': ['Service', 'Gateway']}
+
+    kind_tiers = lib.dependency_tiers(kind_dependencies)
+    kind_order = [kind for tier in kind_tiers for kind in tier]
 
     def __init__(self, bucket_name, strategy, *args, **kwargs):
         super(Restore, self).__init__(*args, **kwargs)
@@ -658,9 +1827,32 @@ class Restore(DRBase):
             raise Exception("you must supply a strategy to use for backup")
 
         self.retrieve = Retrieve(bucket_name=bucket_name, *args, **kwargs)
+        self.retrieve.retry_budget = self.retry_budget
 
         self.bucket_name = bucket_name
         self.strategy = strategy
+        self.namespace_errors = {}
+
+        self.prefetch_workers = kwargs["prefetch_workers"] if "prefetch_workers" in kwargs else 1
+        self.prefetch_bytes = kwargs["prefetch_bytes"] if "prefetch_bytes" in kwargs else 64 * 1024 * 1024
+        self.range_gap = kwargs["range_gap"] if "range_gap" in kwargs else 64 * 1024
+        self.range_size = kwargs["range_size"] if "range_size" in kwargs else 8 * 1024 * 1024
+
+    @classmethod
+    def add_kind(cls, kind, depends_on=()):
+        """Add a kind to restore, or change the dependencies of an existing kind
+
+        Arguments:
+            kind {str} -- the kind name
+            depends_on {str[]} -- the kinds that must be restored before this kind
+        """
+        dependencies = dict(cls.kind_dependencies)
+        dependencies[kind] = list(depends_on)
+        tiers = lib.dependency_tiers(dependencies)
+
+        cls.kind_dependencies = dependencies
+        cls.kind_tiers = tiers
+        cls.kind_order = [k for tier in tiers for k in tier]
 
     @lib.timing_wrapper
     def remove_if_exists(self, namespace, kind, name):
@@ -671,25 +1863,241 @@ class Restore(DRBase):
         self.k8s.delete_kind(namespace, kind, name)
 
     @lib.timing_wrapper
-    @lib.retry_wrapper
     def get_s3_namespaces(self, path):
         """
         retrieve namespace names for provided cluster name prefix.
 
         :param path: the path to root of the namespaces
         """
-        namespace_index = 2
-        keys = self.retrieve.get_bucket_keys(path)
-        if len(self.prefix) > 0:
-            pre = self.untemplated_prefix()
-            num_separators = pre.count("/")
-            namespace_index += (num_separators + 1)
+        # paths starting with '_' hold backup metadata rather than namespaces
+        return [namespace for namespace in self._get_s3_subpaths(path) if not namespace.startswith("_")]
+
+    @lib.timing_wrapper
+    def _get_objects_to_restore(self, path, namespace, kinds=None, names=None, snapshot=None):
+        """Retrieve the objects to restore for a namespace in tier order
+
+        Arguments:
+            path {str} -- the path to root of the namespaces
+            namespace {str} -- the namespace
+            kinds {str[]} -- the kinds to restore, defaults to all
+            names {str[]} -- the objects to restore as name or kind/name, defaults to all
+            snapshot {str} -- the key of the snapshot manifest to restore from, defaults to the latest backup
+
+        Returns:
+            [tuple[]] -- the tier number and object summary from the bucket listing, or bundle index, for each object
+        """
+        objects = []
+        if snapshot is not None:
+            objects_by_kind = self._get_referenced_objects_by_kind(snapshot, path, namespace)
+            bundles = references = None
+        else:
+            objects_by_kind = self._get_objects_by_kind(path, namespace)
+            bundles = objects_by_kind.pop(bundle.BUNDLE_NAME, None)
+            references = objects_by_kind.pop(REFERENCES_NAME, None)
+        if bundles:
+            objects_by_kind = self._get_bundle_objects_by_kind(bundles[0]['Key'])
+        elif references:
+            objects_by_kind = self._get_referenced_objects_by_kind(references[0]['Key'], path, namespace)
+        for tier, tier_kinds in enumerate(self.kind_tiers):
+            for kind in tier_kinds:
+                if kinds is not None and kind not in kinds:
+                    continue
+                for item in objects_by_kind.get(kind, []):
+                    unprefixed_key = self.remove_prefix_from_key(item['Key'])
+                    _, _, _, _, name = S3.parse_key(unprefixed_key)
+                    if self.exclude_check(namespace, kind, name):
+                        lib.log.info("skipping: %s/%s in namespace %s", kind, name, namespace)
+                        continue
+                    if names is not None and not self._is_named(names, kind, name[:-len(".yaml")]):
+                        continue
+                    objects.append((tier, item))
+        return objects
+
+    @staticmethod
+    def _is_named(names, kind, name):
+        return name in names or "{}/{}".format(kind, name) in names
+
+    def _group_ranges(self, objects):
+        """Group the objects to restore into the requests to fetch them with
+
+        Bundle objects are grouped with the previous object when they follow
+        it in the same bundle within range_gap bytes, and the range stays
+        within range_size bytes. Other objects are fetched on their own.
+
+        Arguments:
+            objects {tuple[]} -- the tier number and object for each object, in the order to restore them
+
+        Returns:
+            [tuple[][]] -- the groups of objects
+        """
+        groups = []
+        start = end = None
+        for obj in objects:
+            item = obj[1]
+            if 'Bundle' in item and end is not None and item['Bundle'] == groups[-1][-1][1]['Bundle'] and \
+                    end <= item['Offset'] <= end + self.range_gap and \
+                    item['Offset'] + item['Length'] - start <= self.range_size:
+                groups[-1].append(obj)
+            else:
+                groups.append([obj])
+                start = item.get('Offset')
+            end = item['Offset'] + item['Length'] if 'Bundle' in item else None
+        return groups
+
+    def _fetch_objects(self, group):
+        """Download a group of objects from _group_ranges
+
+        Arguments:
+            group {tuple[]} -- the tier number and object for each object
+
+        Returns:
+            [bytes[]] -- the data of each object
+        """
+        first = group[0][1]
+        if 'Object' in first:
+            data = self.retrieve.get_bucket_item(first['Object'])
+            if hashlib.sha256(data).hexdigest() != first['Hash']:
+                raise Exception("hash mismatch for {} stored as {}".format(first['Key'], first['Object']))
+            return [data]
+        if 'Bundle' not in first:
+            return [self.retrieve.get_bucket_item(first['Key'])]
+
+        last = group[-1][1]
+        start = first['Offset']
+        data = self.retrieve.get_bucket_item_range(first['Bundle'], start, last['Offset'] + last['Length'] - 1)
+        result = []
+        for _, item in group:
+            document = bundle.read_document(data[item['Offset'] - start:item['Offset'] - start + item['Length']])
+            if item.get('Hash') is not None and hashlib.sha256(document).hexdigest() != item['Hash']:
+                raise Exception("hash mismatch for {} in bundle {}".format(item['Key'], item['Bundle']))
+            result.append(document)
+        return result
+
+    def _get_objects_by_kind(self, path, namespace):
+        """Retrieve the objects stored for a namespace grouped by kind
+
+        The namespace is listed once and the objects are grouped using the kind
+        segment of each key, rather than listing each kind separately.
+
+        Arguments:
+            path {str} -- the path to root of the namespaces
+            namespace {str} -- the namespace
+
+        Returns:
+            dict -- the object summaries for each kind, in the order they were listed
+        """
+        base = "{}/{}/".format(path, namespace)
+        objects_by_kind = {}
+        for item in self.retrieve.iter_bucket_objects(base):
+            kind = item['Key'][len(base):].split("/", 1)[0]
+            objects_by_kind.setdefault(kind, []).append(item)
+        return objects_by_kind
+
+    def _get_bundle_objects_by_kind(self, key):
+        """Retrieve the objects in a bundle grouped by kind
+
+        The footer and index are read with ranged GETs, the objects are not
+        downloaded. Each object has the key it would have in the per object
+        layout, and the bundle key, offset and length of its member.
+
+        Arguments:
+            key {str} -- the key of the bundle
+
+        Returns:
+            dict -- the objects for each kind, in the order they were stored
+        """
+        index_offset, index_length = bundle.read_footer(self.retrieve.get_bucket_item_tail(key, bundle.FOOTER_SIZE))
+        index = bundle.read_index(self.retrieve.get_bucket_item_range(key, index_offset, index_offset + index_length - 1))
+        objects_by_kind = {}
+        for entry in index["objects"]:
+            objects_by_kind.setdefault(entry["kind"], []).append(
+                {'Key': entry["key"], 'Bundle': key, 'Offset': entry["offset"], 'Length': entry["length"],
+                 'Size': entry["size"], 'Hash': entry.get("sha256")})
+        return objects_by_kind
+
+    def _iter_fetched(self, fetch, groups):
+        """Generator of each object and its data, prefetching the groups ahead"""
+        for group, results in lib.ordered_prefetch(fetch, groups,
+                                                   workers=self.prefetch_workers, max_bytes=self.prefetch_bytes,
+                                                   size_of=lambda group: sum(obj[1].get('Size', 0) for obj in group)):
+            for obj, data in zip(group, results):
+                yield obj, data
+
+    def _find_snapshot(self, clusterset, clustername, namespace, timestamp):
+        """Find the closest snapshot of a namespace taken at or before a time
+
+        Snapshot names count down, so the closest snapshot is the first key
+        after the name a snapshot taken a millisecond after the time would
+        have.
+
+        Arguments:
+            clusterset {str} -- the name of the clusterset
+            clustername {str} -- the cluster name
+            namespace {str} -- the namespace
+            timestamp {datetime|float} -- the time, naive datetimes are UTC
+
+        Returns:
+            str -- the key of the snapshot manifest, None if there is no snapshot at or before the time
+        """
+        snapshots_path = self.get_s3_snapshots_path(clusterset, clustername, namespace)
+        start_after = self._snapshot_key(snapshots_path, self.epoch_ms(timestamp) + 1)
+        key = next(self.retrieve.iter_bucket_keys(snapshots_path + "/", start_after=start_after, page_size=1), None)
+        if key is not None:
+            lib.log.info("restoring namespace %s from snapshot %s", namespace, key)
+        return key
+
+    def _get_referenced_objects_by_kind(self, key, path, namespace):
+        """Retrieve the objects referenced by a content layout or snapshot manifest grouped by kind
 
-        namespaces = list(map(lambda k: k.split('/')[namespace_index], keys))
-        return list(dict.fromkeys(namespaces))
+        Arguments:
+            key {str} -- the key of the references manifest
+            path {str} -- the path to root of the namespaces
+            namespace {str} -- the namespace
+
+        Returns:
+            dict -- the objects for each kind, with the key they would have in the per object
+                    layout and the key and hash of their content
+        """
+        manifest = json.loads(self.retrieve.get_bucket_item(key).decode("utf-8"))
+        sizes = manifest.get("sizes", {})
+        base = "{}/{}/".format(path, namespace)
+        objects_by_kind = {}
+        for object_key, digest in sorted(manifest["objects"].items()):
+            kind = object_key[len(base):].split("/", 1)[0]
+            objects_by_kind.setdefault(kind, []).append(
+                {'Key': object_key, 'Object': self.get_s3_content_key(manifest["content_path"], digest), 'Hash': digest,
+                 'Size': sizes.get(digest, 0)})
+        return objects_by_kind
+
+    def _get_s3_subpaths(self, path):
+        base = path + "/"
+        return [prefix[len(base):].rstrip("/") for prefix in self.retrieve.iter_common_prefixes(base)]
 
     @lib.timing_wrapper
-    def restore_namespaces(self, clusterSet, clusterName, namespacesToRestore):
+    def restore_namespaces(self, clusterSet, clusterName, namespacesToRestore, workers=1, kinds=None, names=None,
+                           timestamp=None):
+        """Restore namespaces from S3 using the strategy
+
+        A failure in one namespace is recorded in namespace_errors and does not
+        stop the others being restored. With more than one worker, namespaces
+        are restored concurrently, each using its own strategy instance from
+        strategy.new_instance(). The shared S3 client and the strategy's
+        connection pools are grown to allow for the concurrent namespaces.
+
+        Arguments:
+            clusterSet {str} -- the cluster set the backup was taken from
+            clusterName {str} -- the cluster name the backup was taken from
+            namespacesToRestore {str[]} -- the namespaces to restore, or '*' for all
+            workers {int} -- the number of namespaces to restore concurrently, defaults to 1
+            kinds {str[]} -- the kinds to restore, defaults to all
+            names {str[]} -- the objects to restore as name or kind/name, defaults to all
+            timestamp {datetime|float} -- restore the namespaces that have snapshots as they were at the closest
+                                          snapshot at or before this time, defaults to the latest backup.
+                                          Namespaces with no snapshot by then are skipped
+
+        Returns:
+            int -- the number of resources processed
+        """
         if not clusterSet:
             raise Exception("you must supply a cluster set")
         if not clusterName:
@@ -697,37 +2105,144 @@ class Restore(DRBase):
         if not namespacesToRestore:
             raise Exception("you must supply namespaces to restore, or use '*' for all")
 
-        namespace = []
+        self.retry_budget.reset(self.max_retries)
+        self._report = self._start_report("restore", cluster_set=clusterSet, cluster_name=clusterName, workers=workers)
+        try:
+            return self._restore_namespaces(clusterSet, clusterName, namespacesToRestore, workers, kinds, names, timestamp)
+        finally:
+            report = self._report
+            self._report = None
+            self._finish_report(report)
+
+    def _restore_namespaces(self, clusterSet, clusterName, namespacesToRestore, workers, kinds=None, names=None,
+                            timestamp=None):
         num_processed = 0
+        self.namespace_errors = {}
         ns_path = self.get_s3_namespaces_path(clusterSet, clusterName)
+        # namespaces deleted since a snapshot was taken are restored from it too
+        list_path = ns_path if timestamp is None else self.get_s3_snapshots_path(clusterSet, clusterName)
 
-        for namespace in self.get_s3_namespaces(ns_path):
+        namespaces = []
+        snapshots = {}
+        for namespace in self.get_s3_namespaces(list_path):
             if namespacesToRestore != "*" and namespace not in namespacesToRestore:
                 lib.log.info("skipping namespace: %s", namespace)
                 continue
+            if timestamp is not None:
+                snapshots[namespace] = self._find_snapshot(clusterSet, clusterName, namespace, timestamp)
+                if snapshots[namespace] is None:
+                    lib.log.info("skipping namespace %s, it has no snapshot at or before %s", namespace, timestamp)
+                    continue
+            namespaces.append(namespace)
+
+        if workers <= 1:
+            for namespace in namespaces:
+                try:
+                    num_processed += self._restore_namespace(ns_path, namespace, self.strategy, kinds, names,
+                                                             snapshots.get(namespace))
+                except Exception as e:
+                    lib.log.error("failed to restore namespace %s: %s", namespace, e)
+                    self.namespace_errors[namespace] = str(e)
+        else:
+            num_processed = self._restore_namespaces_concurrently(ns_path, namespaces, workers, kinds, names, snapshots)
 
-            lib.log.info("restoring namespace: %s", namespace)
-            self.strategy.start_namespace(namespace)
+        lib.log.info("restored %d resources in %d namespaces, %d namespaces failed",
+                     num_processed, len(namespaces) - len(self.namespace_errors), len(self.namespace_errors))
+        return num_processed
 
-            try:
-                for kind in Restore.kind_order:
-                    prefix = "{}/{}/{}".format(ns_path, namespace, kind)
-
-                    for key in self.retrieve.get_bucket_keys(prefix):
-                        unprefixed_key = self.remove_prefix_from_key(key)
-                        _, _, _, _, name = S3.parse_key(unprefixed_key)
-                        if self.exclude_check(namespace, kind, name):
-                            lib.log.info("skipping: %s/%s in namespace %s", kind, name, namespace)
-                            continue
-                        data = self.retrieve.get_bucket_item(key)
-                        lib.log.info("processing %s", key)
-                        lib.log.debug("%s", data.decode("utf-8"))
-                        self.strategy.process_resource(data)
-                        num_processed += 1
-            except ApiException as err:
-                if err.status == 409:
-                    lib.log.warning("resource already exists, skipping")
-                else:
-                    raise
-            self.strategy.finish_namespace()
+    def _restore_namespaces_concurrently(self, ns_path, namespaces, workers, kinds, names, snapshots):
+        """Restore namespaces on a pool of worker threads, recording failures in namespace_errors
+
+        Returns:
+            int -- the number of resources processed
+        """
+        num_processed = 0
+        # each namespace restored concurrently runs its own prefetch and strategy workers
+        self.retrieve.grow_pool(workers * self.prefetch_workers)
+        self.strategy.grow_pool(workers)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {namespace: pool.submit(self._restore_namespace, ns_path, namespace, self.strategy.new_instance(),
+                                              kinds, names, snapshots.get(namespace))
+                       for namespace in namespaces}
+            for namespace, future in futures.items():
+                try:
+                    num_processed += future.result()
+                except Exception as e:
+                    lib.log.error("failed to restore namespace %s: %s", namespace, e)
+                    self.namespace_errors[namespace] = str(e)
+        return num_processed
+
+    def _restore_namespace(self, ns_path, namespace, strategy, kinds=None, names=None, snapshot=None):
+        """Restore a namespace using a strategy
+
+        Arguments:
+            ns_path {str} -- the path to root of the namespaces
+            namespace {str} -- the namespace to restore
+            strategy {RestoreStrategy} -- the strategy to restore with
+            kinds {str[]} -- the kinds to restore, defaults to all
+            names {str[]} -- the objects to restore as name or kind/name, defaults to all
+            snapshot {str} -- the key of the snapshot manifest to restore from, defaults to the latest backup
+
+        Returns:
+            int -- the number of resources processed
+        """
+        try:
+            return self._restore_namespace_objects(ns_path, namespace, strategy, kinds, names, snapshot)
+        except Exception as e:
+            self._report.error(namespace, str(e))
+            raise
+
+    def _restore_namespace_objects(self, ns_path, namespace, strategy, kinds=None, names=None, snapshot=None):
+        """Restore the objects of a namespace using a strategy
+
+        If restoring fails before the strategy's finish_namespace is called,
+        its abort_namespace is called instead and the error is raised.
+
+        Returns:
+            int -- the number of resources processed
+        """
+        lib.log.info("restoring namespace: %s", namespace)
+        strategy.start_namespace(namespace)
+        finished = False
+        try:
+            num_processed = self._process_namespace_objects(ns_path, namespace, strategy, kinds, names, snapshot)
+            finished = True
+            with self._report.phase("apply", namespace):
+                strategy.finish_namespace()
+        finally:
+            if not finished:
+                lib.log.error("aborting restore of namespace %s", namespace)
+                strategy.abort_namespace()
+        return num_processed
+
+    def _process_namespace_objects(self, ns_path, namespace, strategy, kinds, names, snapshot):
+        num_processed = 0
+        report = self._report
+
+        def fetch(group):
+            with report.phase("download", namespace):
+                return self._fetch_objects(group)
+
+        try:
+            with report.phase("list", namespace):
+                groups = self._group_ranges(self._get_objects_to_restore(ns_path, namespace, kinds, names, snapshot))
+            current_tier = None
+            for (tier, item), data in self._iter_fetched(fetch, groups):
+                with report.phase("apply", namespace):
+                    if current_tier is not None and tier != current_tier:
+                        strategy.finish_tier()
+                    current_tier = tier
+                    lib.log.info("processing %s", item['Key'])
+                    lib.log.debug("%s", data.decode("utf-8"))
+                    strategy.process_resource(data)
+                num_processed += 1
+                _, _, _, kind, _ = S3.parse_key(self.remove_prefix_from_key(item['Key']))
+                report.add(namespace, kind, objects=1, bytes=len(data))
+            with report.phase("apply", namespace):
+                strategy.finish_tier()
+        except ApiException as err:
+            if err.status == 409:
+                lib.log.warning("resource already exists, skipping")
+            else:
+                raise
         return num_processed
@@ -6,17 +6,135 @@ This module includes utility functions and classes
 import os
 import sys
 import time
+import random
 import functools
+import contextlib
+import inspect
+import threading
+import collections
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import json
 import yaml
+import urllib3
+from botocore.exceptions import ClientError, HTTPClientError, ConnectionError as BotoConnectionError
+from kubernetes.client.rest import ApiException
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logging.basicConfig(format='%(asctime)-15s %(name)s:%(lineno)s - %(funcName)s() %(levelname)s - %(message)s', level=logging.INFO)
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
 
+# The libyaml based dumper and loader are used when PyYAML was built with them
+YamlDumper = getattr(yaml, "CDumper", yaml.Dumper)
+YamlSafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def yaml_dump(data):
+    """
+    Serialize data to yaml with the same settings as yaml.dump
+
+    The libyaml emitter can break long double quoted strings over lines
+    differently to the pure Python one, the text parses to the same data.
+
+    Args:
+    data      -- The data to serialize
+
+    Returns:
+    The yaml text
+    """
+    return yaml.dump(data, Dumper=YamlDumper)
+
+
+def yaml_safe_load(stream):
+    """
+    Parse yaml using only the standard yaml tags, as yaml.safe_load does
+
+    Args:
+    stream    -- The yaml text or bytes
+
+    Returns:
+    The parsed data
+    """
+    return yaml.load(stream, Loader=YamlSafeLoader)
+
+
+# The supported compression methods, named by their Content-Encoding, and default levels
+COMPRESSION_LEVELS = {"gzip": 6, "zstd": 3}
+
+
+def check_compression(method):
+    """
+    Raise an exception if a compression method cannot be used
+
+    Args:
+    method    -- The compression method, gzip or zstd
+    """
+    if method not in COMPRESSION_LEVELS:
+        raise Exception("compression must be one of: {}".format(", ".join(COMPRESSION_LEVELS.keys())))
+    if method == "zstd" and zstandard is None:
+        raise Exception("zstd compression needs the zstandard package, install it with: pip install k8sdrutils[zstd]")
+
+
+def compressor(method, level=None):
+    """
+    Create a streaming compressor
+
+    Args:
+    method    -- The compression method, gzip or zstd
+    level     -- The compression level, defaults to the method's default level
+
+    Returns:
+    An object with compress(data) and flush() methods returning compressed bytes
+    """
+    check_compression(method)
+    level = level if level is not None else COMPRESSION_LEVELS[method]
+    if method == "zstd":
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def compress(data, method, level=None):
+    """
+    Compress bytes
+
+    Args:
+    data      -- The bytes to compress
+    method    -- The compression method, gzip or zstd
+    level     -- The compression level, defaults to the method's default level
+
+    Returns:
+    The compressed bytes
+    """
+    c = compressor(method, level)
+    return c.compress(data) + c.flush()
+
+
+def decompress(data, method):
+    """
+    Decompress bytes compressed with compress
+
+    Args:
+    data      -- The compressed bytes
+    method    -- The compression method, gzip or zstd
+
+    Returns:
+    The decompressed bytes
+    """
+    check_compression(method)
+    if method == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
 class DateTimeEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, datetime):
@@ -73,15 +191,103 @@ def k8s_chunk_wrapper(func, limit=100, next_item=''):
     return wrapper
 
 
-def retry_wrapper(func, max_tries=5, delay=1, report=True):
+# Error codes returned by AWS services when a request is throttled or fails transiently
+RETRYABLE_AWS_ERROR_CODES = {"Throttling", "ThrottlingException", "ThrottledException", "SlowDown",
+                             "RequestLimitExceeded", "TooManyRequestsException", "RequestThrottled",
+                             "RequestTimeout", "RequestTimeoutException", "InternalError",
+                             "ServiceUnavailable", "PriorRequestNotComplete"}
+
+# HTTP status codes that are worth retrying, 0 is used by the kubernetes client for connection failures
+RETRYABLE_HTTP_STATUS = {0, 429, 500, 502, 503, 504}
+
+
+class RetryBudget(object):
+    """The number of retries allowed across all retry_wrapper calls in a run
+
+    A budget of None allows any number of retries. Once the budget is used up
+    failed operations are no longer retried, so a run against a service that
+    is down fails quickly rather than retrying every call. Each run object
+    holds its own budget, retry_budget is used by objects that do not.
+    """
+
+    def __init__(self, max_retries=None):
+        self._lock = threading.Lock()
+        self.max_retries = max_retries
+        self.used = 0
+
+    def reset(self, max_retries=None):
+        """Start a new run with the given budget"""
+        with self._lock:
+            self.max_retries = max_retries
+            self.used = 0
+
+    def acquire(self):
+        """Take one retry from the budget, returns False if the budget is used up"""
+        with self._lock:
+            if self.max_retries is not None and self.used >= self.max_retries:
+                return False
+            self.used += 1
+            return True
+
+
+retry_budget = RetryBudget()
+_retry_state = threading.local()
+
+
+def classify_error(e):
+    """
+    Work out whether an exception is worth retrying
+
+    Args:
+    e -- The exception raised
+
+    Returns:
+    True if the operation should be retried and the delay requested by the server in seconds or None
+    """
+    if isinstance(e, ApiException):
+        if e.status not in RETRYABLE_HTTP_STATUS:
+            return False, None
+        return True, _retry_after(e.headers)
+    if isinstance(e, ClientError):
+        error = e.response.get("Error", {})
+        metadata = e.response.get("ResponseMetadata", {})
+        if error.get("Code") in RETRYABLE_AWS_ERROR_CODES or \
+                metadata.get("HTTPStatusCode") in RETRYABLE_HTTP_STATUS:
+            return True, _retry_after(metadata.get("HTTPHeaders"))
+        return False, None
+    if isinstance(e, (BotoConnectionError, HTTPClientError, urllib3.exceptions.HTTPError,
+                      ConnectionError, TimeoutError)):
+        return True, None
+    return False, None
+
+
+def _retry_after(headers):
+    if not headers:
+        return None
+    value = headers.get("Retry-After", headers.get("retry-after"))
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_wrapper(func, max_tries=5, delay=1, report=True, max_delay=30):
     """
     Function wrapper to automatically retry failed operations
 
+    Only errors classified as transient by classify_error are retried, waiting
+    a random time of up to delay * 2 ** (tries - 1) seconds, capped at
+    max_delay, or the time asked for in a Retry-After header. Each retry is
+    taken from the retry_budget attribute of the object a method is called
+    on, if it is a RetryBudget, otherwise from the module's retry_budget. When a wrapped function calls another wrapped
+    function only the outermost one retries, so attempts do not multiply.
+
     Args:
     func      -- The function to be called
-    max_tries -- The maximum number of retries, defaults to 5
-    delay     -- Delay between each retry, defaults to 2 seconds
-    report    -- Indicate whether to report errors, defaults to False
+    max_tries -- The maximum number of attempts, defaults to 5
+    delay     -- Base delay for the exponential backoff, defaults to 1 second
+    report    -- Indicate whether to report errors, defaults to True
+    max_delay -- The maximum delay between attempts, defaults to 30 seconds
 
     Returns:
     Results returned by function called
@@ -89,26 +295,394 @@ def retry_wrapper(func, max_tries=5, delay=1, report=True):
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        tries = 0
-        while True:
-            tries += 1
-            try:
-                return func(*args, **kwargs)
-            except Exception as e:
-                if tries < max_tries:
-                    time.sleep(delay ** tries)
-                    continue
-                if report:
-                    log.error(
-                        "Operation: {0}, retried {1:d} times but failed, "
-                        "exception {2}".format(func.__name__, max_tries, e))
-                raise e
+        if getattr(_retry_state, "active", False):
+            return func(*args, **kwargs)
+
+        budget = getattr(args[0], "retry_budget", None) if len(args) > 0 else None
+        if not isinstance(budget, RetryBudget):
+            budget = retry_budget
+        _retry_state.active = True
+        try:
+            tries = 0
+            while True:
+                tries += 1
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    retryable, retry_after = classify_error(e)
+                    if not retryable:
+                        raise e
+                    if tries >= max_tries:
+                        if report:
+                            log.error(
+                                "Operation: {0}, retried {1:d} times but failed, "
+                                "exception {2}".format(func.__name__, tries - 1, e))
+                        raise e
+                    if not budget.acquire():
+                        if report:
+                            log.error(
+                                "Operation: {0}, retry budget used up, "
+                                "exception {1}".format(func.__name__, e))
+                        raise e
+                    metrics.inc("retries_total", operation=func.__name__)
+                    if retry_after is None:
+                        retry_after = random.uniform(0, delay * 2 ** (tries - 1))
+                    time.sleep(min(retry_after, max_delay))
+        finally:
+            _retry_state.active = False
+    return wrapper
+
+
+def dependency_tiers(dependencies):
+    """
+    Group the nodes of a dependency graph into tiers
+
+    Each tier only contains nodes whose dependencies are all in earlier tiers,
+    so the nodes within a tier are independent of each other. Nodes keep the
+    order they have in the dependencies dictionary within a tier.
+
+    Args:
+    dependencies -- Dictionary of the nodes each node depends on
+
+    Returns:
+    List of tiers, each a list of nodes
+    """
+    unknown = set(d for deps in dependencies.values() for d in deps) - set(dependencies.keys())
+    if len(unknown) > 0:
+        raise Exception("unknown dependencies: {}".format(", ".join(sorted(unknown))))
+
+    tiers = []
+    placed = set()
+    remaining = list(dependencies.keys())
+    while len(remaining) > 0:
+        tier = [node for node in remaining if all(d in placed for d in dependencies[node])]
+        if len(tier) == 0:
+            raise Exception("dependency cycle between: {}".format(", ".join(remaining)))
+        tiers.append(tier)
+        placed.update(tier)
+        remaining = [node for node in remaining if node not in placed]
+    return tiers
+
+
+def ordered_prefetch(fetch, items, workers=1, max_bytes=64 * 1024 * 1024, size_of=None):
+    """
+    Generator that runs fetch on each item using a pool of threads ahead of the consumer
+
+    Items are fetched concurrently but the results are yielded in the order of
+    the items. New fetches are only started while the estimated size of the
+    fetched but not yet consumed results is within max_bytes and fewer than
+    twice the number of workers are outstanding. At least one fetch is always
+    in flight so items larger than max_bytes are still fetched.
+
+    Args:
+    fetch     -- The function to call for each item
+    items     -- The items to fetch
+    workers   -- The number of threads to fetch with, defaults to 1
+    max_bytes -- The maximum number of bytes in flight, defaults to 64MiB
+    size_of   -- Function returning the estimated size of an item, defaults to 0 for all items
+
+    Returns:
+    Tuples of item and the result of fetch for that item
+    """
+    size_of = size_of if size_of is not None else (lambda item: 0)
+    items = iter(items)
+    pending = collections.deque()
+    in_flight = 0
+    next_item = next(items, _END)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            while pending or next_item is not _END:
+                while next_item is not _END and \
+                        (not pending or (len(pending) < workers * 2 and in_flight + size_of(next_item) <= max_bytes)):
+                    in_flight += size_of(next_item)
+                    pending.append((next_item, pool.submit(fetch, next_item)))
+                    next_item = next(items, _END)
+                item, future = pending.popleft()
+                result = future.result()
+                in_flight -= size_of(item)
+                yield item, result
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+_END = object()
+
+
+class RateLimiter(object):
+    """A token bucket limiting the rate of calls, shared by all threads using it
+
+    Calls wait in acquire until a token is available. Tokens are added at
+    rate per second up to burst. When the server signals it is overloaded
+    the rate is halved, down to min_qps, and new calls are held back for any
+    Retry-After period. Each successful call then raises the rate again by
+    a twentieth of qps until it is back at qps.
+    """
+
+    def __init__(self, qps, burst=None, min_qps=None):
+        if qps <= 0:
+            raise Exception("qps must be greater than zero")
+        self._lock = threading.Lock()
+        self.qps = float(qps)
+        self.burst = burst if burst is not None else max(int(qps), 1)
+        self.min_qps = min_qps if min_qps is not None else min(self.qps, 1.0)
+        self.rate = self.qps
+        self.throttled_count = 0
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._held_until = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(float(self.burst), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Wait until a call is allowed, returns the time waited in seconds"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = max(0.0, -self._tokens / self.rate, self._held_until - now)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self, retry_after=None):
+        """Slow down after the server rejected a call as overloaded"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.min_qps, self.rate / 2)
+            self.throttled_count += 1
+            if retry_after:
+                self._held_until = max(self._held_until, time.monotonic() + retry_after)
+        metrics.inc("throttled_total")
+        metrics.set("rate_limit_qps", self.rate)
+        log.warning("throttled by server, rate reduced to %.2f calls per second", self.rate)
+
+    def succeeded(self):
+        """Speed back up after a successful call"""
+        if self.rate >= self.qps:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = min(self.qps, self.rate + self.qps / 20)
+        metrics.set("rate_limit_qps", self.rate)
+
+    def stats(self):
+        """Returns the limiter settings and current state for monitoring"""
+        return {"qps": self.qps, "burst": self.burst, "rate": self.rate, "throttled": self.throttled_count}
+
+
+# HTTP status codes used by the kubernetes API server to signal overload, including
+# API priority and fairness rejections
+THROTTLED_HTTP_STATUS = {429, 503}
+
+
+def rate_limit_wrapper(func):
+    """
+    Method wrapper to limit the rate of calls using the object's rate_limiter
+
+    Each call is counted in the k8s_requests_total metric.
+
+    Args:
+    func      -- The method to be called, the object it is called on may have a rate_limiter attribute
+
+    Returns:
+    Results returned by method called
+    """
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        metrics.inc("k8s_requests_total", operation=func.__name__)
+        limiter = getattr(self, "rate_limiter", None)
+        if limiter is None:
+            return func(self, *args, **kwargs)
+
+        limiter.acquire()
+        try:
+            result = func(self, *args, **kwargs)
+        except ApiException as e:
+            if e.status in THROTTLED_HTTP_STATUS:
+                if e.headers and e.headers.get("X-Kubernetes-PF-PriorityLevel-UID"):
+                    log.debug("request rejected by priority level %s",
+                              e.headers.get("X-Kubernetes-PF-PriorityLevel-UID"))
+                limiter.throttled(_retry_after(e.headers))
+            raise e
+        limiter.succeeded()
+        return result
     return wrapper
 
 
+class MetricsRegistry(object):
+    """In-process counters, gauges and histograms
+
+    Metrics are identified by name and a set of labels. They can be written
+    out in the Prometheus text exposition format with to_prometheus or
+    write_prometheus, or served over HTTP with serve.
+    """
+
+    # Upper bounds of the latency histogram buckets in seconds
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, prefix="k8sdr_"):
+        self._lock = threading.Lock()
+        self.prefix = prefix
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge to value"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        """Record value in a histogram"""
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def counter(self, name, **labels):
+        """Returns the value of a counter, summed over any labels not given"""
+        return self._total(self._counters, name, labels)
+
+    def gauge(self, name, **labels):
+        """Returns the value of a gauge or None"""
+        return self._gauges.get(self._key(name, labels))
+
+    def histogram(self, name, **labels):
+        """Returns the count and sum of a histogram, summed over any labels not given"""
+        wanted = self._key(name, labels)[1]
+        count = 0
+        total = 0.0
+        with self._lock:
+            for (metric, metric_labels), histogram in self._histograms.items():
+                if metric == name and set(wanted) <= set(metric_labels):
+                    count += histogram[-1]
+                    total += histogram[-2]
+        return {"count": count, "sum": total}
+
+    def _total(self, values, name, labels):
+        wanted = self._key(name, labels)[1]
+        with self._lock:
+            return sum(value for (metric, metric_labels), value in values.items()
+                       if metric == name and set(wanted) <= set(metric_labels))
+
+    def reset(self):
+        """Remove all metrics"""
+        with self._lock:
+            self._counters = {}
+            self._gauges = {}
+            self._histograms = {}
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if len(labels) == 0:
+            return ""
+        escaped = [(k, v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for k, v in labels]
+        return "{" + ",".join('{}="{}"'.format(k, v) for k, v in escaped) + "}"
+
+    def to_prometheus(self):
+        """Returns all metrics in the Prometheus text exposition format"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted((key, list(value)) for key, value in self._histograms.items())
+
+        lines = []
+        typed = set()
+        for metric_type, samples in (("counter", counters), ("gauge", gauges)):
+            for (name, labels), value in samples:
+                if name not in typed:
+                    typed.add(name)
+                    lines.append("# TYPE {}{} {}".format(self.prefix, name, metric_type))
+                lines.append("{}{}{} {}".format(self.prefix, name, self._format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {}{} histogram".format(self.prefix, name))
+            for bound, count in zip(self.buckets, histogram):
+                lines.append("{}{}_bucket{} {}".format(self.prefix, name, self._format_labels(labels, (("le", str(bound)),)), count))
+            lines.append("{}{}_bucket{} {}".format(self.prefix, name, self._format_labels(labels, (("le", "+Inf"),)), histogram[-1]))
+            lines.append("{}{}_sum{} {}".format(self.prefix, name, self._format_labels(labels), histogram[-2]))
+            lines.append("{}{}_count{} {}".format(self.prefix, name, self._format_labels(labels), histogram[-1]))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write all metrics to a file in the Prometheus text exposition format
+
+        The file is replaced atomically so it can be read by a node exporter
+        textfile collector while being written.
+        """
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def serve(self, port=9090, address="127.0.0.1"):
+        """Serve the metrics over HTTP on a background thread
+
+        Args:
+        port    -- The port to listen on, 0 picks a free port
+        address -- The address to listen on, defaults to localhost only
+
+        Returns:
+        The HTTPServer, call shutdown on it to stop serving
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format, *args)
+
+        server = ThreadingHTTPServer((address, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        log.info("serving metrics on %s:%d", address, server.server_address[1])
+        return server
+
+
+metrics = MetricsRegistry()
+
+# Arguments of timed functions that are recorded as metric labels
+METRIC_LABEL_ARGS = ("namespace", "kind")
+
+
 def timing_wrapper(func):
     """
-    Function wrapper to automatically retry failed operations
+    Function wrapper to time operations
+
+    The elapsed time of each call is logged and recorded in the metrics
+    registry as the operation_seconds histogram, labelled with the operation
+    name and the namespace and kind arguments when the function has them.
+    Failed calls are also counted in operation_errors_total.
 
     Args:
     func      -- The function to be called
@@ -116,22 +690,160 @@ def timing_wrapper(func):
     Returns:
     Results returned by function called
     """
+    try:
+        params = list(inspect.signature(func).parameters)
+    except (TypeError, ValueError):
+        params = []
+    label_args = [(name, params.index(name)) for name in METRIC_LABEL_ARGS if name in params]
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        failed = True
         try:
-            started = datetime.utcnow()
-            return func(*args, **kwargs)
+            result = func(*args, **kwargs)
+            failed = False
+            return result
         finally:
-            finished = datetime.utcnow()
-            elapsed = finished - started
-            if elapsed.total_seconds() > 1:
-                log.info("Operation: {0}, Elapsed: {1}".format(func.__name__, str(elapsed)))
+            elapsed = time.perf_counter() - started
+            labels = {"operation": func.__name__}
+            for name, position in label_args:
+                labels[name] = args[position] if position < len(args) else kwargs.get(name)
+            metrics.observe("operation_seconds", elapsed, **labels)
+            if failed:
+                metrics.inc("operation_errors_total", **labels)
+            if elapsed > 1:
+                log.info("Operation: {0}, Elapsed: {1}".format(func.__name__, str(timedelta(seconds=elapsed))))
             else:
-                log.debug("Operation: {0}, Elapsed: {1}".format(func.__name__, str(elapsed)))
+                log.debug("Operation: {0}, Elapsed: {1}".format(func.__name__, str(timedelta(seconds=elapsed))))
     return wrapper
 
 
+class RunReport(object):
+    """A record of what a backup or restore run did
+
+    Object counts and bytes are kept per namespace and kind, along with the
+    time spent in each phase of the run. Phase times are summed over all the
+    threads working on the run, so they can add up to more than the elapsed
+    time. The S3 and Kubernetes request, byte, retry and throttling counts
+    are taken from the metrics registry at the start and end of the run.
+    When objects were compressed the report has a compression section with
+    the ratio achieved, the bytes saved and the CPU time it cost.
+    Reports from runs in other processes can be added with merge.
+    """
+
+    # Counters from the metrics registry included in the report
+    metric_counters = ("s3_requests_total", "k8s_requests_total", "s3_uploaded_bytes_total",
+                       "s3_downloaded_bytes_total", "retries_total", "throttled_total",
+                       "compression_input_bytes_total", "compression_output_bytes_total",
+                       "compression_cpu_seconds_total", "decompression_cpu_seconds_total")
+
+    def __init__(self, operation, **info):
+        self._lock = threading.Lock()
+        self.operation = operation
+        self.info = info
+        self.started = datetime.utcnow()
+        self.namespaces = {}
+        self.phases = {}
+        self.errors = {}
+        self._extra_metrics = {}
+        self._clock = time.perf_counter()
+        self._metrics_start = {name: metrics.counter(name) for name in self.metric_counters}
+
+    def _namespace(self, namespace):
+        if namespace not in self.namespaces:
+            self.namespaces[namespace] = {"kinds": {}, "phases": {}}
+        return self.namespaces[namespace]
+
+    def add(self, namespace, kind, **counts):
+        """Add counts for a kind in a namespace"""
+        with self._lock:
+            kinds = self._namespace(namespace)["kinds"]
+            totals = kinds.setdefault(kind, {})
+            for name, value in counts.items():
+                totals[name] = totals.get(name, 0) + value
+
+    def add_phase(self, name, seconds, namespace=None):
+        """Add time spent in a phase of the run"""
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+            if namespace is not None:
+                phases = self._namespace(namespace)["phases"]
+                phases[name] = phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name, namespace=None):
+        """Context manager timing a phase of the run"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - started, namespace)
+
+    def error(self, namespace, message):
+        """Record the failure of a namespace"""
+        with self._lock:
+            self.errors[namespace] = message
+
+    def merge(self, report):
+        """Add the counts from another run's report dictionary"""
+        with self._lock:
+            for namespace, data in report.get("namespaces", {}).items():
+                target = self._namespace(namespace)
+                for kind, counts in data.get("kinds", {}).items():
+                    totals = target["kinds"].setdefault(kind, {})
+                    for name, value in counts.items():
+                        totals[name] = totals.get(name, 0) + value
+                for name, seconds in data.get("phases", {}).items():
+                    target["phases"][name] = target["phases"].get(name, 0.0) + seconds
+            for name, seconds in report.get("phases", {}).items():
+                self.phases[name] = self.phases.get(name, 0.0) + seconds
+            for name, value in report.get("metrics", {}).items():
+                self._extra_metrics[name] = self._extra_metrics.get(name, 0) + value
+            self.errors.update(report.get("errors", {}))
+
+    def to_dict(self):
+        """Returns the report as a dictionary"""
+        with self._lock:
+            namespaces = json.loads(json.dumps(self.namespaces))
+            totals = {}
+            for data in namespaces.values():
+                data["totals"] = {}
+                for counts in data["kinds"].values():
+                    for name, value in counts.items():
+                        data["totals"][name] = data["totals"].get(name, 0) + value
+                        totals[name] = totals.get(name, 0) + value
+            run_metrics = {name: metrics.counter(name) - self._metrics_start[name] + self._extra_metrics.get(name, 0)
+                           for name in self.metric_counters}
+            report = {"operation": self.operation,
+                      "info": dict(self.info),
+                      "started": self.started,
+                      "elapsed_seconds": time.perf_counter() - self._clock,
+                      "totals": totals,
+                      "metrics": run_metrics,
+                      "phases": dict(self.phases),
+                      "namespaces": namespaces,
+                      "errors": dict(self.errors)}
+            if run_metrics["compression_input_bytes_total"] > 0:
+                report["compression"] = _compression_summary(run_metrics)
+            return report
+
+    def write(self, path):
+        """Write the report to a file as JSON"""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, cls=DateTimeEncoder, indent=2, sort_keys=True)
+
+
+def _compression_summary(run_metrics):
+    uncompressed = run_metrics["compression_input_bytes_total"]
+    compressed = run_metrics["compression_output_bytes_total"]
+    cpu_seconds = run_metrics["compression_cpu_seconds_total"]
+    return {"ratio": uncompressed / compressed if compressed > 0 else 0,
+            "saved_bytes": uncompressed - compressed,
+            "cpu_seconds": cpu_seconds,
+            "megabytes_per_cpu_second": uncompressed / 1024 / 1024 / cpu_seconds if cpu_seconds > 0 else 0}
+
+
 def _max_len(my_items,
              item_name='name',
              min_len=4):
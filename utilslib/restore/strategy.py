@@ -1,33 +1,63 @@
 """
 Restore strategies
 """
-import re
+import copy
 import os
 import subprocess
+import threading
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from kubernetes import client, config
-import yaml
 
 import utilslib.library as lib
-from utilslib.dr import Base
+from utilslib.dr import Base, Clients
 
 
 class RestoreStrategy(Base):
-    """Base class for a restore strategy"""
+    """Base class for a restore strategy
+
+    Namespaces restored concurrently each use an instance from new_instance(),
+    a deep copy of the strategy so the state set in __init__ is not shared.
+    Attributes named in shared_attributes, such as clients, locks and
+    semaphores, are shared by all the instances instead of being copied.
+    """
+
+    shared_attributes = ()
 
     def __init__(self, cluster_name, **kwargs):
         super(RestoreStrategy, self).__init__(**kwargs)
         self.cluster_name = cluster_name
 
+    def new_instance(self):
+        """Create a strategy with the same settings to restore a namespace concurrently with this one"""
+        memo = {id(getattr(self, name)): getattr(self, name) for name in self.shared_attributes if hasattr(self, name)}
+        return copy.deepcopy(self, memo)
+
+    def grow_pool(self, namespaces):
+        """Called before restoring namespaces namespaces at a time, each with an instance
+        from new_instance(), so shared connection pools can be sized for them. Does
+        nothing by default.
+        """
+
     def start_namespace(self, namespace):
         raise NotImplementedError
 
     def process_resource(self, resource_data):
         raise NotImplementedError
 
+    def finish_tier(self):
+        """Called when all the resources in a tier have been processed, before
+        any resources that depend on them are processed. Does nothing by default.
+        """
+
     def finish_namespace(self):
         raise NotImplementedError
 
+    def abort_namespace(self):
+        """Called instead of finish_namespace when restoring the namespace failed,
+        to release anything start_namespace acquired. Does nothing by default.
+        """
+
 
 class KubectlRestoreStrategy(RestoreStrategy):
     """Restore strategy that uses kubectl"""
@@ -57,6 +87,7 @@ class KubectlRestoreStrategy(RestoreStrategy):
     @lib.timing_wrapper
     def finish_namespace(self):
         self._output_file.close()
+        self._output_file = None
 
         command = "{} apply -f {}".format(self.kubectl_path, self._filename)
         if self.dry_run:
@@ -74,53 +105,255 @@ class KubectlRestoreStrategy(RestoreStrategy):
         lib.log.info("Kubectl command status/return code: %d", status)
         lib.log.debug("Kubectl output:\n%s", output)
 
+    def abort_namespace(self):
+        if self._output_file is not None:
+            self._output_file.close()
+            self._output_file = None
 
-class SingleResourceApplyStrategy(RestoreStrategy):
-    """Restore strategy that applies one at a time using the Kubernetes API
-    
-    Do not use at present
+
+class StreamingKubectlRestoreStrategy(RestoreStrategy):
+    """Restore strategy that streams resources to kubectl apply on stdin
+
+    A kubectl process is started for each namespace and resources are written
+    to it as they are processed, so no temporary file is needed. At most
+    max_concurrent kubectl processes run at once across this strategy and the
+    instances created from it with new_instance(). The result kubectl reports
+    for each resource is kept in results, e.g. {'configmap/coredns': 'created'}.
     """
-    def __init__(self, cluster_name, in_cluster=False) -> None:
+
+    shared_attributes = ("_slots",)
+
+    def __init__(self, cluster_name, kubectl_path, kubeconfig='', server_side=False, field_manager='', dry_run=False, max_concurrent=4):
         super().__init__(cluster_name)
-        if in_cluster:
-            config.load_incluster_config()
-        else:
-            config.load_kube_config()
-        self._client = client.ApiClient()
+        self.kubectl_path = kubectl_path
+        self.kubeconfig = kubeconfig
+        self.server_side = server_side
+        self.field_manager = field_manager
+        self.dry_run = dry_run
         self.namespace = None
-        raise Exception("Not fully implemented")
+        self.results = {}
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._process = None
+        self._readers = []
+        self._stdout = []
+        self._stderr = []
+
+    def _command(self):
+        command = [self.kubectl_path, "apply", "-f", "-"]
+        if self.server_side:
+            command.append("--server-side")
+            if len(self.field_manager) > 0:
+                command.append("--field-manager={}".format(self.field_manager))
+        if self.dry_run:
+            command.append("--dry-run=server" if self.server_side else "--dry-run=client")
+        if len(self.kubeconfig) > 0:
+            command.append("--kubeconfig={}".format(self.kubeconfig))
+        return command
+
+    @staticmethod
+    def _read_lines(stream, lines):
+        for line in iter(stream.readline, b''):
+            lines.append(line.decode("utf-8").rstrip("\n"))
+        stream.close()
 
+    @lib.timing_wrapper
     def start_namespace(self, namespace):
         self.namespace = namespace
+        self.results = {}
+        self._stdout = []
+        self._stderr = []
+        self._slots.acquire()
+        try:
+            command = self._command()
+            lib.log.debug("kubectl command: %s", " ".join(command))
+            self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except Exception:
+            self._slots.release()
+            raise
+        self._readers = [threading.Thread(target=self._read_lines, args=(self._process.stdout, self._stdout), daemon=True),
+                         threading.Thread(target=self._read_lines, args=(self._process.stderr, self._stderr), daemon=True)]
+        for reader in self._readers:
+            reader.start()
 
     def process_resource(self, resource_data):
-        doc = yaml.load(resource_data, Loader=yaml.FullLoader)
+        try:
+            self._process.stdin.write(resource_data)
+            if not resource_data.endswith(b"\n"):
+                self._process.stdin.write(b"\n")
+            self._process.stdin.write(b"---\n")
+        except BrokenPipeError:
+            lib.log.error("kubectl exited before all resources in namespace %s were written", self.namespace)
+
+    @lib.timing_wrapper
+    def finish_namespace(self):
+        try:
+            try:
+                self._process.stdin.close()
+            except BrokenPipeError:
+                pass
+            status = self._process.wait()
+            for reader in self._readers:
+                reader.join()
+        finally:
+            self._process = None
+            self._readers = []
+            self._slots.release()
 
-        group, _, version = doc["apiVersion"].partition("/")
-        if version == "":
-            version = group
-            group = "core"
+        for line in self._stdout:
+            resource, _, result = line.partition(" ")
+            self.results[resource] = result
+        lib.log.info("kubectl applied %d resources in namespace %s, status/return code: %d", len(self.results), self.namespace, status)
+        lib.log.debug("Kubectl output:\n%s", "\n".join(self._stdout))
+        if status != 0:
+            raise Exception("kubectl apply failed for namespace {}: {}".format(self.namespace, "\n".join(self._stderr)))
 
-        group = "".join(group.rsplit(".k8s.io", 1))
-        group = "".join(word.capitalize() for word in group.split('.'))
-        fcn_to_call = "{0}{1}Api".format(group, version.capitalize())
-        k8s_api = getattr(client, fcn_to_call)(self._client)
+    def abort_namespace(self):
+        """Stop kubectl without applying the namespace and release its process slot"""
+        if self._process is None:
+            return
+        try:
+            try:
+                self._process.stdin.close()
+            except BrokenPipeError:
+                pass
+            self._process.kill()
+            self._process.wait()
+            for reader in self._readers:
+                reader.join()
+        finally:
+            self._process = None
+            self._readers = []
+            self._slots.release()
+        lib.log.warning("kubectl apply aborted for namespace %s", self.namespace)
 
-        kind = doc["kind"]
-        kind = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', kind)
-        kind = re.sub('([a-z0-9])([A-Z])', r'\1_\2', kind).lower()
 
-        if hasattr(k8s_api, "create_namespaced_{0}".format(kind)):
-            resp = getattr(k8s_api, "create_namespaced_{0}".format(kind))(
-                body=doc, namespace=self.namespace)
-        else:
-            resp = getattr(k8s_api, "create_{0}".format(kind))(
-                body=doc)
+class SingleResourceApplyStrategy(RestoreStrategy):
+    """Restore strategy that server-side applies each resource using the Kubernetes API
+
+    Resources are held until their tier is finished and are then applied
+    concurrently by a pool of workers threads, sharing an ApiClient whose
+    connection pool is sized to match, and grown by grow_pool when
+    namespaces are restored concurrently. The ApiClient is taken from the
+    shared Clients registry unless the default kube config is used. The API
+    path for each apiVersion and kind is resolved once using API discovery
+    and cached.
+    """
+
+    shared_attributes = ("_client", "_api_resources", "_lock")
+
+    def __init__(self, cluster_name, in_cluster=False, kubeconfig='', field_manager='k8s-dr-utils', force=True, dry_run=False, workers=8, api_client=None) -> None:
+        super().__init__(cluster_name)
+        self.in_cluster = in_cluster
+        self.kubeconfig = kubeconfig
+        self._own_client = api_client is None
+        self._client = self._create_client(workers) if api_client is None else api_client
+        self.field_manager = field_manager
+        self.force = force
+        self.dry_run = dry_run
+        self.workers = workers
+        self.namespace = None
+        self.results = {}
+        self._pending = []
+        self._api_resources = {}
+        self._lock = threading.Lock()
+
+    def _create_client(self, pool_size):
+        if self.in_cluster or len(self.kubeconfig) > 0:
+            return Clients.k8s(self.kubeconfig if not self.in_cluster else '', pool_size=pool_size)
+        configuration = client.Configuration()
+        config.load_kube_config(client_configuration=configuration)
+        configuration.connection_pool_maxsize = pool_size
+        return client.ApiClient(configuration)
+
+    def grow_pool(self, namespaces):
+        pool_size = namespaces * self.workers
+        if self._own_client and self._client.configuration.connection_pool_maxsize < pool_size:
+            self._client = self._create_client(pool_size)
+
+    def start_namespace(self, namespace):
+        self.namespace = namespace
+        self.results = {}
+        self._pending = []
+
+    def process_resource(self, resource_data):
+        body = resource_data.decode("utf-8") if isinstance(resource_data, bytes) else resource_data
+        self._pending.append((lib.yaml_safe_load(body), body))
+
+    @lib.timing_wrapper
+    def finish_tier(self):
+        docs, self._pending = self._pending, []
+        if len(docs) == 0:
+            return
 
-        print("{0} created. status='{1}'".format(kind, str(resp.status)))
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # resources can share a kind and name, so each keeps its own future
+            futures = [(self._resource_name(doc), pool.submit(self._apply, doc, body)) for doc, body in docs]
+            for resource, future in futures:
+                try:
+                    future.result()
+                    if self.results.get(resource) != "failed":
+                        self.results[resource] = "serverside-applied"
+                except Exception as e:
+                    lib.log.error("failed to apply %s in namespace %s: %s", resource, self.namespace, e)
+                    self.results[resource] = "failed"
+                    failed.append(resource)
+        if len(failed) > 0:
+            raise Exception("failed to apply {} resources in namespace {}: {}".format(
+                len(failed), self.namespace, ", ".join(sorted(failed))))
 
     def finish_namespace(self):
-        lib.log.info("finished processing namespace %s", self.namespace)
+        self.finish_tier()
+        lib.log.info("finished processing namespace %s, applied %d resources", self.namespace, len(self.results))
+
+    def abort_namespace(self):
+        self._pending = []
+
+    @staticmethod
+    def _resource_name(doc):
+        return "{}/{}".format(doc["kind"].lower(), doc["metadata"]["name"])
+
+    def _apply(self, doc, body):
+        """Server-side apply a resource, sending the stored YAML unchanged"""
+        path = self._resource_path(doc)
+        query_params = [('fieldManager', self.field_manager)]
+        if self.force:
+            query_params.append(('force', 'true'))
+        if self.dry_run:
+            query_params.append(('dryRun', 'All'))
+        return self._client.call_api(path, 'PATCH',
+                                     query_params=query_params,
+                                     header_params={'Content-Type': 'application/apply-patch+yaml',
+                                                    'Accept': 'application/json'},
+                                     body=body,
+                                     auth_settings=['BearerToken'],
+                                     _return_http_data_only=True)
+
+    def _resource_path(self, doc):
+        base, plural, namespaced = self._get_api_resource(doc["apiVersion"], doc["kind"])
+        name = doc["metadata"]["name"]
+        if namespaced:
+            namespace = doc["metadata"].get("namespace", self.namespace)
+            return "{}/namespaces/{}/{}/{}".format(base, namespace, plural, name)
+        return "{}/{}/{}".format(base, plural, name)
+
+    def _get_api_resource(self, api_version, kind):
+        """Resolve the API path, resource name and scope for a kind, using discovery the first time"""
+        key = (api_version, kind)
+        with self._lock:
+            if key not in self._api_resources:
+                base = "/api/{}".format(api_version) if "/" not in api_version else "/apis/{}".format(api_version)
+                resource_list = self._client.call_api(base, 'GET',
+                                                      header_params={'Accept': 'application/json'},
+                                                      response_type='V1APIResourceList',
+                                                      auth_settings=['BearerToken'],
+                                                      _return_http_data_only=True)
+                for resource in resource_list.resources:
+                    if "/" not in resource.name:
+                        self._api_resources[(api_version, resource.kind)] = (base, resource.name, resource.namespaced)
+                if key not in self._api_resources:
+                    raise Exception("kind {} not found in api version {}".format(kind, api_version))
+            return self._api_resources[key]
 
 class NullStrategy(RestoreStrategy):
     """A strategy that does nothing, used for testing"""